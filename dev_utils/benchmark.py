@@ -0,0 +1,175 @@
+"""
+Benchmark the pipeline stages on synthetic snapshots (see generate_snapshot.py) of different sizes.
+Every stage runs in a fresh process, which loads the results of the previous stage from disk, like the scripts do.
+Only the stage itself is timed, the peak RSS of the process includes loading its inputs.
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+import pathlib
+import sys
+import tempfile
+from typing import Dict, Iterator, List
+
+from paging_detection import max_page_addr, PageTypes
+from paging_detection import instrumentation
+from paging_detection.analyze_type_prediction import calculate_errors
+from paging_detection.determine_types import determine_possible_types
+from paging_detection.extract_all_pages import build_page_graph
+from paging_detection.filters import prune_designations, pml4_kernel_mapping_similarity
+from paging_detection.mmaped import DesignationStore, MemMappedSnapshot, load_snapshot, save_snapshot
+from paging_detection.out_of_core import parse_size
+from paging_detection.page_graph import load_graph, save_graph
+
+from generate_snapshot import GeneratorConfig, generate_snapshot, write_snapshot
+
+STAGES = (
+    "extract_all_pages",
+    "determine_possible_types",
+    "prune_designations",
+    "pml4_kernel_mapping_similarity",
+    "calculate_errors",
+)
+
+
+class _StageCounters(instrumentation.Collector):
+    """
+    Sums up the counters of the spans directly below the stage span.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+
+    def span_finished(self, span: instrumentation.Span):
+        if span.parent is not None and span.parent.parent is None:
+            for name, value in span.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+
+def _run_stage(stage: str, workdir: pathlib.Path, jobs: int) -> Dict[str, float]:
+    """
+    Run a single stage on the files in workdir and save its results there.
+    :return: Wall-clock time of the stage, RSS after loading the inputs, peak RSS and the counters of the stage.
+    """
+    dump = workdir / "dump.raw"
+    all_pages, with_types, pruned = (workdir / name for name in ("all_pages", "with_types", "pruned"))
+
+    if stage == "extract_all_pages":
+        snapshot = MemMappedSnapshot(DesignationStore.create(str(dump), tracked=True))
+        run = lambda: build_page_graph(snapshot, max_page_addr(snapshot.size), jobs=jobs)
+        out = all_pages
+    elif stage == "determine_possible_types":
+        graph, snapshot = load_graph(all_pages.with_suffix(".pgraph")), load_snapshot(all_pages.with_suffix(".desig"))
+        run = lambda: determine_possible_types(graph, snapshot)
+        out = with_types
+    elif stage == "prune_designations":
+        graph, snapshot = load_graph(with_types.with_suffix(".pgraph")), load_snapshot(with_types.with_suffix(".desig"))
+        run = lambda: prune_designations(graph, snapshot)
+        out = pruned
+    elif stage == "pml4_kernel_mapping_similarity":
+        snapshot = load_snapshot(pruned.with_suffix(".desig"))
+        run = lambda: pml4_kernel_mapping_similarity(snapshot)
+        out = None
+    elif stage == "calculate_errors":
+        truth = load_snapshot(workdir / "dump_known_pages.desig")
+        predicted = load_snapshot(pruned.with_suffix(".desig"))
+        run = lambda: calculate_errors(truth, predicted)
+        out = None
+    else:
+        raise ValueError(f"Unknown stage {stage}.")
+
+    counters = _StageCounters()
+    instrumentation.set_collectors([counters])
+    baseline_rss = instrumentation.peak_rss()
+    with instrumentation.span(stage) as stage_span:
+        result = run()
+
+    if out is not None:
+        graph = graph if stage == "prune_designations" else result
+        if stage != "extract_all_pages":
+            snapshot.designations.set_designations(graph.nodes, {t: graph.node_data[str(t)] for t in PageTypes})
+        save_graph(graph, out.with_suffix(".pgraph"))
+        save_snapshot(snapshot, out.with_suffix(".desig"))
+    return {
+        "seconds": stage_span.seconds,
+        "baseline_rss": baseline_rss,
+        "peak_rss": stage_span.peak_rss,
+        "counters": counters.counters,
+    }
+
+
+def _stage_process(stage: str, workdir: pathlib.Path, jobs: int, conn):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        conn.send(_run_stage(stage, workdir, jobs))
+
+
+def _generate_process(config: GeneratorConfig, path: pathlib.Path):
+    write_snapshot(generate_snapshot(config, path), path, config.kpti)
+
+
+def benchmark(
+    config: GeneratorConfig, stages: List[str] = STAGES, jobs: int = 1, workdir: pathlib.Path = None
+) -> Iterator[Dict]:
+    """
+    Generate a snapshot and run the stages on it, each in a fresh process.
+    :return: Iterator over one record per stage.
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        tmp = pathlib.Path(tmp)
+        ctx = multiprocessing.get_context("spawn")
+        # Generating in a process of its own, the stage processes would inherit the peak RSS (ru_maxrss) of this one.
+        process = ctx.Process(target=_generate_process, args=(config, tmp / "dump.raw"))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Generating the snapshot failed with exit code {process.exitcode}.")
+        for stage in stages:
+            receiver, sender = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_stage_process, args=(stage, tmp, jobs, sender))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}.")
+            metrics = receiver.recv()
+            pages = config.size // 4096
+            yield {
+                "stage": stage,
+                "size": config.size,
+                "pages": pages,
+                "processes": config.processes,
+                "kpti": config.kpti,
+                "jobs": jobs,
+                **metrics,
+                "pages_per_second": pages / metrics["seconds"] if metrics["seconds"] else None,
+            }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic snapshots.")
+    parser.add_argument(
+        "--sizes", help="Snapshot sizes. (Default: 64M 256M 1G)", nargs="+", default=["64M", "256M", "1G"]
+    )
+    parser.add_argument("--processes", help="Number of processes per snapshot. (Default: 64)", type=int, default=64)
+    parser.add_argument("--kpti", help="Generate snapshots with KPTI PGD pairs.", action="store_true")
+    parser.add_argument("--stages", help="Stages to run. (Default: all)", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--jobs", help="Number of processes for extract_all_pages. (Default: 1)", type=int, default=1)
+    parser.add_argument("--seed", help="Random seed. (Default: 0)", type=int, default=0)
+    parser.add_argument("--workdir", help="Directory for the snapshots. (Default: system temp)", type=pathlib.Path)
+    parser.add_argument("--json", help="Print JSON lines instead of a table.", action="store_true")
+    args = parser.parse_args()
+
+    if not args.json:
+        print(f"{'size':>8} {'stage':<32}{'seconds':>10}{'peak RSS (MiB)':>16}{'pages/s':>14}")
+    for size in args.sizes:
+        config = GeneratorConfig(parse_size(size), args.processes, args.kpti, seed=args.seed)
+        for record in benchmark(config, args.stages, args.jobs, args.workdir):
+            if args.json:
+                print(json.dumps(record))
+            else:
+                mib = record["peak_rss"] / 2 ** 20
+                rate = record["pages_per_second"] or 0
+                print(f"{size:>8} {record['stage']:<32}{record['seconds']:>10.3f}{mib:>16.1f}{rate:>14.0f}")
+            sys.stdout.flush()
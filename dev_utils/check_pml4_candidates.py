@@ -0,0 +1,51 @@
+"""
+Check the PML4 triage (see paging_detection/pml4_candidates.py) on synthetic KPTI snapshots (see generate_snapshot.py):
+All kernel and user PGDs have to come out likely. Exits with status 1 otherwise.
+"""
+import pathlib
+import sys
+import tempfile
+from typing import List, Tuple
+
+from paging_detection import max_page_addr
+from paging_detection import instrumentation
+from paging_detection.mmaped import DesignationStore, MemMappedSnapshot
+from paging_detection.out_of_core import parse_size
+from paging_detection.pml4_candidates import find_pml4_candidates
+
+from generate_snapshot import GeneratorConfig, generate_snapshot
+
+# (size, processes, seed), 32 processes with seed 2 used to make a page table full of entries dominate similarity
+CONFIGS = [("32M", 32, seed) for seed in range(4)] + [("32M", 64, seed) for seed in range(1, 4)] + [("256M", 64, 1)]
+
+
+def check(config: GeneratorConfig, workdir: pathlib.Path) -> Tuple[int, int, int]:
+    """
+    Generate a snapshot and triage its PML4 candidates.
+    :return: Number of PGDs, PGDs that are not likely and likely candidates that are no PGD.
+    """
+    path = workdir / "dump.raw"
+    generated = generate_snapshot(config, path)
+    generated.entries.flush()
+    size = generated.entries.size * generated.entries.itemsize
+    snapshot = MemMappedSnapshot(DesignationStore.create(str(path), size))
+    candidates = find_pml4_candidates(snapshot, max_page_addr(size))
+    pgds = {pgd for kernel_pgd, user_pgd, _ in generated.tasks for pgd in (kernel_pgd, user_pgd)}
+    likely = set(candidates.address[candidates.likely])
+    return len(pgds), len(pgds - likely), len(likely - pgds)
+
+
+if __name__ == "__main__":
+    instrumentation.set_collectors([])
+    failed: List[str] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size, processes, seed in CONFIGS:
+            config = GeneratorConfig(parse_size(size), processes, kpti=True, seed=seed)
+            pgds, missed, false = check(config, pathlib.Path(tmp))
+            line = f"{size} {processes} processes seed {seed}: {pgds - missed}/{pgds} PGDs likely, {false} false likely"
+            print(line)
+            if missed:
+                failed.append(line)
+    if failed:
+        print(f"{len(failed)} snapshots with PGDs that are not likely.", file=sys.stderr)
+        sys.exit(1)
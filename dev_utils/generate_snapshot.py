@@ -0,0 +1,224 @@
+"""
+Generate synthetic raw snapshots with x86-64 paging structure hierarchies, e.g. to benchmark the pipeline without real
+dumps. Alongside the snapshot, the ground truth is written in the same formats as for real dumps: the designations of
+all paging structures (like extract_known_paging_structures.py) and a PGD csv (like the pslist_with_pgds plugin).
+"""
+import pathlib
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from paging_detection import CHUNK_PAGES, PageTypes, PAGING_STRUCTURE_SIZE, ENTRIES_PER_PAGE
+from paging_detection.mmaped import DesignationStore, MemMappedSnapshot, save_snapshot
+from paging_detection.out_of_core import parse_size
+
+# Entry flags
+PRESENT = 1 << 0
+RW = 1 << 1
+USER = 1 << 2
+ACCESSED = 1 << 5
+DIRTY = 1 << 6
+LARGE = 1 << 7
+NX = 1 << 63
+
+KERNEL_FLAGS = PRESENT | RW | ACCESSED | DIRTY
+USER_FLAGS = KERNEL_FLAGS | USER
+
+LARGE_PAGE_SIZES = {PageTypes.PDP: 1 << 30, PageTypes.PD: 1 << 21}
+
+# Ranges (low inclusive, high exclusive) of the number of user PML4 entries of a process and of entries of PDPs and PDs.
+USER_SLOTS = (1, 4)
+TABLE_ENTRIES = {PageTypes.PDP: (1, 4), PageTypes.PD: (1, 8)}
+
+# PML4 slots of the kernel half used by linux: direct map, vmalloc, vmemmap, cpu entry area, kernel text / modules.
+KERNEL_SLOTS = (273, 338, 468, 508, 511)
+# Kernel slots which are also present in the user PGD of a KPTI pair (cpu entry area)
+KPTI_USER_KERNEL_SLOTS = (508,)
+
+
+class GeneratorConfig(NamedTuple):
+    size: int
+    processes: int = 64
+    kpti: bool = False
+    large_pages: float = 0.1
+    noise: float = 0.3
+    seed: int = 0
+
+
+class GeneratedSnapshot(NamedTuple):
+    # Raw entry values, one row per page, memory mapped on the snapshot file
+    entries: np.ndarray
+    # Designations of all paging structures
+    truth: Dict[int, Set[PageTypes]]
+    # (kernel pgd, user pgd, comm) for KPTI snapshots, (pgd, comm) otherwise
+    tasks: List[Tuple]
+
+
+def max_pages(config: GeneratorConfig) -> int:
+    """
+    Upper bound of the pages a snapshot needs for its paging structures, including the unused page 0.
+    """
+    pdp_tree = 1 + (TABLE_ENTRIES[PageTypes.PDP][1] - 1) * (1 + TABLE_ENTRIES[PageTypes.PD][1] - 1)
+    pdp_trees = len(KERNEL_SLOTS) + (USER_SLOTS[1] - 1) * config.processes
+    return 1 + pdp_trees * pdp_tree + (2 if config.kpti else 1) * config.processes
+
+
+class _Generator:
+    def __init__(self, config: GeneratorConfig, path: pathlib.Path):
+        self.config = config
+        self.rng = np.random.default_rng(config.seed)
+        self.num_pages = config.size // PAGING_STRUCTURE_SIZE
+        if max_pages(config) > self.num_pages:
+            raise ValueError(
+                f"A snapshot of {config.size} bytes ({self.num_pages} pages) is too small for {config.processes} "
+                f"processes, their paging structures may need up to {max_pages(config)} pages."
+            )
+        # Written through to the (sparse) snapshot file, so snapshots may be bigger than memory.
+        self.entries = np.memmap(path, dtype="<u8", mode="w+", shape=(self.num_pages, ENTRIES_PER_PAGE))
+        self.truth: Dict[int, Set[PageTypes]] = {}
+
+        # Page 0 is never used. With KPTI, top level tables are allocated as 8kb aligned pairs.
+        pair_count = config.processes if config.kpti else 0
+        pairs = 2 * self.rng.choice(np.arange(1, self.num_pages // 2), size=pair_count, replace=False)
+        self.pairs = iter(pairs.tolist())
+        reserved = np.zeros(self.num_pages, dtype=bool)
+        reserved[0] = True
+        reserved[pairs] = reserved[pairs + 1] = True
+        self.free = iter(self.rng.permutation(np.flatnonzero(~reserved)).tolist())
+
+    def alloc(self, page_type: PageTypes) -> int:
+        page = next(self.free)
+        self.entries[page] = 0
+        self.truth[page * PAGING_STRUCTURE_SIZE] = {page_type}
+        return page
+
+    def data_page(self) -> int:
+        return int(self.rng.integers(1, self.num_pages))
+
+    def large_page(self, page_type: PageTypes) -> int:
+        # Large pages may lie outside of the snapshot (e.g. IOMem), they are not "out of bounds".
+        size = LARGE_PAGE_SIZES[page_type]
+        return int(self.rng.integers(0, max(2, self.config.size // size))) * size
+
+    def slots(self, low: int, high: int, count: int) -> np.ndarray:
+        return np.sort(self.rng.choice(np.arange(low, high), size=min(count, high - low), replace=False))
+
+    def table(self, page_type: PageTypes, flags: int) -> int:
+        """
+        Create a table of page_type and the hierarchy below it, return its page number.
+        """
+        page = self.alloc(page_type)
+        if page_type == PageTypes.PT:
+            for slot in self.slots(0, ENTRIES_PER_PAGE, int(self.rng.integers(16, ENTRIES_PER_PAGE))):
+                nx = NX if self.rng.random() < 0.5 else 0
+                self.entries[page, slot] = (self.data_page() * PAGING_STRUCTURE_SIZE) | flags | nx
+            return page
+        for slot in self.slots(0, ENTRIES_PER_PAGE, int(self.rng.integers(*TABLE_ENTRIES[page_type]))):
+            if self.rng.random() < self.config.large_pages:
+                self.entries[page, slot] = self.large_page(page_type) | flags | LARGE
+            else:
+                sub_type = PageTypes.PD if page_type == PageTypes.PDP else PageTypes.PT
+                self.entries[page, slot] = (self.table(sub_type, flags) * PAGING_STRUCTURE_SIZE) | flags
+        return page
+
+    def generate(self) -> GeneratedSnapshot:
+        # Random data first, tables overwrite it.
+        noise = np.flatnonzero(self.rng.random(self.num_pages) < self.config.noise)
+        for start in range(0, len(noise), CHUNK_PAGES):
+            chunk = noise[start : start + CHUNK_PAGES]
+            self.entries[chunk] = self.rng.integers(0, 2 ** 64, size=(len(chunk), ENTRIES_PER_PAGE), dtype=np.uint64)
+
+        kernel_half = np.zeros(ENTRIES_PER_PAGE // 2, dtype=np.uint64)
+        for slot in KERNEL_SLOTS:
+            pdp = self.table(PageTypes.PDP, KERNEL_FLAGS)
+            kernel_half[slot - ENTRIES_PER_PAGE // 2] = (pdp * PAGING_STRUCTURE_SIZE) | KERNEL_FLAGS
+
+        tasks = []
+        for i in range(self.config.processes):
+            user_half = np.zeros(ENTRIES_PER_PAGE // 2, dtype=np.uint64)
+            for slot in self.slots(0, ENTRIES_PER_PAGE // 2, int(self.rng.integers(*USER_SLOTS))):
+                user_half[slot] = (self.table(PageTypes.PDP, USER_FLAGS) * PAGING_STRUCTURE_SIZE) | USER_FLAGS
+            comm = f"proc{i}"
+            if self.config.kpti:
+                kernel_pgd = next(self.pairs)
+                user_pgd = kernel_pgd + 1
+                # Linux sets NX on the user mappings in the kernel PGD, the user PGD only maps the entry code.
+                user_half_nx = user_half | np.where(user_half, np.uint64(NX), np.uint64(0))
+                self.entries[kernel_pgd] = np.concatenate((user_half_nx, kernel_half))
+                user_kernel_half = np.zeros_like(kernel_half)
+                for slot in KPTI_USER_KERNEL_SLOTS:
+                    user_kernel_half[slot - ENTRIES_PER_PAGE // 2] = kernel_half[slot - ENTRIES_PER_PAGE // 2]
+                self.entries[user_pgd] = np.concatenate((user_half, user_kernel_half))
+                for pgd in (kernel_pgd, user_pgd):
+                    self.truth[pgd * PAGING_STRUCTURE_SIZE] = {PageTypes.PML4}
+                tasks.append((kernel_pgd * PAGING_STRUCTURE_SIZE, user_pgd * PAGING_STRUCTURE_SIZE, comm))
+            else:
+                pgd = self.alloc(PageTypes.PML4)
+                self.entries[pgd] = np.concatenate((user_half, kernel_half))
+                tasks.append((pgd * PAGING_STRUCTURE_SIZE, comm))
+        return GeneratedSnapshot(self.entries, self.truth, tasks)
+
+
+def generate_snapshot(config: GeneratorConfig, path: pathlib.Path) -> GeneratedSnapshot:
+    """
+    Generate a synthetic snapshot and write it to path:
+        - Every process has a PML4 with 1 - 3 user mappings (PDP -> PD -> PT -> data pages)
+        - All PML4s share the same kernel half (a PDP hierarchy per slot in KERNEL_SLOTS)
+        - With KPTI, every process has a pair of 8kb aligned PML4s, the user PGD at +4kb only maps the user half and
+          the cpu entry area
+        - PDP and PD entries map large pages (1GiB / 2MiB) with probability config.large_pages
+        - A share of config.noise pages is filled with random data
+    Paging structures are placed at random pages, never at page 0.
+    The snapshot is written through a memory map, it does not need to fit into memory.
+    """
+    return _Generator(config, path).generate()
+
+
+def write_snapshot(generated: GeneratedSnapshot, path: pathlib.Path, kpti: bool) -> Tuple[pathlib.Path, pathlib.Path]:
+    """
+    Finish writing a generated snapshot (see generate_snapshot) and write its ground truth.
+    :return: Paths of the ground truth designations (<stem>_known_pages.desig) and PGD csv (<stem>_pgds.csv).
+    """
+    generated.entries.flush()
+    size = generated.entries.size * generated.entries.itemsize
+    store = DesignationStore.create(str(path), size)
+    for addr, designations in generated.truth.items():
+        store[addr] = designations
+    truth_path = path.with_stem(path.stem + "_known_pages").with_suffix(".desig")
+    save_snapshot(MemMappedSnapshot(store), truth_path)
+
+    pgds_path = path.with_stem(path.stem + "_pgds").with_suffix(".csv")
+    columns = ["phy_pgd_kernel", "phy_pgd_user", "COMM"] if kpti else ["phy_pgd", "COMM"]
+    tasks = pd.DataFrame(generated.tasks, columns=columns)
+    if kpti:
+        tasks["phy_pgd"] = tasks["phy_pgd_kernel"]
+    tasks.to_csv(pgds_path, index=False)
+    return truth_path, pgds_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic raw snapshot and its ground truth.")
+    parser.add_argument("out_file", help="Path of the snapshot.", type=pathlib.Path)
+    parser.add_argument("--size", help="Size of the snapshot, e.g. 512M or 4G. (Default: 256M)", default="256M")
+    parser.add_argument("--processes", help="Number of processes. (Default: 64)", type=int, default=64)
+    parser.add_argument("--kpti", help="Allocate KPTI PGD pairs.", action="store_true")
+    parser.add_argument(
+        "--large-pages",
+        help="Probability of PDP / PD entries mapping large pages. (Default: 0.1)",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--noise", help="Share of pages filled with random data. (Default: 0.3)", type=float, default=0.3
+    )
+    parser.add_argument("--seed", help="Random seed. (Default: 0)", type=int, default=0)
+    args = parser.parse_args()
+
+    config = GeneratorConfig(parse_size(args.size), args.processes, args.kpti, args.large_pages, args.noise, args.seed)
+    generated = generate_snapshot(config, args.out_file)
+    truth_path, pgds_path = write_snapshot(generated, args.out_file, args.kpti)
+    print(f"Wrote {args.out_file} with {len(generated.truth)} paging structures.")
+    print(f"Ground truth: {truth_path}, {pgds_path}")
@@ -1,9 +1,9 @@
 from enum import Enum
-import functools
 from mmap import mmap
 import struct
 from typing import Tuple, Mapping, Union, Iterable, Dict, Set
 
+import numpy as np
 from pydantic import BaseModel, Field
 
 ReadableMem = Union[Mapping[slice, bytes], mmap]
@@ -13,7 +13,6 @@ class InvalidAddressException(Exception):
     ...
 
 
-@functools.lru_cache(maxsize=None)
 def dir2base(layer: ReadableMem, table_addr: int, index: int) -> Tuple[int, int]:
     entry_addr = table_addr + (8 * index)
     if entry_addr + 8 > len(layer):
@@ -29,8 +28,11 @@ def dir2base(layer: ReadableMem, table_addr: int, index: int) -> Tuple[int, int]
     return next_page, fields
 
 
-@functools.lru_cache(maxsize=None)
 def translate(layer: ReadableMem, dtb: int, vaddr: int) -> int:
+    """
+    Translate a single virtual address. Nothing is cached, use paging_detection.translation.Translator for repeated or
+    batch translations within one address space.
+    """
     (l4, f4) = dir2base(layer, dtb, (vaddr >> 39) & 0x1FF)
     (l3, f3) = dir2base(layer, l4, (vaddr >> 30) & 0x1FF)
     if f3 & 0x80:
@@ -45,6 +47,9 @@ def translate(layer: ReadableMem, dtb: int, vaddr: int) -> int:
 
 PAGING_STRUCTURE_SIZE = 2 ** 12
 PAGING_ENTRY_SIZE = 8
+ENTRIES_PER_PAGE = PAGING_STRUCTURE_SIZE // PAGING_ENTRY_SIZE
+# Number of pages processed at once by the chunked passes over snapshots, their entry arrays take 4kb per page.
+CHUNK_PAGES = 2 ** 14
 
 
 class PageTypes(Enum):
@@ -97,7 +102,8 @@ class PagingEntry(BaseModel):
 
     @property
     def user_access(self) -> bool:
-        return bool(self.value & (1 << 1))
+        # U/S flag, bit 1 is R/W
+        return bool(self.value & (1 << 2))
 
     def is_valid(self, page_type: PageTypes):
         if page_type == PageTypes.PML4:
@@ -123,6 +129,71 @@ class PagingEntry(BaseModel):
             return True
 
 
+# Vectorized counterparts of the PagingEntry properties above.
+# They operate on arrays of raw (little endian uint64) entry values of any shape and return arrays of the same shape.
+# All constants are numpy uint64 to avoid numpys signed / unsigned promotion rules turning values into floats.
+_PRESENT_BIT = np.uint64(1)
+_USER_BIT = np.uint64(1 << 2)
+_LARGE_BIT = np.uint64(1 << 7)
+_PML4E_MBZ = np.uint64(3 << 7)
+_PDPE_LARGE_MBZ = np.uint64(0x1FFFF << 12)
+_PDE_LARGE_MBZ = np.uint64(0xFF << 12)
+_NX_BIT = np.uint64(1 << 63)
+_TARGET_MASK = np.uint64(0x000FFFFFFFFFF000)
+
+
+def entries_present(values: np.ndarray) -> np.ndarray:
+    return (values & _PRESENT_BIT).astype(bool)
+
+
+def entries_target(values: np.ndarray) -> np.ndarray:
+    return values & _TARGET_MASK
+
+
+def entries_nx(values: np.ndarray) -> np.ndarray:
+    return (values & _NX_BIT).astype(bool)
+
+
+def entries_without_nx(values: np.ndarray) -> np.ndarray:
+    return values & ~_NX_BIT
+
+
+def entries_user_access(values: np.ndarray) -> np.ndarray:
+    return (values & _USER_BIT).astype(bool)
+
+
+def entries_large_page(values: np.ndarray) -> np.ndarray:
+    """
+    Present entries with bit 7 set. Whether they actually map a large page depends on the type of their table.
+    """
+    return entries_present(values) & (values & _LARGE_BIT).astype(bool)
+
+
+def entries_valid(values: np.ndarray, page_type: PageTypes) -> np.ndarray:
+    if page_type == PageTypes.PML4:
+        return ~(entries_present(values) & (values & _PML4E_MBZ).astype(bool))
+    if page_type == PageTypes.PDP:
+        return ~(entries_large_page(values) & (values & _PDPE_LARGE_MBZ).astype(bool))
+    if page_type == PageTypes.PD:
+        return ~(entries_large_page(values) & (values & _PDE_LARGE_MBZ).astype(bool))
+    if page_type == PageTypes.PT:
+        return np.ones(values.shape, dtype=bool)
+
+
+def entries_target_is_data(values: np.ndarray, page_type: PageTypes) -> np.ndarray:
+    """
+    Vectorized PagingEntry.target_is_data. Like the original, this does not check whether the entries are present.
+    """
+    if page_type == PageTypes.PML4:
+        return np.zeros(values.shape, dtype=bool)
+    if page_type == PageTypes.PDP:
+        return entries_valid(values, PageTypes.PDP) & (values & _LARGE_BIT).astype(bool)
+    if page_type == PageTypes.PD:
+        return entries_valid(values, PageTypes.PD) & (values & _LARGE_BIT).astype(bool)
+    if page_type == PageTypes.PT:
+        return np.ones(values.shape, dtype=bool)
+
+
 # The class used to represent a single PagingStructure was to be implemented here,
 # Now "MemMappedSnapshots" are used everywhere, but PagingStructure was used in a lot of type-signatures
 # TODO: Rename PagingStructure to PageView and change the import everywhere
@@ -1,65 +1,105 @@
-from collections import defaultdict, Counter
-from functools import cache
-import json
 from typing import Dict
 
+import numpy as np
 import pandas as pd
 
-from paging_detection import PageTypes, PagingStructure
-from paging_detection.mmaped import SnapshotPagingData, MemMappedSnapshot
-
-_PAGE_TYPES_ORDERED = tuple(PageTypes)
-
-
-class CachedMapsToData:
-    def __init__(self, pages: Dict[int, PagingStructure]):
-        self.pages = pages
-
-    @cache
-    def __call__(self, page: int, page_type: PageTypes) -> bool:
-        """
-        Determine if a page under a certain designation ends up mapping to any data pages.
-        """
-
-        page = self.pages[page]
-
-        assert page_type in page.designations
-
-        if page_type == PageTypes.PT and page.entries:
-            return True
-
-        for entry in page.entries.values():
-            if entry.target_is_data(page_type):
-                return True
-            else:
-                return self(entry.target, _PAGE_TYPES_ORDERED[_PAGE_TYPES_ORDERED.index(page_type) + 1])
-        return False
-
-
-def calculate_errors(pages_truth, pages_predicted):
-    maps_to_data = CachedMapsToData(pages_truth)
-    true_positives = defaultdict(lambda: 0)
-    false_positives = defaultdict(lambda: 0)
-    true_negatives = defaultdict(lambda: 0)
-    # Pages not mapping to any data are not counted here
-    false_negatives = defaultdict(lambda: 0)
-    # Considering false negatives where the real page does not map to any data
-    false_negatives_with_empty = defaultdict(lambda: 0)
-
-    for offset, pred in pages_predicted.items():
-        true_designations = pages_truth[offset].designations if offset in pages_truth else set()
-
-        for page_type in true_designations & pred.designations:
-            true_positives[page_type] += 1
-        for page_type in set(PageTypes) - (true_designations | pred.designations):
-            true_negatives[page_type] += 1
-        for page_type in pred.designations - true_designations:
-            false_positives[page_type] += 1
-        for page_type in true_designations - pred.designations:
-            false_negatives_with_empty[page_type] += 1
-            if maps_to_data(offset, page_type):
-                false_negatives[page_type] += 1
-    return true_positives, false_positives, true_negatives, false_negatives, false_negatives_with_empty
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGE_TYPES_ORDERED,
+    PAGING_STRUCTURE_SIZE,
+    next_type,
+    entries_present,
+    entries_target,
+    entries_target_is_data,
+)
+from paging_detection import instrumentation
+from paging_detection.mmaped import DESIGNATION_BITS, TRACKED_BIT, MemMappedSnapshot, load_snapshot
+
+ERROR_COLUMNS = ["TP", "FP", "TN", "FN", "FN (with empty)"]
+
+
+def maps_to_data(truth: MemMappedSnapshot) -> Dict[PageTypes, np.ndarray]:
+    """
+    Determine for all true paging structures whether they end up mapping to any data pages under their designations.
+    Computed bottom-up, one type at a time: A PT maps to data if it has a present entry, any other paging structure if
+    it has a present entry pointing to data (a large page) or to a paging structure of the next type mapping to data.
+    Entries pointing outside the snapshot are not considered.
+    :param truth: Snapshot with the true designations.
+    :return: Dict mapping page types to bool arrays with one value per page (indexed by page number).
+    """
+    store = truth.designations
+    num_pages = len(store.masks)
+    result = {}
+    for page_type in reversed(PAGE_TYPES_ORDERED):
+        addrs = store.addresses(page_type)
+        maps = np.zeros(num_pages, dtype=bool)
+        for start in range(0, len(addrs), CHUNK_PAGES):
+            chunk_addrs = addrs[start : start + CHUNK_PAGES]
+            entries = truth.gather_pages(chunk_addrs)
+            targets = entries_target(entries)
+            considered = entries_present(entries) & truth.in_bounds(targets)
+            if page_type != PageTypes.PT:
+                target_pages = np.minimum(targets // PAGING_STRUCTURE_SIZE, num_pages - 1).astype(np.int64)
+                points_to_data = entries_target_is_data(entries, page_type) | result[next_type(page_type)][target_pages]
+                considered &= points_to_data
+            maps[chunk_addrs // PAGING_STRUCTURE_SIZE] = considered.any(axis=1)
+        result[page_type] = maps
+    return result
+
+
+@instrumentation.span("calculate_errors")
+def calculate_errors(truth: MemMappedSnapshot, predicted: MemMappedSnapshot) -> pd.DataFrame:
+    """
+    Count the true / false positives and negatives of the predicted designations for every page type.
+    All pages in the store of predicted are evaluated, pages missing in truth have no true designations.
+    False negatives ("FN") only count pages which map to data under the missed type (see maps_to_data),
+    "FN (with empty)" counts all of them.
+    :param truth: Snapshot with the true designations.
+    :param predicted: Snapshot with the predicted designations.
+    :return: DataFrame indexed by page type, with the columns in ERROR_COLUMNS.
+    """
+    predicted_masks = np.asarray(predicted.designations.masks)
+    num_pages = len(predicted_masks)
+    common = min(num_pages, len(truth.designations.masks))
+    truth_masks = np.zeros(num_pages, dtype=np.uint8)
+    truth_masks[:common] = truth.designations.masks[:common]
+    has_data = {}
+    for page_type, maps in maps_to_data(truth).items():
+        has_data[page_type] = np.zeros(num_pages, dtype=bool)
+        has_data[page_type][:common] = maps[:common]
+
+    evaluated = (predicted_masks & TRACKED_BIT).astype(bool)
+    instrumentation.count("pages", int(np.count_nonzero(evaluated)))
+    rows = []
+    for page_type in PageTypes:
+        pred = evaluated & (predicted_masks & DESIGNATION_BITS[page_type]).astype(bool)
+        true = evaluated & (truth_masks & DESIGNATION_BITS[page_type]).astype(bool)
+        missed = true & ~pred
+        rows.append(
+            (
+                np.count_nonzero(pred & true),
+                np.count_nonzero(pred & ~true),
+                np.count_nonzero(evaluated & ~pred & ~true),
+                np.count_nonzero(missed & has_data[page_type]),
+                np.count_nonzero(missed),
+            )
+        )
+    return pd.DataFrame(rows, index=pd.Index(list(PageTypes), name="Type"), columns=ERROR_COLUMNS)
+
+
+def prediction_summary(truth: MemMappedSnapshot, predicted: MemMappedSnapshot) -> pd.DataFrame:
+    """
+    The errors (see calculate_errors) along with the true counts, accuracy, recall and precision for every page type.
+    """
+    summary_df = calculate_errors(truth, predicted)
+    summary_df["true counts"] = [int(np.count_nonzero(truth.designations.type_mask(t))) for t in summary_df.index]
+
+    total = len(predicted.designations)
+    summary_df["accuracy"] = (summary_df["TP"] + summary_df["TN"]) / total
+    summary_df["recall"] = summary_df["TP"] / summary_df["true counts"]
+    summary_df["precision"] = summary_df["TP"] / (summary_df["TP"] + summary_df["FP"])
+    return summary_df
 
 
 if __name__ == "__main__":
@@ -70,41 +110,26 @@ if __name__ == "__main__":
     parser.add_argument(
         "--csv-out", dest="csv_out", action="store_true", help="Print the results in csv format, suppress other prints."
     )
-    parser.add_argument("predictions", help="Snapshot JSON with predicted designations.", type=pathlib.Path)
-    parser.add_argument("truths", help="Snapshot JSON with true paging structures.", type=pathlib.Path)
+    parser.add_argument(
+        "predictions", help="Designations (.desig or .json) with predicted designations.", type=pathlib.Path
+    )
+    parser.add_argument("truths", help="Designations (.desig or .json) of true paging structures.", type=pathlib.Path)
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    if args.csv_out:
+        instrumentation.set_collectors([])
+    instrumentation.configure(args)
 
-    if not args.csv_out:
-        print("Loading page data.")
-    with open(args.predictions) as f:
-        predicted = MemMappedSnapshot(SnapshotPagingData.validate(json.load(f)))
-
-    with open(args.truths) as f:
-        truth = MemMappedSnapshot(SnapshotPagingData.validate(json.load(f)))
-
-    if not args.csv_out:
-        print("Filtering out of bound entries.")
-
-    for page in truth.pages.values():
-        page.entries = {offset: entry for offset, entry in page.entries.items() if entry.target < truth.size}
-
-    if not args.csv_out:
-        print("Counting errors.")
-    tp, fp, tn, fn, fnwe = calculate_errors(truth.pages, predicted.pages)
+    # Without collectors (--csv-out), nothing but the csv is printed.
+    instrumentation.log("Loading page data.")
+    predicted = load_snapshot(args.predictions)
+    truth = load_snapshot(args.truths)
 
-    truth_counts = Counter((page_type for page in truth.pages.values() for page_type in page.designations))
+    instrumentation.log("Counting errors.")
+    summary_df = prediction_summary(truth, predicted)
 
-    summary = [(pt, tp[pt], fp[pt], tn[pt], fn[pt], fnwe[pt]) for pt in PageTypes]
-    summary_df = pd.DataFrame(summary, columns=["Type", "TP", "FP", "TN", "FN", "FN (with empty)"]).set_index("Type")
-    summary_df["true counts"] = pd.Series(truth_counts)
-
-    total = len(predicted.pages)
-    summary_df["accuracy"] = (summary_df["TP"] + summary_df["TN"]) / total
-    summary_df["recall"] = summary_df["TP"] / summary_df["true counts"]
-    summary_df["precision"] = summary_df["TP"] / (summary_df["TP"] + summary_df["FP"])
-
-    if not args.csv_out:
-        print(summary_df.to_string())
-        print("Done")
-    else:
+    if args.csv_out:
         print(summary_df.to_csv())
+    else:
+        instrumentation.log(summary_df.to_string())
+        instrumentation.log("Done")
@@ -0,0 +1,436 @@
+"""
+Run the pipeline (see pipeline.py) on many snapshots, e.g. all captures of a day. Snapshots are taken from a directory
+or a manifest, each one is processed in a fresh process. If the PGDs of a snapshot are known (a csv from the
+pslist_with_pgds volatility plugin), its known paging structures are extracted and the prediction is evaluated like
+analyze_type_prediction.py does. The tables of all snapshots are aggregated into one csv.
+
+At most `workers` snapshots are processed at once and the estimated memory of the running ones (see MEMORY_FACTOR) has
+to fit into the memory budget, so big snapshots do not run side by side. The estimate is calibrated with the peak RSS of
+finished snapshots. A snapshot exceeding the budget on its own runs alone. Finished snapshots are recorded in a state
+file, an interrupted batch resumes where it stopped.
+"""
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
+import time
+import traceback
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import pandas as pd
+
+from paging_detection import PageTypes
+from paging_detection import instrumentation
+from paging_detection.analyze_type_prediction import prediction_summary
+from paging_detection.compressed import BLOCK_INDEX_SUFFIX, snapshot_stem
+from paging_detection.extract_known_paging_structures import read_paging_structures
+from paging_detection.mmaped import DESIGNATIONS_SUFFIX, save_snapshot
+from paging_detection.out_of_core import parse_size
+from paging_detection.page_graph import GRAPH_SUFFIX
+from paging_detection.page_index import INDEX_SUFFIX
+from paging_detection.physical import physical_size
+from paging_detection.pipeline import run_pipeline
+
+# Appended to the stem of a snapshot to find its PGD csv in a directory, like in the README.
+PGDS_SUFFIX = "_pgds.csv"
+# Appended to the stem of a snapshot for its evaluation (the table of analyze_type_prediction.py) and its log.
+PREDICTION_SUFFIX = "_type_prediction.csv"
+LOG_SUFFIX = "_batch.log"
+
+STATE_NAME = "batch_state.jsonl"
+AGGREGATE_NAME = "batch_type_prediction.csv"
+
+# Files in a directory with these suffixes are outputs or sidecars, not snapshots.
+NON_SNAPSHOT_SUFFIXES = {
+    ".csv",
+    ".json",
+    ".jsonl",
+    ".log",
+    ".txt",
+    ".graphml",
+    DESIGNATIONS_SUFFIX,
+    GRAPH_SUFFIX,
+    INDEX_SUFFIX,
+    BLOCK_INDEX_SUFFIX,
+}
+
+# Estimated memory of processing a snapshot, relative to the size of its physical address space, per scanning process.
+# (The snapshot is memory mapped and its pages are read a few times, on top of the graph and per page state. Every
+# scanning process maps and reads the snapshot itself.) The pipeline peaks at 1.3 - 2.1 times the size of synthetic
+# snapshots of 256M - 1G, see calibrate_memory_factor for raising it with the peaks measured in a batch.
+MEMORY_FACTOR = 2.0
+# Share of the physical memory kept free by the default memory budget, for the OS, the page cache and the batch itself.
+MEMORY_HEADROOM = 0.1
+
+
+class BatchJob(NamedTuple):
+    """
+    A snapshot to process, with the csv of its PGDs (from the pslist_with_pgds volatility plugin) if known.
+    """
+
+    snapshot: pathlib.Path
+    pgds: Optional[pathlib.Path] = None
+
+
+def find_jobs(directory: pathlib.Path) -> List[BatchJob]:
+    """
+    All snapshots in a directory (files not ending in NON_SNAPSHOT_SUFFIXES), sorted by name. The PGDs of a snapshot
+    are taken from <stem>_pgds.csv next to it, if present.
+    """
+    jobs = []
+    for path in sorted(directory.iterdir()):
+        if not path.is_file() or path.name.startswith(".") or path.suffix in NON_SNAPSHOT_SUFFIXES:
+            continue
+        pgds = path.with_name(snapshot_stem(path) + PGDS_SUFFIX)
+        jobs.append(BatchJob(path, pgds if pgds.exists() else None))
+    return jobs
+
+
+def read_manifest(manifest: pathlib.Path) -> List[BatchJob]:
+    """
+    Read the snapshots to process from a csv with a "snapshot" and an optional "pgds" column (empty if unknown).
+    Relative paths are relative to the directory of the manifest.
+    """
+    table = pd.read_csv(manifest, dtype=str)
+    if "snapshot" not in table.columns:
+        raise ValueError(f"Manifest {manifest} has no snapshot column.")
+    jobs = []
+    for row in table.itertuples(index=False):
+        pgds = getattr(row, "pgds", None)
+        jobs.append(
+            BatchJob(
+                manifest.parent / row.snapshot,
+                manifest.parent / pgds if isinstance(pgds, str) and pgds else None,
+            )
+        )
+    return jobs
+
+
+def read_pgds(pgds_path: pathlib.Path) -> List[int]:
+    """
+    Physical addresses of the PGDs in a csv of the pslist_with_pgds plugin. Both PGDs of every process are used if the
+    csv has the columns of a kernel with KPTI (phy_pgd_kernel and phy_pgd_user).
+    """
+    task_info = pd.read_csv(pgds_path)
+    if {"phy_pgd_kernel", "phy_pgd_user"} <= set(task_info.columns):
+        return task_info[["phy_pgd_kernel", "phy_pgd_user"]].to_numpy().ravel().tolist()
+    return task_info["phy_pgd"].tolist()
+
+
+def _output_path(snapshot: pathlib.Path, suffix: str) -> pathlib.Path:
+    return snapshot.with_name(snapshot_stem(snapshot) + suffix)
+
+
+def run_job(job: BatchJob, use_index: bool = False, jobs: int = 1) -> Dict:
+    """
+    Process a snapshot: Run the pipeline and, if its PGDs are known, save its known paging structures
+    (<stem>_known_pages.desig) and the evaluation (<stem>_type_prediction.csv).
+    :return: Summary of the run: Duration, peak RSS, number of predicted PML4s and whether it was evaluated.
+    """
+    timings = instrumentation.SummaryCollector(max_depth=0)
+    instrumentation.add_collector(timings)
+    with instrumentation.span("batch_job", snapshot=str(job.snapshot)) as job_span:
+        _, predicted = run_pipeline(job.snapshot, use_index=use_index, jobs=jobs)
+        if job.pgds is not None:
+            with instrumentation.span("evaluate"):
+                truth = read_paging_structures(str(job.snapshot), read_pgds(job.pgds))
+                save_snapshot(truth, _output_path(job.snapshot, "_known_pages").with_suffix(DESIGNATIONS_SUFFIX))
+                prediction_summary(truth, predicted).to_csv(_output_path(job.snapshot, PREDICTION_SUFFIX))
+        pml4s = len(predicted.designations.addresses(PageTypes.PML4))
+    instrumentation.log("Stage timings:\n" + timings.summary())
+    return {"seconds": job_span.seconds, "peak_rss": job_span.peak_rss, "pml4s": pml4s, "evaluated": bool(job.pgds)}
+
+
+def _job_process(job: BatchJob, use_index: bool, jobs: int, conn):
+    with open(_output_path(job.snapshot, LOG_SUFFIX), "w") as log:
+        instrumentation.set_collectors([instrumentation.ProgressCollector(log)])
+        try:
+            conn.send(run_job(job, use_index, jobs))
+        except Exception:
+            log.write(traceback.format_exc())
+            conn.send({"error": traceback.format_exc(limit=1).strip().splitlines()[-1]})
+
+
+def _fingerprint(snapshot: pathlib.Path) -> Dict:
+    stat = snapshot.stat()
+    return {"snapshot": str(snapshot.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_state(state_path: pathlib.Path) -> Dict[str, Dict]:
+    """
+    The last record of every snapshot in a state file, by resolved path. Lines cut off by an interruption are skipped.
+    """
+    records = {}
+    if state_path.exists():
+        for line in state_path.read_text().splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["snapshot"]] = record
+    return records
+
+
+def latest_record(job: BatchJob, state: Dict[str, Dict]) -> Optional[Dict]:
+    """
+    The last record of a snapshot in the state, None if it was not processed yet.
+    """
+    return state.get(str(job.snapshot.resolve()))
+
+
+def is_done(job: BatchJob, state: Dict[str, Dict]) -> bool:
+    """
+    Whether a snapshot was processed successfully according to the state, and has not changed since.
+    """
+    fingerprint = _fingerprint(job.snapshot)
+    record = state.get(fingerprint["snapshot"])
+    return (
+        record is not None
+        and record["status"] == "done"
+        and all(record[key] == value for key, value in fingerprint.items())
+    )
+
+
+def total_memory() -> int:
+    """
+    Physical memory of the machine.
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def estimate_memory(size: int, memory_factor: float = MEMORY_FACTOR, scan_jobs: int = 1) -> int:
+    """
+    Estimated memory of processing a snapshot with a physical address space of size bytes, see MEMORY_FACTOR.
+    """
+    return int(size * memory_factor * scan_jobs)
+
+
+def _estimates(sizes: Dict[BatchJob, int], memory_factor: float, scan_jobs: int) -> Dict[BatchJob, int]:
+    return {job: estimate_memory(size, memory_factor, scan_jobs) for job, size in sizes.items()}
+
+
+def calibrate_memory_factor(records: Iterable[Dict], memory_factor: float = MEMORY_FACTOR) -> float:
+    """
+    The memory factor, raised to the highest ratio of peak RSS to physical size among the successful records.
+    Records without these values (e.g. of earlier versions) are skipped.
+    """
+    ratios = [
+        record["peak_rss"] / record["physical_size"]
+        for record in records
+        if record["status"] == "done" and record.get("peak_rss") and record.get("physical_size")
+    ]
+    return max([memory_factor, *ratios])
+
+
+def _write_record(state_file, record: Dict):
+    state_file.write(json.dumps(record) + "\n")
+    state_file.flush()
+    instrumentation.count("snapshots")
+
+
+def _failed_record(job: BatchJob, error: OSError) -> Dict:
+    return {
+        "snapshot": str(job.snapshot.resolve()),
+        "pgds": str(job.pgds) if job.pgds else None,
+        "status": "failed",
+        "finished": time.time(),
+        "error": f"{type(error).__name__}: {error}",
+    }
+
+
+def run_batch(
+    jobs: List[BatchJob],
+    state_path: pathlib.Path,
+    workers: int = 1,
+    memory: Optional[int] = None,
+    memory_factor: float = MEMORY_FACTOR,
+    use_index: bool = False,
+    scan_jobs: int = 1,
+) -> Iterator[Dict]:
+    """
+    Process snapshots in fresh processes (see run_job), skipping the ones already done according to the state file.
+    The biggest snapshots are started first, smaller ones fill up the remaining memory. Every finished (or failed)
+    snapshot is appended to the state file. Missing or unreadable snapshots fail without stopping the batch.
+    :param jobs: Snapshots to process.
+    :param state_path: State file, it is created if it does not exist.
+    :param workers: Maximum number of snapshots processed at once.
+    :param memory: Memory budget of all running snapshots, in bytes. (Default: Physical memory of the machine, less
+    MEMORY_HEADROOM)
+    :param memory_factor: Estimated memory of a snapshot relative to its size per scanning process, see MEMORY_FACTOR.
+    It is raised to the peak RSS measured for snapshots in the state file and for every finished one, see
+    calibrate_memory_factor.
+    :param use_index: Whether the pipeline uses the page index, see run_pipeline.
+    :param scan_jobs: Number of processes scanning each snapshot, see run_pipeline.
+    :return: Iterator over the state records of the snapshots processed by this call, as they finish.
+    """
+    memory = int(total_memory() * (1 - MEMORY_HEADROOM)) if memory is None else memory
+    state = read_state(state_path)
+    memory_factor = calibrate_memory_factor(state.values(), memory_factor)
+    ctx = multiprocessing.get_context("spawn")
+    running = {}
+    with open(state_path, "a") as state_file:
+        pending, sizes, done = [], {}, 0
+        for job in jobs:
+            try:
+                if is_done(job, state):
+                    done += 1
+                    continue
+                sizes[job] = physical_size(job.snapshot)
+            except OSError as error:
+                record = _failed_record(job, error)
+                _write_record(state_file, record)
+                yield record
+                continue
+            pending.append(job)
+        instrumentation.log(f"{done} of {len(jobs)} snapshots are already done.")
+        pending.sort(key=lambda job: sizes[job], reverse=True)
+        estimates = _estimates(sizes, memory_factor, scan_jobs)
+
+        try:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= workers:
+                        break
+                    reserved = sum(estimates[other] for other, *_ in running.values())
+                    if running and reserved + estimates[job] > memory:
+                        continue
+                    if estimates[job] > memory:
+                        instrumentation.log(f"{job.snapshot} exceeds the memory budget, running it alone.")
+                    pending.remove(job)
+                    try:
+                        # Fingerprint before processing, a snapshot changing meanwhile is processed again next time.
+                        fingerprint = _fingerprint(job.snapshot)
+                    except OSError as error:
+                        record = _failed_record(job, error)
+                        _write_record(state_file, record)
+                        yield record
+                        continue
+                    receiver, sender = ctx.Pipe(duplex=False)
+                    process = ctx.Process(target=_job_process, args=(job, use_index, scan_jobs, sender))
+                    process.start()
+                    sender.close()
+                    running[process.sentinel] = (job, process, receiver, fingerprint, time.time())
+                    instrumentation.log(f"Started {job.snapshot}.")
+
+                if not running:
+                    continue
+                for sentinel in multiprocessing.connection.wait(list(running)):
+                    job, process, receiver, fingerprint, started = running.pop(sentinel)
+                    process.join()
+                    result = receiver.recv() if receiver.poll() else {"error": f"Exit code {process.exitcode}"}
+                    finished = time.time()
+                    record = {
+                        **fingerprint,
+                        "physical_size": sizes[job],
+                        "pgds": str(job.pgds) if job.pgds else None,
+                        "status": "failed" if "error" in result else "done",
+                        "finished": finished,
+                        "wall_seconds": finished - started,
+                        **result,
+                    }
+                    _write_record(state_file, record)
+                    calibrated = calibrate_memory_factor([record], memory_factor)
+                    if calibrated > memory_factor:
+                        instrumentation.log(f"Raising the memory factor to {calibrated:.2f}.")
+                        memory_factor = calibrated
+                        estimates = _estimates(sizes, memory_factor, scan_jobs)
+                    instrumentation.progress(1 - (len(pending) + len(running)) / max(len(estimates), 1))
+                    yield record
+        finally:
+            # Interrupted, the unfinished snapshots are processed again when resuming.
+            for _, process, *_ in running.values():
+                process.terminate()
+                process.join()
+
+
+def aggregate_predictions(jobs: List[BatchJob], state: Dict[str, Dict]) -> pd.DataFrame:
+    """
+    Concatenate the evaluations (<stem>_type_prediction.csv) of all evaluated snapshots whose last record in the state
+    is done, with the path of the snapshot as first column. (Evaluations left over from earlier runs of snapshots that
+    failed since are not included.)
+    """
+    tables = []
+    for job in jobs:
+        record = latest_record(job, state)
+        table_path = _output_path(job.snapshot, PREDICTION_SUFFIX)
+        if job.pgds is not None and record is not None and record["status"] == "done" and table_path.exists():
+            table = pd.read_csv(table_path)
+            table.insert(0, "snapshot", str(job.snapshot))
+            tables.append(table)
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline on many snapshots in parallel and evaluate the ones whose PGDs are known."
+    )
+    parser.add_argument(
+        "in_path",
+        help=f"Directory of snapshots (PGD csvs are found as <stem>{PGDS_SUFFIX}) or a csv manifest with a snapshot "
+        "and an optional pgds column. Outputs of every snapshot are saved next to it, like pipeline.py does.",
+        type=pathlib.Path,
+    )
+    parser.add_argument("--workers", help="Number of snapshots processed at once. (Default: 1)", type=int, default=1)
+    parser.add_argument(
+        "--memory",
+        help="Memory (e.g. 64G) the running snapshots may use in total, estimated from their sizes. "
+        f"(Default: Physical memory, less {MEMORY_HEADROOM * 100:.0f}%%)",
+        type=parse_size,
+    )
+    parser.add_argument(
+        "--memory-factor",
+        help=f"Estimated memory of a snapshot relative to its size, per process scanning it (see --jobs). It is raised "
+        f"to the peak memory measured for finished snapshots. (Default: {MEMORY_FACTOR})",
+        type=float,
+        default=MEMORY_FACTOR,
+    )
+    parser.add_argument(
+        "--jobs", help="Number of processes used to scan each snapshot. (Default: 1)", type=int, default=1
+    )
+    parser.add_argument("--index", help="Use the page index, see pipeline.py.", action="store_true")
+    parser.add_argument(
+        "--state",
+        help=f"State file of the batch, finished snapshots recorded in it are skipped. (Default: {STATE_NAME} in the "
+        "directory, or next to the manifest)",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--out",
+        help=f"Aggregated evaluation of all snapshots. (Default: {AGGREGATE_NAME} next to the state file)",
+        type=pathlib.Path,
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+
+    if args.in_path.is_dir():
+        batch_jobs, out_dir = find_jobs(args.in_path), args.in_path
+    else:
+        batch_jobs, out_dir = read_manifest(args.in_path), args.in_path.parent
+    state_path = args.state or out_dir / STATE_NAME
+    out_path = args.out or state_path.with_name(AGGREGATE_NAME)
+
+    with instrumentation.span("batch"):
+        for record in run_batch(
+            batch_jobs, state_path, args.workers, args.memory, args.memory_factor, args.index, args.jobs
+        ):
+            if record["status"] == "done":
+                instrumentation.log(
+                    f"Finished {record['snapshot']} in {record['seconds']:.1f}s, {record['pml4s']} PML4s."
+                )
+            else:
+                instrumentation.log(f"Failed {record['snapshot']}: {record['error']}")
+
+    state = read_state(state_path)
+    records = [latest_record(job, state) for job in batch_jobs]
+    failed = [record for record in records if record is not None and record["status"] != "done"]
+    if failed:
+        instrumentation.log(f"{len(failed)} snapshots failed, see their {LOG_SUFFIX} files. Rerun to retry them.")
+    predictions = aggregate_predictions(batch_jobs, state)
+    if len(predictions):
+        instrumentation.log(f"Saving aggregated evaluation: {out_path}")
+        predictions.to_csv(out_path, index=False)
+    instrumentation.log("Done")
@@ -0,0 +1,557 @@
+"""
+Random access to compressed snapshots, without decompressing them to a temporary file first.
+A compressed snapshot has to consist of independently compressed blocks:
+    - gzip: Concatenated members, e.g. from bgzip or the compress command of this module.
+    - xz: Streams with several blocks (xz --block-size, multi threaded xz) or concatenated streams.
+    - zstd: Concatenated frames. Needs python >= 3.14 (compression.zstd) or the zstandard package.
+The block index maps offsets in the decompressed snapshot to blocks. It is saved next to the snapshot (see
+BLOCK_INDEX_SUFFIX) when it is built, for gzip and zstd that requires decompressing the snapshot once.
+CompressedFile keeps an LRU of decompressed blocks and decompresses the next blocks on a background thread as long as
+they are read in order, e.g. by the scan of extract_all_pages.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+import lzma
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import zlib
+from typing import Callable, Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+from paging_detection import instrumentation
+
+try:
+    from compression import zstd  # python >= 3.14
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for zstd compressed snapshots
+    zstandard = None
+
+BLOCK_INDEX_SUFFIX = ".bidx"
+_BLOCK_INDEX_MAGIC = b"NOPGDBLK"
+_BLOCK_INDEX_VERSION = 1
+# magic, version, header length, compressed file size, compressed file modification time (ns)
+_BLOCK_INDEX_HEADER = struct.Struct("<8sIIQQ")
+
+# One record per block:
+#   start: Offset of the block in the decompressed snapshot
+#   size: Decompressed size
+#   file_offset: Offset of the compressed block in the file
+#   file_size: Compressed size (for xz: unpadded size of the block)
+#   stream_offset: Offset of the stream the block belongs to (xz only, the block is decompressed with its header)
+BLOCK_DTYPE = np.dtype(
+    [("start", "<u8"), ("size", "<u8"), ("file_offset", "<u8"), ("file_size", "<u8"), ("stream_offset", "<u8")]
+)
+
+_MAGICS = {"gzip": b"\x1f\x8b", "xz": b"\xfd7zXZ\x00", "zstd": b"\x28\xb5\x2f\xfd"}
+# File extensions of the formats, e.g. of the results of the compress command
+SUFFIXES = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+_XZ_HEADER_SIZE = 12
+_XZ_FOOTER_MAGIC = b"YZ"
+
+# Compressed bytes fed to a decompressor at once while building the block index
+_SCAN_CHUNK = 2 ** 16
+# Blocks larger than this are rejected, random access would decompress too much
+MAX_BLOCK_SIZE = 2 ** 28
+# Default block size of the compress command
+DEFAULT_BLOCK_SIZE = 2 ** 20
+# Decompressed bytes kept in the LRU
+CACHE_SIZE = 2 ** 26
+# Decompressed bytes read ahead during sequential reads
+READAHEAD_SIZE = 2 ** 23
+
+
+def compression_format(path: Union[str, pathlib.Path]) -> Optional[str]:
+    """
+    Detect the compression of a file by its magic: "gzip", "xz", "zstd" or None if it is not compressed.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(max(len(m) for m in _MAGICS.values()))
+    return next((fmt for fmt, m in _MAGICS.items() if magic.startswith(m)), None)
+
+
+def snapshot_stem(path: Union[str, pathlib.Path]) -> str:
+    """
+    The stem outputs of a snapshot are named after, e.g. <stem>_all_pages.desig: Its name without the extension,
+    unless it is compressed (has one of SUFFIXES). Compressed snapshots keep their extension, so e.g. dump.raw.gz and
+    dump.raw.xz in the same directory do not overwrite each other's outputs.
+    """
+    path = pathlib.Path(path)
+    return path.name if path.suffix in SUFFIXES.values() else path.stem
+
+
+def _zstd_decompressor():
+    if zstd is not None:
+        return zstd.ZstdDecompressor()
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ImportError("Reading zstd compressed snapshots requires python >= 3.14 or the zstandard package.")
+
+
+def _gzip_compress(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zstd_compress(data: bytes, level: int) -> bytes:
+    if zstd is not None:
+        return zstd.compress(data, level)
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level).compress(data)
+    raise ImportError("Writing zstd compressed snapshots requires python >= 3.14 or the zstandard package.")
+
+
+# Decompressors of a single gzip member / zstd frame, they stop at its end (eof) and keep the rest (unused_data).
+_FRAME_DECOMPRESSORS: Dict[str, Callable] = {
+    "gzip": lambda: zlib.decompressobj(wbits=31),
+    "zstd": _zstd_decompressor,
+}
+
+
+def _scan_frames(data: memoryview, fmt: str) -> Iterator[Tuple[int, int, int]]:
+    """
+    Decompress the frames (gzip members / zstd frames) of a file one after another.
+    :return: Iterator of (file offset, compressed size, decompressed size) of every frame.
+    """
+    pos = 0
+    while pos < len(data):
+        if data[pos] == 0:  # Padding between frames
+            pos += 1
+            continue
+        decompressor = _FRAME_DECOMPRESSORS[fmt]()
+        start, size = pos, 0
+        while not decompressor.eof:
+            if pos >= len(data):
+                raise ValueError(f"Truncated {fmt} frame at file offset {start}.")
+            chunk = data[pos : pos + _SCAN_CHUNK]
+            size += len(decompressor.decompress(chunk))
+            pos += len(chunk)
+            if size > MAX_BLOCK_SIZE:
+                raise ValueError(
+                    f"{fmt} frame at file offset {start} is larger than {MAX_BLOCK_SIZE} bytes. Recompress the "
+                    "snapshot in blocks, e.g. with python3 compressed.py compress."
+                )
+        pos -= len(decompressor.unused_data)
+        yield start, pos - start, size
+        instrumentation.progress(pos / len(data))
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _varint(value: int) -> bytes:
+    result = bytearray()
+    while value >= 0x80:
+        result.append(value & 0x7F | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _padded(size: int) -> int:
+    return (size + 3) & ~3
+
+
+def _scan_xz_blocks(data: memoryview) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Read the blocks of all streams of an xz file from their indexes, without decompressing anything.
+    Streams are walked from the end of the file, following the backward size in their footers.
+    :return: Iterator of (file offset, unpadded size, decompressed size, stream offset) of every block, in order.
+    """
+    streams = []
+    pos = len(data)
+    while pos > 0:
+        while pos >= 4 and bytes(data[pos - 4 : pos]) == bytes(4):  # Stream padding
+            pos -= 4
+        if pos == 0:
+            break
+        footer = bytes(data[pos - _XZ_HEADER_SIZE : pos])
+        if footer[-2:] != _XZ_FOOTER_MAGIC:
+            raise ValueError(f"Invalid xz stream footer at file offset {pos - _XZ_HEADER_SIZE}.")
+        index_size = (struct.unpack_from("<I", footer, 4)[0] + 1) * 4
+        index_start = pos - _XZ_HEADER_SIZE - index_size
+        index = bytes(data[index_start : index_start + index_size])
+        count, index_pos = _read_varint(index, 1)
+        records = []
+        for _ in range(count):
+            unpadded, index_pos = _read_varint(index, index_pos)
+            decompressed, index_pos = _read_varint(index, index_pos)
+            records.append((unpadded, decompressed))
+        stream_offset = index_start - sum(_padded(unpadded) for unpadded, _ in records) - _XZ_HEADER_SIZE
+        if bytes(data[stream_offset : stream_offset + len(_MAGICS["xz"])]) != _MAGICS["xz"]:
+            raise ValueError(f"Invalid xz stream header at file offset {stream_offset}.")
+        streams.append((stream_offset, records))
+        pos = stream_offset
+    for stream_offset, records in reversed(streams):
+        block_offset = stream_offset + _XZ_HEADER_SIZE
+        for unpadded, decompressed in records:
+            if decompressed > MAX_BLOCK_SIZE:
+                raise ValueError(
+                    f"xz block at file offset {block_offset} is larger than {MAX_BLOCK_SIZE} bytes. Recompress the "
+                    "snapshot with smaller blocks, e.g. xz --block-size."
+                )
+            yield block_offset, unpadded, decompressed, stream_offset
+            block_offset += _padded(unpadded)
+
+
+def _xz_single_block_stream(header: bytes, block: bytes, unpadded: int, decompressed: int) -> bytes:
+    """
+    Wrap a block of an xz stream into a stream of its own (with the header of the original stream), so it can be
+    decompressed on its own.
+    """
+    index = b"\x00" + _varint(1) + _varint(unpadded) + _varint(decompressed)
+    index += bytes(_padded(len(index)) - len(index))
+    index += struct.pack("<I", zlib.crc32(index))
+    stream_flags = header[6:8]
+    backward_size = struct.pack("<I", len(index) // 4 - 1)
+    footer = struct.pack("<I", zlib.crc32(backward_size + stream_flags)) + backward_size + stream_flags
+    return header + block + index + footer + _XZ_FOOTER_MAGIC
+
+
+class BlockIndex:
+    """
+    Maps offsets in a decompressed snapshot to the compressed blocks of the snapshot file, see BLOCK_DTYPE.
+    """
+
+    def __init__(self, fmt: str, file_size: int, mtime_ns: int, blocks: np.ndarray):
+        """
+        :param fmt: Compression format, see compression_format.
+        :param file_size: Size of the compressed file when the index was built.
+        :param mtime_ns: Modification time of the compressed file when the index was built.
+        :param blocks: Array of BLOCK_DTYPE records, ordered by start.
+        """
+        self.format = fmt
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.blocks = blocks
+        self.starts = blocks["start"]
+        self.ends = blocks["start"] + blocks["size"]
+
+    @property
+    def size(self) -> int:
+        """
+        Size of the decompressed snapshot.
+        """
+        return int(self.ends[-1]) if len(self.blocks) else 0
+
+    @staticmethod
+    def sidecar_path(path: Union[str, pathlib.Path]) -> pathlib.Path:
+        path = pathlib.Path(path)
+        return path.with_name(path.name + BLOCK_INDEX_SUFFIX)
+
+    @classmethod
+    @instrumentation.span("block_index")
+    def build(cls, path: Union[str, pathlib.Path]) -> "BlockIndex":
+        """
+        Build the block index of a compressed file. gzip and zstd files are decompressed once to find the frames.
+        """
+        fmt = compression_format(path)
+        if fmt is None:
+            raise ValueError(f"{path} is not compressed.")
+        stat = os.stat(path)
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = memoryview(mm)
+            try:
+                if fmt == "xz":
+                    records = list(_scan_xz_blocks(data))
+                else:
+                    records = [
+                        (offset, size, decompressed, offset) for offset, size, decompressed in _scan_frames(data, fmt)
+                    ]
+            finally:
+                data.release()
+        blocks = np.zeros(len(records), dtype=BLOCK_DTYPE)
+        for name, column in zip(("file_offset", "file_size", "size", "stream_offset"), zip(*records)):
+            blocks[name] = column
+        blocks["start"][1:] = np.cumsum(blocks["size"])[:-1]
+        instrumentation.count("blocks", len(blocks))
+        return cls(fmt, stat.st_size, stat.st_mtime_ns, blocks)
+
+    @classmethod
+    def load(cls, file: Union[str, pathlib.Path]) -> "BlockIndex":
+        with open(file, "rb") as f:
+            magic, version, header_len, file_size, mtime_ns = _BLOCK_INDEX_HEADER.unpack(
+                f.read(_BLOCK_INDEX_HEADER.size)
+            )
+            if magic != _BLOCK_INDEX_MAGIC or version != _BLOCK_INDEX_VERSION:
+                raise ValueError(f"{file} is not a block index (version {_BLOCK_INDEX_VERSION}).")
+            fmt = f.read(header_len - _BLOCK_INDEX_HEADER.size).rstrip(b"\x00").decode()
+            blocks = np.frombuffer(f.read(), dtype=BLOCK_DTYPE)
+        return cls(fmt, file_size, mtime_ns, blocks)
+
+    def save(self, file: Union[str, pathlib.Path]):
+        # The format name is stored (zero padded) after the fixed header.
+        header_len = _BLOCK_INDEX_HEADER.size + 8
+        with open(file, "wb") as f:
+            f.write(
+                _BLOCK_INDEX_HEADER.pack(
+                    _BLOCK_INDEX_MAGIC, _BLOCK_INDEX_VERSION, header_len, self.file_size, self.mtime_ns
+                )
+            )
+            f.write(self.format.encode().ljust(header_len - _BLOCK_INDEX_HEADER.size, b"\x00"))
+            f.write(np.ascontiguousarray(self.blocks).data)
+
+    def matches(self, path: Union[str, pathlib.Path]) -> bool:
+        """
+        Whether the index (still) belongs to the file at path, judging by its size and modification time.
+        """
+        stat = os.stat(path)
+        return stat.st_size == self.file_size and stat.st_mtime_ns == self.mtime_ns
+
+
+def load_or_build_block_index(path: Union[str, pathlib.Path]) -> BlockIndex:
+    """
+    Load the sidecar block index of a compressed file, or build and save it if it is missing or outdated.
+    If it can not be saved (e.g. read only directory), it is only kept in memory.
+    """
+    sidecar = BlockIndex.sidecar_path(path)
+    if sidecar.exists():
+        index = BlockIndex.load(sidecar)
+        if index.matches(path):
+            return index
+        instrumentation.log(f"Block index {sidecar} is outdated.")
+    index = BlockIndex.build(path)
+    try:
+        index.save(sidecar)
+        instrumentation.log(f"Saved block index: {sidecar}")
+    except OSError as e:
+        instrumentation.log(f"Could not save block index {sidecar}: {e}")
+    return index
+
+
+class CompressedFile(io.RawIOBase):
+    """
+    Read only, seekable file of the decompressed content of a compressed snapshot, see the module docstring.
+    pread and gather read at arbitrary offsets without moving the file position.
+    Decompressed blocks are kept in an LRU of cache_size bytes. Whenever the block after the previously read one is
+    read, the blocks in the next readahead_size bytes are decompressed on a background thread.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, pathlib.Path],
+        index: Optional[BlockIndex] = None,
+        cache_size: int = CACHE_SIZE,
+        readahead_size: int = READAHEAD_SIZE,
+    ):
+        super().__init__()
+        self.path = path
+        self.index = load_or_build_block_index(path) if index is None else index
+        self.cache_size = max(cache_size, 2 * readahead_size)
+        self.readahead_size = readahead_size
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._cache: "OrderedDict[int, Future]" = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._last_block = -1
+        self._position = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self) -> int:
+        return self.index.size
+
+    def _decompress(self, block: int) -> bytes:
+        record = self.index.blocks[block]
+        offset, file_size = int(record["file_offset"]), int(record["file_size"])
+        if self.index.format == "xz":
+            stream_offset = int(record["stream_offset"])
+            header = self._mmap[stream_offset : stream_offset + _XZ_HEADER_SIZE]
+            block_data = self._mmap[offset : offset + _padded(file_size)]
+            data = lzma.decompress(_xz_single_block_stream(header, block_data, file_size, int(record["size"])))
+        else:
+            data = _FRAME_DECOMPRESSORS[self.index.format]().decompress(self._mmap[offset : offset + file_size])
+        if len(data) != record["size"]:
+            raise ValueError(
+                f"Block {block} of {self.path} decompressed to {len(data)} instead of {record['size']} bytes."
+            )
+        return data
+
+    def _fill(self, future: Future, block: int):
+        # Blocks are decompressed by whoever claims their future first, the reader or the readahead thread.
+        with self._lock:
+            if future.running() or future.done():
+                return
+            future.set_running_or_notify_cancel()
+        try:
+            future.set_result(self._decompress(block))
+        except BaseException as e:
+            with self._lock:
+                if self._cache.get(block) is future:
+                    self._cached_bytes -= int(self.index.blocks["size"][block])
+                    del self._cache[block]
+            future.set_exception(e)
+
+    def _insert(self, block: int) -> Future:
+        # Caller holds the lock. The least recently used blocks are evicted, blocks in flight complete anyway.
+        future = self._cache[block] = Future()
+        self._cached_bytes += int(self.index.blocks["size"][block])
+        while self._cached_bytes > self.cache_size and len(self._cache) > 1:
+            evicted, _ = self._cache.popitem(last=False)
+            self._cached_bytes -= int(self.index.blocks["size"][evicted])
+        return future
+
+    def _readahead(self, block: int):
+        # Caller holds the lock.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="readahead")
+        end = int(self.index.starts[block]) + self.readahead_size
+        for ahead in range(block + 1, int(np.searchsorted(self.index.starts, end))):
+            if ahead not in self._cache:
+                self._executor.submit(self._fill, self._insert(ahead), ahead)
+
+    def block(self, block: int) -> bytes:
+        """
+        Get the decompressed data of a block, through the LRU.
+        """
+        with self._lock:
+            future = self._cache.get(block)
+            if future is not None:
+                self.hits += 1
+                self._cache.move_to_end(block)
+            else:
+                self.misses += 1
+                future = self._insert(block)
+            if block == self._last_block + 1:
+                self._readahead(block)
+            self._last_block = block
+        self._fill(future, block)
+        return future.result()
+
+    def _blocks_of(self, offset: int, length: int) -> range:
+        first = int(np.searchsorted(self.index.starts, offset, side="right")) - 1
+        last = int(np.searchsorted(self.index.starts, offset + length, side="left"))
+        return range(max(first, 0), min(last, len(self.index.blocks)))
+
+    def pread(self, offset: int, length: int) -> bytes:
+        """
+        Read up to length bytes at offset of the decompressed content.
+        """
+        parts = []
+        for block in self._blocks_of(offset, length):
+            start = int(self.index.starts[block])
+            data = self.block(block)
+            parts.append(data[max(offset - start, 0) : max(offset + length - start, 0)])
+        return b"".join(parts)
+
+    def gather(self, offsets: np.ndarray, item_size: int) -> np.ndarray:
+        """
+        Read items of item_size bytes at arbitrary offsets of the decompressed content.
+        Every block is decompressed (or taken from the LRU) once. Bytes past the end read as zeros.
+        :return: uint8 array of shape (len(offsets), item_size)
+        """
+        offsets = np.asarray(offsets, dtype=np.uint64)
+        result = np.zeros((len(offsets), item_size), dtype=np.uint8)
+        if not len(offsets) or not len(self.index.blocks):
+            return result
+        blocks = np.maximum(np.searchsorted(self.index.starts, offsets, side="right") - 1, 0)
+        within = (offsets >= self.index.starts[blocks]) & (offsets + np.uint64(item_size) <= self.index.ends[blocks])
+        rows = np.flatnonzero(within)
+        rows = rows[np.argsort(blocks[rows], kind="stable")]
+        group_blocks, group_starts = np.unique(blocks[rows], return_index=True)
+        for block, block_rows in zip(group_blocks.tolist(), np.split(rows, group_starts[1:])):
+            windows = np.lib.stride_tricks.sliding_window_view(np.frombuffer(self.block(block), np.uint8), item_size)
+            result[block_rows] = windows[(offsets[block_rows] - self.index.starts[block]).astype(np.int64)]
+        # Items spanning blocks
+        for row in np.flatnonzero(~within).tolist():
+            data = self.pread(int(offsets[row]), item_size)
+            result[row, : len(data)] = np.frombuffer(data, np.uint8)
+        return result
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with memoryview(buffer) as view:
+            data = self.pread(self._position, len(view))
+            view[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: self.size}[whence]
+        self._position = base + offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if not self.closed:
+            self._mmap.close()
+        super().close()
+
+
+def compress(
+    in_path: Union[str, pathlib.Path], out_path: Union[str, pathlib.Path], fmt: str, block_size: int, level: int
+):
+    """
+    Compress a snapshot in independent blocks of block_size bytes (gzip members, xz streams or zstd frames), so it
+    can be read with CompressedFile. The block index is saved next to the result.
+    """
+    compressors = {
+        "gzip": lambda data: _gzip_compress(data, level),
+        "xz": lambda data: lzma.compress(data, preset=level),
+        "zstd": lambda data: _zstd_compress(data, level),
+    }
+    in_size = os.path.getsize(in_path)
+    with open(in_path, "rb") as f_in, open(out_path, "wb") as f_out:
+        done = 0
+        while data := f_in.read(block_size):
+            f_out.write(compressors[fmt](data))
+            done += len(data)
+            instrumentation.progress(done / max(in_size, 1))
+    BlockIndex.build(out_path).save(BlockIndex.sidecar_path(out_path))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from paging_detection.out_of_core import parse_size
+
+    parser = argparse.ArgumentParser(description="Compress a snapshot in blocks, or build the block index of one.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compress_parser = subparsers.add_parser("compress", help="Compress a snapshot in independent blocks.")
+    compress_parser.add_argument("in_file", type=pathlib.Path)
+    compress_parser.add_argument("--format", choices=list(_MAGICS), default="gzip")
+    compress_parser.add_argument(
+        "--block-size", help="Size of the blocks (e.g. 1M). (Default: 1M)", type=parse_size, default=DEFAULT_BLOCK_SIZE
+    )
+    compress_parser.add_argument("--level", help="Compression level. (Default: 6)", type=int, default=6)
+    index_parser = subparsers.add_parser("index", help=f"Build the block index (<snapshot>{BLOCK_INDEX_SUFFIX}).")
+    index_parser.add_argument("in_file", type=pathlib.Path)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+
+    if args.command == "compress":
+        out_path = args.in_file.with_name(args.in_file.name + SUFFIXES[args.format])
+        instrumentation.log(f"Compressing {args.in_file} to {out_path}")
+        compress(args.in_file, out_path, args.format, args.block_size, args.level)
+    else:
+        BlockIndex.build(args.in_file).save(BlockIndex.sidecar_path(args.in_file))
+    instrumentation.log("Done")
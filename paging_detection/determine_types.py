@@ -1,89 +1,179 @@
-import json
-from typing import Dict, Literal, Union
-
-import networkx as nx
-
-from paging_detection import PageTypes, PagingStructure, PAGE_TYPES_ORDERED
-from paging_detection.mmaped import SnapshotPagingData, MemMappedSnapshot
-
-
-def get_max_path(graph: nx.MultiDiGraph, node, max_len: int, direction: Union[Literal["in"], Literal["out"]]) -> int:
+from typing import Dict, Literal, Tuple, Union
+
+import numpy as np
+
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGE_TYPES_ORDERED,
+    entries_present,
+    entries_valid,
+    entries_target_is_data,
+)
+from paging_detection import instrumentation
+from paging_detection.mmaped import (
+    DESIGNATIONS_SUFFIX,
+    MemMappedSnapshot,
+    load_snapshot,
+    resolve_pages_path,
+    save_snapshot,
+)
+from paging_detection.page_graph import PageGraph, GRAPH_SUFFIX, load_graph, resolve_graph_path, save_graph
+
+
+def bounded_path_lengths(graph: PageGraph, max_len: int, direction: Union[Literal["in"], Literal["out"]]) -> np.ndarray:
     """
-    Given a graph and one of its nodes, calculate the maximum length of any out / inbound paths, up to max_len.
+    For every node in a graph, calculate the maximum length of any in / outbound paths, up to max_len.
     If there is an in / outbound cycle shorter than max_len the result will be max_len.
+    All nodes are handled at once: A node has an inbound path of length k, iff one of its predecessors has one of length
+    k - 1. Starting with k = 1, every level is propagated along all edges, so this takes O(max_len * edges).
     :param graph: The graph.
-    :param node: Id of start node in the graph.
     :param max_len: Maximum length to consider.
     :param direction: Whether to look at inbound or outbound paths.
-    :return: The maximum path length considered.
+    :return: The maximum path length considered for every node. (Indexed like graph.nodes)
+    """
+    sources, targets = (graph.sources, graph.targets) if direction == "in" else (graph.targets, graph.sources)
+    lengths = graph.allocate(graph.number_of_nodes(), np.uint8)
+    has_path = graph.allocate(graph.number_of_nodes(), bool)
+    has_path[:] = True  # Every node has a path of length 0
+    for _ in range(max_len):
+        next_has_path = graph.allocate(graph.number_of_nodes(), bool)
+        for edges in graph.edge_chunks():
+            next_has_path[targets[edges][has_path[sources[edges]]]] = True
+        if not next_has_path.any():
+            break
+        lengths += next_has_path
+        has_path = next_has_path
+    return lengths
+
+
+def get_entry_flags(
+    snapshot: MemMappedSnapshot, addrs: np.ndarray, chunk_pages: int = CHUNK_PAGES
+) -> Dict[str, Dict[PageTypes, np.ndarray]]:
+    """
+    For every page, determine whether it has any present entry that is valid / points to data under a page type.
+    :param chunk_pages: Number of pages whose entries are inspected at once.
+    :return: Dict with the keys "valid" and "data", each mapping page types to a bool array indexed like addrs.
+    """
+    flags = {
+        "valid": {t: np.zeros(len(addrs), dtype=bool) for t in PAGE_TYPES_ORDERED[:-1]},
+        "data": {t: np.zeros(len(addrs), dtype=bool) for t in (PageTypes.PDP, PageTypes.PD)},
+    }
+    for start in range(0, len(addrs), chunk_pages):
+        entries = snapshot.gather_pages(addrs[start : start + chunk_pages])
+        present = entries_present(entries)
+        for page_type, has_valid in flags["valid"].items():
+            has_valid[start : start + chunk_pages] = (present & entries_valid(entries, page_type)).any(axis=1)
+        for page_type, has_data in flags["data"].items():
+            has_data[start : start + chunk_pages] = (present & entries_target_is_data(entries, page_type)).any(axis=1)
+    return flags
+
+
+# (page type, successor type): A page can only have the type, if one of its successors has an entry pointing to data
+# under the successor type. (Only checked for pages without longer outbound paths, see possible_types.)
+SUCCESSOR_DATA_TYPES = ((PageTypes.PML4, PageTypes.PDP), (PageTypes.PDP, PageTypes.PD))
+
+
+def possible_types(
+    max_inbound: np.ndarray,
+    max_outbound: np.ndarray,
+    flags: Dict[str, Dict[PageTypes, np.ndarray]],
+    suc_has_data: Dict[PageTypes, np.ndarray],
+) -> Tuple[Dict[PageTypes, np.ndarray], int]:
     """
-    path_len = 0
-    next_nodes = {node}
-    next_func = graph.successors if direction == "out" else graph.predecessors
+    Apply the rules of determine_possible_types to a set of pages. All arrays are indexed alike, e.g. like graph.nodes.
+    :param max_inbound: Maximum inbound path lengths of the pages, see bounded_path_lengths.
+    :param max_outbound: Maximum outbound path lengths of the pages.
+    :param flags: Entry flags of the pages, see get_entry_flags.
+    :param suc_has_data: Maps the page types in SUCCESSOR_DATA_TYPES to bool arrays, indicating whether any successor
+    of a page has an entry pointing to data under the respective successor type.
+    :return: Dict mapping page types to bool arrays of possible types and the number of avoided designations.
+    """
+    # No dangling paging structures
+    possible = {t: max_inbound >= level for level, t in enumerate(PAGE_TYPES_ORDERED)}
+
+    def discard(page_type: PageTypes, mask: np.ndarray) -> int:
+        discarded = possible[page_type] & mask
+        possible[page_type] &= ~mask
+        return int(np.count_nonzero(discarded))
+
+    designations_avoided = 0
+    # Can only be a data page
+    for page_type in PageTypes:
+        designations_avoided += discard(page_type, max_outbound == 0)
 
-    # TODO: Can abort sooner when there is any cycle with len < max_len
-    # Since I currently use this with max_len == 3, it doesn't matter much.
-    while (next_nodes := {suc for node in next_nodes for suc in next_func(node)}) and path_len < max_len:
-        path_len += 1
+    # PML4s never directly point to data pages
+    discard(PageTypes.PML4, max_outbound == 1)
+    # PDP and PD can point to large pages, but there needs to be at least one qualifying entry
+    for page_type in (PageTypes.PDP, PageTypes.PD):
+        designations_avoided += discard(page_type, (max_outbound == 1) & ~flags["data"][page_type])
 
-    return path_len
+    # If none of the successors qualifies as a PDP pointing to a data page, the current page can't be a PML4
+    # If none of the successors qualifies as a PD pointing to a data page, the current page can't be a PDP
+    for page_type, _ in SUCCESSOR_DATA_TYPES:
+        designations_avoided += discard(page_type, (max_outbound == 2) & ~suc_has_data[page_type])
 
+    # At least one valid entry under any assigned page_type
+    for page_type in PAGE_TYPES_ORDERED[:-1]:  # PT entries are always valid
+        designations_avoided += discard(page_type, ~flags["valid"][page_type])
 
-def determine_possible_types(graph: nx.MultiDiGraph, pages: Dict[int, PagingStructure]) -> nx.MultiDiGraph:
+    return possible, designations_avoided
+
+
+@instrumentation.span("determine_types")
+def determine_possible_types(graph: PageGraph, snapshot: MemMappedSnapshot) -> PageGraph:
     """
     From the topology of a "page graph", infer the possible page_types for every page (node).
     Assumptions:
         - Only PML4s can have no inbound edges. (Higher level structures must exist in any hierarchy)
         - At least one valid entry under any assigned page_type
         - At least one entry all the way to a data page
+    All checks are done for all nodes at once (in chunks of nodes and edges), so this scales with the number of edges.
     :param graph: Graph representing the pages.
-    :param pages: Dict mapping physical address to a paging structure.
-    :return: Graph with possible types of any page stored in its node data. (node[page_type] -> bool)
+    :param snapshot: The snapshot containing the pages.
+    :return: Graph with possible types of any page stored in its node data. (node_data[str(page_type)] -> bool)
     """
 
     # graph = graph.copy() # Without this I am technically speaking mutating args, but the copy is costly.
 
+    max_inbound = bounded_path_lengths(graph, max_len=len(PageTypes) - 1, direction="in")
+    max_outbound = bounded_path_lengths(graph, max_len=len(PageTypes) - 1, direction="out")
+    num_nodes = graph.number_of_nodes()
+    flags = {
+        "valid": {t: graph.allocate(num_nodes, bool) for t in PAGE_TYPES_ORDERED[:-1]},
+        "data": {t: graph.allocate(num_nodes, bool) for t in (PageTypes.PDP, PageTypes.PD)},
+    }
+    for nodes in graph.node_chunks():
+        for flag, by_type in get_entry_flags(snapshot, graph.nodes[nodes], graph.chunk_sizes.pages).items():
+            for page_type, values in by_type.items():
+                flags[flag][page_type][nodes] = values
+
+    suc_has_data = {}
+    for page_type, suc_type in SUCCESSOR_DATA_TYPES:
+        suc_has_data[page_type] = graph.allocate(num_nodes, bool)
+        for edges in graph.edge_chunks():
+            suc_has_data[page_type][graph.sources[edges][flags["data"][suc_type][graph.targets[edges]]]] = True
+
+    # The rules only look at the pages themselves, so they can be applied to chunks of pages.
+    possible = {t: graph.allocate(num_nodes, bool) for t in PageTypes}
     designations_avoided = 0
-    for node in graph.nodes:
-        page = pages[int(node)]
-        # No dangling paging structures
-        max_inbound = get_max_path(graph, node, max_len=len(PageTypes) - 1, direction="in")
-        poss_types = set(PAGE_TYPES_ORDERED[: max_inbound + 1])
-
-        max_outbound = get_max_path(graph, node, max_len=len(PageTypes) - 1, direction="out")
-
-        if max_outbound == 0:  # Can only be a data page
-            designations_avoided += len(poss_types)
-            poss_types = set()
-        elif max_outbound == 1:
-            poss_types.discard(PageTypes.PML4)  # PML4s never directly point to data pages
-            # PDP and PD can point to large pages, but there needs to be at least one qualifying entry
-            for page_type in poss_types & {PageTypes.PDP, PageTypes.PD}:
-                if not any(entry.target_is_data(page_type) for entry in page.entries.values()):
-                    poss_types.discard(page_type)
-                    designations_avoided += 1
-        elif max_outbound == 2:
-            suc_entries = [entry for suc in graph.successors(node) for entry in pages[int(suc)].entries.values()]
-            # If none of the successors qualifies as a PDP pointing to a data page, the current page can't be a PML4
-            if PageTypes.PML4 in poss_types and not any(entry.target_is_data(PageTypes.PDP) for entry in suc_entries):
-                poss_types.discard(PageTypes.PML4)
-                designations_avoided += 1
-            # If none of the successors qualifies as a PD pointing to a data page, the current page can't be a PDP
-            if PageTypes.PDP in poss_types and not any(entry.target_is_data(PageTypes.PD) for entry in suc_entries):
-                poss_types.discard(PageTypes.PDP)
-                designations_avoided += 1
-
-        # At least one valid entry under any assigned page_type
-        for page_type in poss_types & set(PAGE_TYPES_ORDERED[:-1]):  # PT entries are always valid
-            if not any(entry.is_valid(page_type) for entry in page.entries.values()):
-                poss_types.remove(page_type)
-                designations_avoided += 1
-
-        for t in PageTypes:
-            graph.nodes[node][t] = t in poss_types
+    for nodes in graph.node_chunks():
+        chunk_flags = {flag: {t: values[nodes] for t, values in by_type.items()} for flag, by_type in flags.items()}
+        chunk_suc_has_data = {t: values[nodes] for t, values in suc_has_data.items()}
+        chunk_possible, avoided = possible_types(
+            max_inbound[nodes], max_outbound[nodes], chunk_flags, chunk_suc_has_data
+        )
+        for page_type, has_type in chunk_possible.items():
+            possible[page_type][nodes] = has_type
+        designations_avoided += avoided
+    for t in PageTypes:
+        graph.node_data[str(t)] = possible[t]
 
     avoided_perc = designations_avoided / (graph.number_of_nodes() * len(PageTypes))
-    print(f"Avoided {designations_avoided} designations. ({avoided_perc:%})")
+    instrumentation.count("pages", graph.number_of_nodes())
+    instrumentation.count("edges", graph.number_of_edges())
+    instrumentation.count("designations_avoided", designations_avoided)
+    instrumentation.log(f"Avoided {designations_avoided} designations. ({avoided_perc:%})")
     return graph
 
 
@@ -94,39 +184,43 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "in_files",
-        help="Path to graphml file or the json with all pages in the snapshot. Other will be inferred.",
+        help="Path to the graph (.pgraph or .graphml) or the designations (.desig or .json) of all pages in the "
+        "snapshot. Other will be inferred.",
         type=pathlib.Path,
     )
+    parser.add_argument("--json", help="Additionally export the designations as JSON.", action="store_true")
+    parser.add_argument("--graphml", help="Additionally export the graph as graphml.", action="store_true")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.configure(args)
     input_path = args.in_files
-    if input_path.suffix not in {".json", ".graphml", ""}:
-        raise ValueError("Invalid extension for input files path. Must be either .json, .graphml or no extension.")
-    in_pages_path = input_path.with_suffix(".json")
-    in_graph_path = input_path.with_suffix(".graphml")
-    out_pages_path = input_path.with_stem(input_path.stem + "_with_types").with_suffix(".json")
-    out_graph_path = out_pages_path.with_suffix(".graphml")
-
-    print(f"Loading graph: {in_graph_path}")
-    graph: nx.DiGraph = nx.read_graphml(in_graph_path, force_multigraph=True)
+    if input_path.suffix not in {".json", ".graphml", DESIGNATIONS_SUFFIX, GRAPH_SUFFIX, ""}:
+        raise ValueError(
+            f"Invalid extension for input files path. "
+            f"Must be either .json, {DESIGNATIONS_SUFFIX}, .graphml, {GRAPH_SUFFIX} or none."
+        )
+    in_pages_path = resolve_pages_path(input_path)
+    in_graph_path = resolve_graph_path(input_path)
+    out_pages_path = input_path.with_stem(input_path.stem + "_with_types").with_suffix(DESIGNATIONS_SUFFIX)
+    out_graph_path = out_pages_path.with_suffix(GRAPH_SUFFIX)
 
-    print(f"Loading pages: {in_pages_path}")
-    with open(in_pages_path) as f:
-        snapshot = MemMappedSnapshot(SnapshotPagingData.validate(json.load(f)))
+    instrumentation.log(f"Loading graph: {in_graph_path}")
+    graph = load_graph(in_graph_path)
 
-    pages = snapshot.pages
+    instrumentation.log(f"Loading pages: {in_pages_path}")
+    snapshot = load_snapshot(in_pages_path)
 
-    print("Determining possible types for all pages.")
-    graph_with_types = determine_possible_types(graph, pages)
+    instrumentation.log("Determining possible types for all pages.")
+    graph_with_types = determine_possible_types(graph, snapshot)
 
-    print(f"Saving graph: {out_graph_path}")
-    nx.readwrite.write_graphml(graph_with_types, out_graph_path)
+    instrumentation.log(f"Saving graph: {out_graph_path}")
+    save_graph(graph_with_types, out_graph_path, export_graphml=args.graphml)
 
-    print("Transferring designations to snapshot data")
-    for offset, node in graph_with_types.nodes.items():
-        pages[int(offset)].designations = {t for t in PageTypes if node[t]}
+    instrumentation.log("Transferring designations to snapshot data")
+    designations = {t: graph_with_types.node_data[str(t)] for t in PageTypes}
+    snapshot.designations.set_designations(graph_with_types.nodes, designations)
 
-    print(f"Saving pages: {out_pages_path}")
-    with open(out_pages_path, "w") as f:
-        f.write(snapshot.json())
+    instrumentation.log(f"Saving pages: {out_pages_path}")
+    save_snapshot(snapshot, out_pages_path, export_json=args.json)
 
-print("Done")
+    instrumentation.log("Done")
@@ -0,0 +1,146 @@
+"""
+Sorting more (key, value) pairs than fit into memory, see ExternalSorter.
+"""
+import io
+import os
+import pathlib
+import tempfile
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+# Number of sorted runs merged at once
+MERGE_FAN_IN = 64
+
+# Header size of the .npy files written by NpyWriter. numpy pads the headers of 1-d arrays to 128 bytes.
+_NPY_HEADER_SIZE = 128
+
+
+class NpyWriter:
+    """
+    Writes a 1-d .npy file by appending arrays to it, its length is only known when it is closed.
+    """
+
+    def __init__(self, path: pathlib.Path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._file = open(path, "wb")
+        self._file.seek(_NPY_HEADER_SIZE)
+
+    def append(self, values: np.ndarray):
+        np.asarray(values, dtype=self.dtype).tofile(self._file)
+        self.length += len(values)
+
+    def close(self):
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            header,
+            {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.length,)},
+        )
+        if len(header.getvalue()) != _NPY_HEADER_SIZE:
+            raise ValueError(f"Unexpected .npy header size {len(header.getvalue())} for {self.path}.")
+        self._file.seek(0)
+        self._file.write(header.getvalue())
+        self._file.close()
+
+
+class ExternalSorter:
+    """
+    Sorts (key, value) pairs by key and value with bounded memory. Added pairs are collected into runs of run_size
+    pairs, which are sorted and written to the workspace. Sorting merges MERGE_FAN_IN runs at a time, until the
+    remaining runs can be merged at once. (With increasing values, e.g. edge ids, this is a stable sort by key.)
+    """
+
+    def __init__(self, workspace: pathlib.Path, key_dtype, value_dtype, run_size: int):
+        self.workspace = workspace
+        self.key_dtype = np.dtype(key_dtype)
+        self.value_dtype = np.dtype(value_dtype)
+        self.run_size = run_size
+        self._runs: List[Tuple[pathlib.Path, pathlib.Path]] = []
+        self._buffer: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._buffered = 0
+
+    def add(self, keys: np.ndarray, values: np.ndarray):
+        self._buffer.append((np.asarray(keys, dtype=self.key_dtype), np.asarray(values, dtype=self.value_dtype)))
+        self._buffered += len(keys)
+        if self._buffered >= self.run_size:
+            self._flush()
+
+    def _new_run(self) -> Tuple[NpyWriter, NpyWriter]:
+        paths = []
+        for _ in range(2):
+            fd, name = tempfile.mkstemp(suffix=".npy", dir=self.workspace)
+            os.close(fd)
+            paths.append(pathlib.Path(name))
+        self._runs.append((paths[0], paths[1]))
+        return NpyWriter(paths[0], self.key_dtype), NpyWriter(paths[1], self.value_dtype)
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        keys = np.concatenate([keys for keys, _ in self._buffer])
+        values = np.concatenate([values for _, values in self._buffer])
+        self._buffer, self._buffered = [], 0
+        order = np.lexsort((values, keys))
+        key_writer, value_writer = self._new_run()
+        key_writer.append(keys[order])
+        value_writer.append(values[order])
+        key_writer.close()
+        value_writer.close()
+
+    def _merge(self, runs: List[Tuple[pathlib.Path, pathlib.Path]]) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Merge sorted runs, yielding the merged pairs in blocks. At most block_size pairs of every run are read at once.
+        """
+        arrays = [(np.load(keys, mmap_mode="r"), np.load(values, mmap_mode="r")) for keys, values in runs]
+        block_size = max(self.run_size // len(runs), 1)
+        positions = [0] * len(runs)
+        while True:
+            heads = [
+                (i, keys[pos : pos + block_size], values[pos : pos + block_size])
+                for i, ((keys, values), pos) in enumerate(zip(arrays, positions))
+                if pos < len(keys)
+            ]
+            if not heads:
+                return
+            # Everything up to the smallest last pair of the heads can be merged, the run it belongs to is used up.
+            bound_key, bound_value = min((head_keys[-1], head_values[-1]) for _, head_keys, head_values in heads)
+            merged_keys, merged_values = [], []
+            for i, head_keys, head_values in heads:
+                low = int(np.searchsorted(head_keys, bound_key, side="left"))
+                high = int(np.searchsorted(head_keys, bound_key, side="right"))
+                count = low + int(np.searchsorted(head_values[low:high], bound_value, side="right"))
+                merged_keys.append(head_keys[:count])
+                merged_values.append(head_values[:count])
+                positions[i] += count
+            keys, values = np.concatenate(merged_keys), np.concatenate(merged_values)
+            order = np.lexsort((values, keys))
+            yield keys[order], values[order]
+
+    def _remove(self, runs: List[Tuple[pathlib.Path, pathlib.Path]]):
+        for keys, values in runs:
+            keys.unlink()
+            values.unlink()
+
+    def sorted(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Sort all added pairs. The sorter is empty afterwards.
+        :return: Iterator over blocks of sorted keys and the corresponding values.
+        """
+        self._flush()
+        while len(self._runs) > MERGE_FAN_IN:
+            runs, self._runs = self._runs, []
+            for start in range(0, len(runs), MERGE_FAN_IN):
+                group = runs[start : start + MERGE_FAN_IN]
+                key_writer, value_writer = self._new_run()
+                for keys, values in self._merge(group):
+                    key_writer.append(keys)
+                    value_writer.append(values)
+                key_writer.close()
+                value_writer.close()
+                self._remove(group)
+        runs, self._runs = self._runs, []
+        if runs:
+            yield from self._merge(runs)
+            self._remove(runs)
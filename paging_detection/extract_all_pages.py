@@ -1,32 +1,201 @@
-from typing import Dict
-
-import networkx as nx
-
-from paging_detection import PagingStructure, max_page_addr, PageTypes, PAGING_STRUCTURE_SIZE
-from paging_detection.mmaped import SnapshotPagingData, MemMappedSnapshot
-
-
-def build_nx_graph(pages: Dict[int, PagingStructure], max_paddr: int) -> nx.MultiDiGraph:
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, Tuple, Optional
+
+import numpy as np
+
+from paging_detection import (
+    CHUNK_PAGES,
+    max_page_addr,
+    PageTypes,
+    PAGING_STRUCTURE_SIZE,
+    ENTRIES_PER_PAGE,
+    PAGING_ENTRY_SIZE,
+    entries_present,
+    entries_target,
+    entries_valid,
+    entries_target_is_data,
+)
+from paging_detection import instrumentation
+from paging_detection.compressed import snapshot_stem
+from paging_detection.mmaped import (
+    SnapshotPagingData,
+    MemMappedSnapshot,
+    DesignationStore,
+    DESIGNATIONS_SUFFIX,
+    save_snapshot,
+)
+from paging_detection.page_graph import ChunkSizes, PageGraph, index_dtype, GRAPH_SUFFIX, save_graph
+from paging_detection.physical import physical_size
+from paging_detection.page_index import INDEX_SUFFIX, load_or_build_index, PageIndex
+
+# Count of invalid / oob entries per page
+COUNT_TYPE = np.min_scalar_type(ENTRIES_PER_PAGE)
+
+
+def scan_pages(
+    snapshot: MemMappedSnapshot, start: int, stop: int, max_paddr: int, rows: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
     """
-    Build a networkx graph representing pages and their (hypothetical) paging entries in a snapshot.
-    :param pages: Dict mapping physical address to pages
-    :return: The resulting graph
+    Collect the edges and the invalid / oob entry counts for all pages with physical addresses in [start, stop).
+    :param snapshot: The snapshot.
+    :param start: Physical address of the first page.
+    :param stop: Physical address after the last page.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param rows: Positions (relative to start) of the pages to read. The other pages are not touched and treated as
+    having no present entries. Defaults to all pages.
+    :return: Source page addresses, target page addresses and entry offsets of all edges as well as a dict mapping
+    "invalid_<type>" and "oob_<type>" to the respective counts for every page.
     """
-    graph = nx.MultiDiGraph()
-    # Allows nx to avoid mem reallocation for the nodes.
-    # Adds "disconnected" pages to avoid key errors.
-    graph.add_nodes_from(pages.keys())
-
-    print("Building nx graph.")
-    last_prog = 0
-    for page_offset, page in pages.items():
-        if ((prog := int(100 * page_offset / snap_size)) != last_prog) and (prog % 5) == 0:
-            last_prog = prog
-            print(f"{prog} % done.")
-        for entry_offset, entry in page.entries.items():
-            if entry.target <= max_paddr:
-                graph.add_edge(page_offset, entry.target, offset=entry_offset)
-
+    num_pages = (stop - start) // PAGING_STRUCTURE_SIZE
+    entries = snapshot.page_entries(start, stop)
+    if rows is None:
+        rows = np.arange(num_pages)
+    else:
+        entries = entries[rows]
+    present = entries_present(entries)
+    targets = entries_target(entries)
+
+    edges = present & (targets <= max_paddr) & snapshot.in_bounds(targets)
+    pages, slots = np.nonzero(edges)
+    sources = start + rows[pages].astype(np.uint64) * PAGING_STRUCTURE_SIZE
+
+    out_of_bounds = present & ~edges
+    counts = {}
+    for page_type in PageTypes:
+        # Invalid entries violate constraints.
+        # E.g. a PD entry with bit7 set pointing to an address which is not 2mb aligned.
+        invalid = present & ~entries_valid(entries, page_type)
+        counts[f"invalid_{page_type}"] = np.zeros(num_pages, dtype=COUNT_TYPE)
+        counts[f"invalid_{page_type}"][rows] = invalid.sum(axis=1, dtype=COUNT_TYPE)
+        # oob entries point to a paging structure outside of the memories bounds.
+        # Note that a entries pointing to a data page (bit7 set or PT entry) are never "out of bounds"
+        oob = out_of_bounds & ~entries_target_is_data(entries, page_type)
+        counts[f"oob_{page_type}"] = np.zeros(num_pages, dtype=COUNT_TYPE)
+        counts[f"oob_{page_type}"][rows] = oob.sum(axis=1, dtype=COUNT_TYPE)
+
+    return sources, targets[edges], (slots * PAGING_ENTRY_SIZE).astype(np.uint16), counts
+
+
+# Snapshot of the dump in a worker process of a parallel scan.
+_worker_snapshot: Optional[MemMappedSnapshot] = None
+
+
+def _init_scan_worker(path: str):
+    global _worker_snapshot
+    _worker_snapshot = MemMappedSnapshot(SnapshotPagingData(path=path, designations={}))
+
+
+def _scan_chunk(
+    chunk: Tuple[int, int, int, Optional[np.ndarray]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    return scan_pages(_worker_snapshot, *chunk)
+
+
+def _index_rows(
+    chunk: Tuple[int, int, int, None], may_be_paging_structure: np.ndarray
+) -> Tuple[int, int, int, Optional[np.ndarray]]:
+    """
+    Restrict a chunk to the pages which may be paging structures according to the index.
+    :param may_be_paging_structure: PageIndex.may_be_paging_structure of the index, for all pages.
+    """
+    start, stop, max_paddr, _ = chunk
+    candidates = may_be_paging_structure[start // PAGING_STRUCTURE_SIZE : stop // PAGING_STRUCTURE_SIZE]
+    if candidates.all():
+        return chunk
+    return start, stop, max_paddr, np.flatnonzero(candidates)
+
+
+def scan_chunks(
+    snapshot: MemMappedSnapshot,
+    max_paddr: int,
+    jobs: int = 1,
+    index: Optional[PageIndex] = None,
+    chunk_pages: int = CHUNK_PAGES,
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray, np.ndarray, Dict[str, np.ndarray]]]:
+    """
+    Scan the snapshot chunk by chunk (see scan_pages), counting the scanned pages, entries and edges.
+    See build_page_graph for the other parameters.
+    :param chunk_pages: Number of pages per chunk.
+    :return: Iterator over the results of scan_pages for all chunks in order, each preceded by the page number of the
+    first page of the chunk.
+    """
+    end = max_paddr + PAGING_STRUCTURE_SIZE
+    chunk_size = chunk_pages * PAGING_STRUCTURE_SIZE
+    chunks = [(start, min(start + chunk_size, end), max_paddr, None) for start in range(0, end, chunk_size)]
+    if index is not None:
+        may_be_paging_structure = index.may_be_paging_structure()
+        chunks = [_index_rows(chunk, may_be_paging_structure) for chunk in chunks]
+        chunks = [chunk for chunk in chunks if chunk[3] is None or len(chunk[3])]
+        skipped = int(np.count_nonzero(~may_be_paging_structure))
+        instrumentation.count("pages_skipped", skipped)
+        instrumentation.log(f"Page index: Skipping {skipped} pages.")
+
+    instrumentation.log(f"Building page graph using {jobs} process(es).")
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_scan_worker, initargs=(snapshot.path,))
+    # The workers are shut down even if scanning fails or the iterator is not consumed completely.
+    try:
+        if executor is not None:
+            results = executor.map(_scan_chunk, chunks)
+        else:
+            results = (scan_pages(snapshot, *chunk) for chunk in chunks)
+
+        for chunk, (chunk_sources, chunk_targets, chunk_offsets, counts) in zip(chunks, results):
+            chunk_start, chunk_stop, _, rows = chunk
+            instrumentation.progress(chunk_start / end)
+            scanned = (chunk_stop - chunk_start) // PAGING_STRUCTURE_SIZE if rows is None else len(rows)
+            instrumentation.count("pages", scanned)
+            instrumentation.count("entries", scanned * ENTRIES_PER_PAGE)
+            instrumentation.count("edges", len(chunk_sources))
+            yield chunk_start // PAGING_STRUCTURE_SIZE, chunk_sources, chunk_targets, chunk_offsets, counts
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+@instrumentation.span("extract_all_pages")
+def build_page_graph(
+    snapshot: MemMappedSnapshot,
+    max_paddr: int,
+    jobs: int = 1,
+    index: Optional[PageIndex] = None,
+    chunk_sizes: ChunkSizes = ChunkSizes(),
+) -> PageGraph:
+    """
+    Build a graph representing pages and their (hypothetical) paging entries in a snapshot.
+    Every page becomes a node, every present entry pointing to a page within the snapshot becomes an edge.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param jobs: Number of processes scanning the snapshot. Every process maps the snapshot file itself and scans a
+    share of the chunks, the results are merged in order.
+    :param index: Page index of the snapshot. If given, pages without present entries are not read, chunks without
+    any present entries are skipped entirely.
+    :param chunk_sizes: Chunk sizes of the streaming passes, chunk_sizes.pages is used for scanning the snapshot. The
+    graph keeps them for the later stages.
+    :return: The resulting graph with "invalid_<type>" and "oob_<type>" counts in its node data.
+    """
+    nodes = np.arange(0, max_paddr + PAGING_STRUCTURE_SIZE, PAGING_STRUCTURE_SIZE, dtype=np.uint64)
+    node_data = {}
+    for page_type in PageTypes:
+        node_data[f"invalid_{page_type}"] = np.zeros(len(nodes), dtype=COUNT_TYPE)
+        node_data[f"oob_{page_type}"] = np.zeros(len(nodes), dtype=COUNT_TYPE)
+
+    sources, targets, offsets = [], [], []
+    scanned = scan_chunks(snapshot, max_paddr, jobs, index, chunk_sizes.pages)
+    for first, chunk_sources, chunk_targets, chunk_offsets, counts in scanned:
+        sources.append(chunk_sources)
+        targets.append(chunk_targets)
+        offsets.append(chunk_offsets)
+        for key, count in counts.items():
+            node_data[key][first : first + len(count)] = count
+
+    # Nodes are all pages in order, so a nodes index is its address divided by the page size.
+    idx_type = index_dtype(len(nodes))
+    sources = (np.concatenate(sources) // PAGING_STRUCTURE_SIZE).astype(idx_type)
+    targets = (np.concatenate(targets) // PAGING_STRUCTURE_SIZE).astype(idx_type)
+    graph = PageGraph(nodes, sources, targets, np.concatenate(offsets), node_data)
+    graph.chunk_sizes = chunk_sizes
     return graph
 
 
@@ -37,55 +206,42 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "in_file",
-        help="Path to snapshot. Output files will have the same name with .json and .graphml as suffix.",
+        help="Path to snapshot. Output files will have the same name with _all_pages.[desig|pgraph] appended.",
         type=pathlib.Path,
     )
+    parser.add_argument(
+        "--jobs", help="Number of processes used to scan the snapshot. (Default: 1)", type=int, default=1
+    )
+    parser.add_argument(
+        "--index",
+        help=f"Use the page index (<snapshot>{INDEX_SUFFIX}) to skip pages without present entries. It is built and "
+        "saved next to the snapshot if it does not exist yet.",
+        action="store_true",
+    )
+    parser.add_argument("--json", help="Additionally export the designations as JSON.", action="store_true")
+    parser.add_argument("--graphml", help="Additionally export the graph as graphml.", action="store_true")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.configure(args)
     dump_path = args.in_file
-    if dump_path.suffix in {".json", ".graphml"}:
+    if dump_path.suffix in {".json", ".graphml", DESIGNATIONS_SUFFIX, GRAPH_SUFFIX}:
         raise ValueError(f"Snapshot has {dump_path.suffix} as extension and would be overwritten by outputs.")
-    out_pages_path = dump_path.with_stem(dump_path.stem + "_all_pages").with_suffix(".json")
-    out_graph_path = out_pages_path.with_suffix(".graphml")
+    out_pages_path = dump_path.with_name(snapshot_stem(dump_path) + "_all_pages" + DESIGNATIONS_SUFFIX)
+    out_graph_path = out_pages_path.with_suffix(GRAPH_SUFFIX)
 
-    snap_size = dump_path.stat().st_size
+    snap_size = physical_size(dump_path)
 
-    # snapshot.pages.items() only iterates over pages for which designations are stored.
-    dummy_desigs = {offset: set() for offset in range(0, snap_size, PAGING_STRUCTURE_SIZE)}
-    snapshot = MemMappedSnapshot(SnapshotPagingData(path=str(dump_path), designations=dummy_desigs))
+    # snapshot.pages.items() only iterates over pages in the store, so all pages are added (without designations).
+    snapshot = MemMappedSnapshot(DesignationStore.create(str(dump_path), snap_size, tracked=True))
 
-    pages = snapshot.pages
     max_paddr = max_page_addr(snap_size)
+    index = load_or_build_index(snapshot, max_paddr, jobs=args.jobs) if args.index else None
+    full_graph = build_page_graph(snapshot, max_paddr=max_paddr, jobs=args.jobs, index=index)
+
+    instrumentation.log(f"Saving graph: {out_graph_path}")
+    save_graph(full_graph, out_graph_path, export_graphml=args.graphml)
+
+    instrumentation.log(f"Saving pages: {out_pages_path}")
+    save_snapshot(snapshot, out_pages_path, export_json=args.json)
 
-    full_graph = build_nx_graph(pages, max_paddr=max_paddr)
-
-    last_prog = 0
-    print("Counting oob entries and invalid entries.")
-    for page_offset, page in pages.items():
-        if ((prog := int(100 * page_offset / snap_size)) != last_prog) and (prog % 5) == 0:
-            last_prog = prog
-            print(f"{prog} % done.")
-        node = full_graph.nodes[page_offset]
-
-        for page_type in PageTypes:
-            # oob entries point to a paging structure outside of the memories bounds.
-            # Note that a entries pointing to a data page (bit7 set or PT entry) are never "out of bounds"
-            node[f"invalid_{page_type}"] = 0
-            # Invalid entries violate constraints.
-            # E.g. a PD entry with bit7 set pointing to an address which is not 2mb aligned.
-            node[f"oob_{page_type}"] = 0
-
-        for entry in page.entries.values():
-            for page_type in PageTypes:
-                if not entry.is_valid(page_type):
-                    node[f"invalid_{page_type}"] += 1
-                if entry.target > max_paddr and not entry.target_is_data(page_type):
-                    node[f"oob_{page_type}"] += 1
-
-    print(f"Saving graph: {out_graph_path}")
-    nx.readwrite.write_graphml(full_graph, out_graph_path)
-
-    print(f"Saving pages: {out_pages_path}")
-    with open(out_pages_path, "w") as f:
-        f.write(snapshot.json())
-
-    print("Done")
+    instrumentation.log("Done")
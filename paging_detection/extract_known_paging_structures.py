@@ -1,116 +1,179 @@
-from collections import defaultdict, Counter
-from typing import Dict, List, DefaultDict, Tuple
+from collections import Counter
+from typing import List, Tuple
 
 import pandas as pd
 import networkx as nx
-
-from paging_detection import PagingStructure, PageTypes, PAGING_STRUCTURE_SIZE
-from paging_detection.mmaped import SnapshotPagingData, MemMappedSnapshot
+import numpy as np
+
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGE_TYPES_ORDERED,
+    PAGING_STRUCTURE_SIZE,
+    PAGING_ENTRY_SIZE,
+    entries_large_page,
+    entries_nx,
+    entries_present,
+    entries_target,
+    entries_target_is_data,
+    entries_user_access,
+    entries_valid,
+)
+from paging_detection import instrumentation
+from paging_detection.compressed import snapshot_stem
+from paging_detection.determine_types import bounded_path_lengths
+from paging_detection.mmaped import MemMappedSnapshot, DesignationStore, DESIGNATIONS_SUFFIX, save_snapshot
 from paging_detection.graphs import color_graph, add_task_info
+from paging_detection.page_graph import PageGraph, GRAPH_SUFFIX, save_graph
 
 
+def _next_level(snapshot: MemMappedSnapshot, tables: np.ndarray, page_type: PageTypes) -> np.ndarray:
+    """
+    Physical addresses of the tables the present entries of tables (of page_type) point to, without duplicates.
+    Large pages and targets outside of the snapshot are left out.
+    """
+    targets = []
+    for start in range(0, len(tables), CHUNK_PAGES):
+        entries = snapshot.gather_pages(tables[start : start + CHUNK_PAGES])
+        # PDEs and PDPEs can point to large pages, we do not want to confuse those for paging structures
+        entries = entries[entries_present(entries) & ~entries_target_is_data(entries, page_type)]
+        chunk_targets = entries_target(entries)
+        targets.append(chunk_targets[snapshot.in_bounds(chunk_targets)])
+        instrumentation.count("entries", len(entries))
+    return np.unique(np.concatenate(targets)) if targets else np.array([], dtype=np.uint64)
+
+
+@instrumentation.span("extract_known_paging_structures")
 def read_paging_structures(dump_path: str, pgds: List[int]) -> MemMappedSnapshot:
     """
-    Extract PagingStructure from memory. Consider every int in pgds to be an address of a PML4.
-    :param mem: Memory
-    :param pgds: List of physical pml4 addresses in mem
-    :return: Dict mapping page address to instance of PagingStructure describing the underlying page
+    Extract the paging structures from memory. Consider every int in pgds to be an address of a PML4.
+    The hierarchies of all PML4s are walked together, one level at a time: The tables of the next type are the
+    (deduplicated) targets of the present entries of all tables of the current type.
+    :param dump_path: Path to the snapshot.
+    :param pgds: List of physical pml4 addresses in the snapshot
+    :return: Snapshot with the types of all paging structures as designations
     """
-    designations = {}
-    snapshot = MemMappedSnapshot(SnapshotPagingData(path=dump_path, designations=designations))
-
-    print("Extracting known paging structures.")
-    last_progress = 0
-    for i, pml4_addr in enumerate(sorted(pgds)):
-        if (progress := 100 * i // len(pgds)) != last_progress and (progress % 5 == 0):
-            print(f"{progress}%")
-            last_progress = progress
-
-        addresses = {pml4_addr}
-        for page_type in PageTypes:
-            next_addresses = set()  # Holds addresses of tables of the "next" table type by the end onf the iteration
-            for addr in addresses:
-                if not addr in snapshot.designations:
-                    snapshot.designations[addr] = set()
-                table = snapshot.pages[addr]
-                if not page_type in table.designations:  # Did not consider this table as page_type yet
-                    table.designations.add(page_type)
-                    next_addresses |= {
-                        entry.target
-                        for entry in table.entries.values()
-                        # PDEs and PDPEs can point to large pages, we do not want to confuse those for paging structures
-                        if not entry.target_is_data(page_type) and entry.target < snapshot.size
-                    }
-            addresses = next_addresses
+    snapshot = MemMappedSnapshot(DesignationStore.create(dump_path))
+
+    instrumentation.log("Extracting known paging structures.")
+    tables = np.unique(np.asarray(pgds, dtype=np.uint64))
+    for level, page_type in enumerate(PAGE_TYPES_ORDERED):
+        instrumentation.progress(level / len(PAGE_TYPES_ORDERED))
+        snapshot.designations.add_designation(tables, page_type)
+        instrumentation.count("pages", len(tables))
+        if page_type != PAGE_TYPES_ORDERED[-1]:
+            tables = _next_level(snapshot, tables, page_type)
 
     return snapshot
 
 
-def get_mapped_pages(pages: Dict[int, PagingStructure]) -> DefaultDict[int, bool]:
+def get_mapped_pages(snapshot: MemMappedSnapshot) -> np.ndarray:
     """
-    Determine which of the pages are mapped into any virtual address space.
+    Determine which pages are mapped into any virtual address space, by the present entries of the paging structures
+    (pages designated in the store) pointing to data under their designations. Large pages count by their first page.
+    :return: Physical addresses of the mapped pages, without duplicates.
     """
-    is_mapped = defaultdict(lambda: False)
-    for page in pages.values():
-        for entry in page.entries.values():
-            for designation in page.designations:
-                if entry.target_is_data(designation):
-                    is_mapped[entry.target] = True
-    return is_mapped
-
-
-def build_nx_graph(
-    pages: Dict[int, PagingStructure], mem_size: int, data_page_nodes: bool = False
-) -> Tuple[nx.MultiDiGraph, List[Tuple]]:
+    mapped = []
+    for page_type in PageTypes:
+        tables = snapshot.designations.addresses(page_type)
+        for start in range(0, len(tables), CHUNK_PAGES):
+            entries = snapshot.gather_pages(tables[start : start + CHUNK_PAGES])
+            entries = entries[entries_present(entries) & entries_target_is_data(entries, page_type)]
+            mapped.append(np.unique(entries_target(entries)))
+    return np.unique(np.concatenate(mapped)) if mapped else np.array([], dtype=np.uint64)
+
+
+def build_page_graph(snapshot: MemMappedSnapshot, data_page_nodes: bool = False) -> Tuple[PageGraph, List[Tuple]]:
     """
-    Build a networkx graph representing the paging structures in a snapshot.
-    :param pages: Dict mapping physical address to paging structure.
-    :param mem_size: Size of the memory snapshot, pages "outside" the physical memory will be ignored.
+    Build a graph representing the paging structures in a snapshot.
+    :param snapshot: Snapshot backed by a DesignationStore, every page in the store is considered a paging structure of
+    its designated types.
+    Pages "outside" the physical memory will be ignored.
     :param data_page_nodes: Whether to add nodes for data pages, if False, last-level structures have an additional
     property "data_pages", indicating how many data pages they point to
     :return: The built graph and a list of out of bounds entries.
     """
-    graph = nx.MultiDiGraph()
-    out_of_bound_entries = []
-
-    # Empty PML4s are not added during the loop below because they have neither in- nor outbound edges.
-    graph.add_nodes_from(pages.keys())
-    for offset, page in pages.items():
-        graph.nodes[offset].update({t: (t in page.designations) for t in PageTypes})
-
-    for page_offset, page in pages.items():
-        for designation in page.designations:
-            for entry_offset, entry in page.entries.items():
-                if entry.target == 0:
-                    continue
-                if entry.target < mem_size:
-                    if data_page_nodes or not entry.target_is_data(designation):
-                        graph.add_edge(page_offset, entry.target, page_offset + entry_offset, offset=entry_offset)
-                    else:
-                        node = graph.nodes[page_offset]
-                        node["data_pages"] = node.get("data_pages", 0) + 1
-                # If the target is a data page, it may lie outside the snapshot (IOMem). Otherwise its an out-of-bounds
-                # entry. In any case, it is not added as a node.
-                elif not entry.target_is_data(designation):
-                    out_of_bound_entries.append(
-                        (str(designation), hex(page_offset), hex(entry_offset), hex(entry.target), hex(entry.value))
-                    )
-
-    return graph, out_of_bound_entries
-
-
-def get_node_features(graph: nx.MultiDiGraph) -> pd.DataFrame:
+    store = snapshot.designations
+    addrs = store.addresses()
+    has_type = {t: store.type_mask(t)[addrs // PAGING_STRUCTURE_SIZE] for t in PageTypes}
+    entries = snapshot.gather_pages(addrs)
+    entry_offsets = np.arange(0, PAGING_STRUCTURE_SIZE, PAGING_ENTRY_SIZE, dtype=np.uint64)
+
+    data_pages = np.zeros(len(addrs), dtype=np.int64)
+    sources, targets, offsets, out_of_bound_entries = [], [], [], []
+    for page_type in PageTypes:
+        type_addrs = addrs[has_type[page_type]]
+        type_entries = entries[has_type[page_type]]
+        type_targets = entries_target(type_entries)
+        points_to_data = entries_target_is_data(type_entries, page_type)
+        in_bounds = snapshot.in_bounds(type_targets)
+        # Entries pointing to page 0 are ignored.
+        considered = entries_present(type_entries) & (type_targets != 0)
+        edges = considered & in_bounds & (data_page_nodes | ~points_to_data)
+        pages, slots = np.nonzero(edges)
+        sources.append(type_addrs[pages])
+        targets.append(type_targets[pages, slots])
+        offsets.append(entry_offsets[slots])
+        data_pages[has_type[page_type]] += (considered & in_bounds & ~edges).sum(axis=1)
+        # If the target is a data page, it may lie outside the snapshot (IOMem). Otherwise its an out-of-bounds
+        # entry. In any case, it is not added as a node.
+        pages, slots = np.nonzero(considered & ~in_bounds & ~points_to_data)
+        for page, offset, value in zip(type_addrs[pages], entry_offsets[slots], type_entries[pages, slots]):
+            out_of_bound_entries.append(
+                (str(page_type), hex(page), hex(offset), hex(int(entries_target(value))), hex(value))
+            )
+
+    # Pages with several designations contribute the same entry once per designation, it becomes a single edge.
+    sources, offsets, targets = np.unique(
+        np.stack([np.concatenate(sources), np.concatenate(offsets), np.concatenate(targets)]), axis=1
+    )
+    nodes = np.union1d(addrs, targets)
+    node_data = {str(t): np.isin(nodes, addrs[has_type[t]]) for t in PageTypes}
+    node_data["data_pages"] = np.zeros(len(nodes), dtype=np.int64)
+    node_data["data_pages"][np.searchsorted(nodes, addrs)] = data_pages
+    return PageGraph.from_edges(nodes, sources, targets, offsets, node_data), out_of_bound_entries
+
+
+@instrumentation.span("node_features")
+def get_node_features(graph: PageGraph, snapshot: MemMappedSnapshot) -> pd.DataFrame:
     """
-    Create a pandas dataframe with some useful stats for every node in a paging structures graph.
+    Create a pandas dataframe with some useful stats for every node in a paging structures graph:
+        - The node data of the graph (designations, data_pages, ...)
+        - depth: Length of the longest inbound path, up to the number of page types - 1
+        - in_degree, out_degree
+        - present_entries, valid_<type>_entries: Number of present entries and of those valid under every type
+        - user_entries, nx_entries, large_entries: Number of present entries with the U/S (bit 2), NX (bit 63) or
+          page size (bit 7) flag set
+    Degrees and depth are computed on the edge arrays, the entry counts in one (chunked) pass over the pages.
+    :param graph: Graph of the paging structures, see build_page_graph.
+    :param snapshot: The snapshot containing the pages.
+    :return: DataFrame with one row per node, indexed by physical address.
     """
-    df = pd.DataFrame(data=[graph.nodes[node] for node in graph.nodes], index=graph.nodes)
-    r_graph = graph.reverse()
-    df["longest_inbound_path"] = [len(nx.dfs_successors(r_graph, source=node)) for node in r_graph.nodes]
-    idx, deg = tuple(zip(*graph.in_degree))
-    df["in_degree"] = pd.Series(data=deg, index=idx)
-    idx, deg = tuple(zip(*graph.out_degree))
+    num_nodes = graph.number_of_nodes()
+    df = pd.DataFrame({key: np.asarray(values) for key, values in graph.node_data.items()})
+    df.index = pd.Index(graph.nodes, name="page")
+    df["depth"] = bounded_path_lengths(graph, max_len=len(PageTypes) - 1, direction="in")
+    df["in_degree"] = graph.in_degree
     # Note: Out degree will be 0 for pages in "training" data and 1 in "target" data
-    df["out_degree"] = pd.Series(data=deg, index=idx)
+    df["out_degree"] = graph.out_degree
+
+    counts = {name: np.zeros(num_nodes, dtype=np.uint16) for name in ("present", "user", "nx", "large")}
+    valid_types = PAGE_TYPES_ORDERED[:-1]  # PT entries are always valid
+    counts.update({f"valid_{t}": np.zeros(num_nodes, dtype=np.uint16) for t in valid_types})
+    for start in range(0, num_nodes, CHUNK_PAGES):
+        chunk = slice(start, start + CHUNK_PAGES)
+        entries = snapshot.gather_pages(graph.nodes[chunk])
+        present = entries_present(entries)
+        counts["present"][chunk] = present.sum(axis=1)
+        counts["user"][chunk] = (present & entries_user_access(entries)).sum(axis=1)
+        counts["nx"][chunk] = (present & entries_nx(entries)).sum(axis=1)
+        counts["large"][chunk] = entries_large_page(entries).sum(axis=1)
+        for page_type in valid_types:
+            counts[f"valid_{page_type}"][chunk] = (present & entries_valid(entries, page_type)).sum(axis=1)
+    for name, count in counts.items():
+        df[f"{name}_entries"] = count
+    instrumentation.count("pages", num_nodes)
+    instrumentation.count("edges", graph.number_of_edges())
     return df
 
 
@@ -123,7 +186,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "dump_path",
-        help="Path to snapshot. Output files will have the same name with _known_pages.[json|graphml] appended.",
+        help="Path to snapshot. Output files will have the same name with _known_pages.[desig|pgraph] appended.",
         type=pathlib.Path,
     )
     parser.add_argument(
@@ -134,14 +197,29 @@ if __name__ == "__main__":
     parser.add_argument(
         "--kpti", help="Whether the snapshot is from a kernel with KPTI enabled.", action=argparse.BooleanOptionalAction
     )
+    parser.add_argument("--json", help="Additionally export the designations as JSON.", action="store_true")
+    parser.add_argument(
+        "--graphml",
+        help="Additionally export the graph, with task info and color coding, as graphml.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--features",
+        help="Additionally save the features of all nodes (see get_node_features) as csv.",
+        action="store_true",
+    )
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    instrumentation.configure(args)
     dump_path = args.dump_path
     task_info_path = args.task_info
 
-    out_pages = dump_path.with_stem(dump_path.stem + "_known_pages").with_suffix(".json")
-    out_graph = out_pages.with_suffix(".graphml")
-    out_oob_entries = dump_path.with_stem(dump_path.stem + "_out_of_bounds").with_suffix(".csv")
+    stem = snapshot_stem(dump_path)
+    out_pages = dump_path.with_name(stem + "_known_pages" + DESIGNATIONS_SUFFIX)
+    out_graph = out_pages.with_suffix(GRAPH_SUFFIX)
+    out_oob_entries = dump_path.with_name(stem + "_out_of_bounds.csv")
+    out_features = dump_path.with_name(stem + "_node_features.csv")
 
     task_info = pd.read_csv(task_info_path)
 
@@ -154,15 +232,14 @@ if __name__ == "__main__":
 
     snapshot = read_paging_structures(str(dump_path), phy_pgds)
 
-    print(f"Saving pages: {out_pages}")
-    with open(out_pages, "w") as f:
-        f.write(snapshot.snapshot.json())
+    instrumentation.log(f"Saving pages: {out_pages}")
+    save_snapshot(snapshot, out_pages, export_json=args.json)
 
-    print("Building nx graph.")
-    graph, out_of_bounds = build_nx_graph(snapshot.pages, snapshot.size)
+    instrumentation.log("Building page graph.")
+    page_graph, out_of_bounds = build_page_graph(snapshot)
 
     if out_of_bounds:
-        print(f"There are {len(out_of_bounds)} out of bounds entries. Saving to csv: {out_oob_entries}")
+        instrumentation.log(f"There are {len(out_of_bounds)} out of bounds entries. Saving to csv: {out_oob_entries}")
         oob_df = pd.DataFrame(
             out_of_bounds,
             columns=[
@@ -175,25 +252,36 @@ if __name__ == "__main__":
         )
         oob_df.to_csv(out_oob_entries, index=False)
 
-    print("Adding task info to PML4s in graph.")
+    instrumentation.log(f"Saving graph: {out_graph}")
+    save_graph(page_graph, out_graph)
 
-    graph_cols = ["phy_pgd_kernel", "phy_pgd_user", "COMM"] if args.kpti else ["phy_pgd", "COMM"]
-    graph = add_task_info(graph, task_info[graph_cols].itertuples(index=False))
-    print("Adding colors to graph.")
-    graph = color_graph(graph, snapshot.pages)
+    if args.features:
+        instrumentation.log(f"Saving node features: {out_features}")
+        get_node_features(page_graph, snapshot).to_csv(out_features)
 
-    print(f"Saving graph: {out_graph}")
-    nx.readwrite.write_graphml(graph, out_graph)
+    if args.graphml:
+        instrumentation.log("Adding task info to PML4s in graph.")
+        # The networkx graph is only used for visualisation.
+        graph = page_graph.to_networkx()
+        graph_cols = ["phy_pgd_kernel", "phy_pgd_user", "COMM"] if args.kpti else ["phy_pgd", "COMM"]
+        graph = add_task_info(graph, task_info[graph_cols].itertuples(index=False))
+        instrumentation.log("Adding colors to graph.")
+        graph = color_graph(graph, snapshot.pages)
+        instrumentation.log(f"Saving graph: {out_graph.with_suffix('.graphml')}")
+        nx.readwrite.write_graphml(graph, out_graph.with_suffix(".graphml"))
 
     # Below is some exploratory code, you will need a debugger / add prints to access these values.
 
-    node_data = get_node_features(graph)
-    is_mapped = get_mapped_pages(snapshot.pages)
-    total_mapped = sum(mapped and addr < snapshot.size for addr, mapped in is_mapped.items())
+    mapped = get_mapped_pages(snapshot)
+    total_mapped = int(snapshot.in_bounds(mapped).sum())
     # Approximate b.c. of large pages
     app_mapped_mem_perc = total_mapped / (snapshot.size / PAGING_STRUCTURE_SIZE)
 
-    types_summary = Counter((is_mapped[addr], *page.designations) for addr, page in snapshot.pages.items())
-    ambiguous_pages = sum(occ for desigs, occ in types_summary.items() if len(desigs) > 2)
+    known = snapshot.designations.addresses()
+    is_mapped = np.isin(known, mapped)
+    has_type = [snapshot.designations.type_mask(t)[known // PAGING_STRUCTURE_SIZE] for t in PageTypes]
+    # Keys are (mapped, designated as PML4, PDP, PD, PT)
+    types_summary = Counter(zip(is_mapped.tolist(), *(designated.tolist() for designated in has_type)))
+    ambiguous_pages = int((np.sum(has_type, axis=0) > 1).sum())
 
-print("Done.")
+    instrumentation.log("Done.")
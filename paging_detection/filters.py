@@ -1,78 +1,466 @@
-from collections import defaultdict
-import json
-from typing import Dict
-
-import networkx as nx
-
-from paging_detection import PageTypes, PagingStructure, next_type, prev_type, PAGE_TYPES_ORDERED
-from paging_detection.mmaped import SnapshotPagingData, MemMappedSnapshot
-
-
-def prune_designations(graph: nx.MultiDiGraph, pages: Dict[int, PagingStructure]) -> int:
-    need_check = graph.nodes
-    removed = 0
-    while need_check:
-        print(f"{len(need_check)} need checking.")
-        next_need_check = set()
-        for p_offset in need_check:
-            node = graph.nodes[p_offset]
-            page = pages[int(p_offset)]
-            modified = False
-            used_entries = [page.entries[int(e_offset)] for _, _, e_offset in graph.out_edges(p_offset, keys=True)]
-            designations = set(type for type in PageTypes if node[str(type)])
-            if PageTypes.PT in designations and not used_entries:  # Needs to point somewhere
-                node[str(PageTypes.PT)] = False
-                modified = True
-            for type in designations.intersection(PAGE_TYPES_ORDERED[:-1]):
-                if not (
-                    # Points to something with the "next type"
-                    any(graph.nodes[succ][str(next_type(type))] for succ in graph.successors(p_offset))
-                    # Points to data
-                    or any(entry.target_is_data(type) for entry in used_entries)
-                ):
-                    node[str(type)] = False
-                    removed += 1
-                    modified = True
-            for type in designations.intersection(PAGE_TYPES_ORDERED[1:]):
-                # Has a matching predecessor
-                if not any(graph.nodes[pred][str(prev_type(type))] for pred in graph.predecessors(p_offset)):
-                    node[str(type)] = False
-                    removed += 1
-                    modified = True
-            if modified:
-                next_need_check.update(graph.neighbors(p_offset))
-        need_check = next_need_check
-    return removed
-
-
-def pml4_kernel_mapping_similarity(pages: Dict[int, PagingStructure]) -> Dict[int, float]:
+import pathlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGING_ENTRY_SIZE,
+    ENTRIES_PER_PAGE,
+    next_type,
+    prev_type,
+    PAGE_TYPES_ORDERED,
+    max_page_addr,
+    entries_present,
+    entries_target_is_data,
+)
+from paging_detection import instrumentation
+from paging_detection.external_sort import ExternalSorter
+from paging_detection.kpti import find_kpti_pairs
+from paging_detection.mmaped import (
+    DESIGNATIONS_SUFFIX,
+    MemMappedSnapshot,
+    load_snapshot,
+    resolve_pages_path,
+    save_snapshot,
+)
+from paging_detection.page_graph import (
+    PageGraph,
+    GRAPH_SUFFIX,
+    add_counts,
+    allocate,
+    chunks,
+    load_graph,
+    resolve_graph_path,
+    save_graph,
+)
+
+
+class DesignationPruner:
+    """
+    Removes designations from pages that are not supported by their neighbours, see prune_designations.
+    For every page and type, the pruner keeps count of the page's supporting outbound edges (pointing to a page with the
+    next type or to data) and supporting inbound edges (coming from a page with the previous type). Removing a
+    designation decrements the counters of the page's neighbours and only pages whose counters changed are checked
+    again. Every edge is visited at most once per type and removal, so pruning takes O(edges) in total.
+    Designations are read from and written to the node data of the graph.
+    """
+
+    def __init__(self, graph: PageGraph, snapshot: MemMappedSnapshot):
+        """
+        :param graph: Graph representing the pages, with the current designations in its node data.
+        :param snapshot: The snapshot containing the pages.
+        """
+        self.snapshot = snapshot
+        self._set_graph(graph)
+        # Pages that need to be checked for every type, as list of index arrays holding at most graph.chunk_sizes.nodes
+        # indices in total. Beyond that, they are marked in a bool array (indexed like graph.nodes) instead.
+        self._pending: Dict[PageTypes, List[np.ndarray]] = {t: [] for t in PageTypes}
+        self._pending_size = dict.fromkeys(PageTypes, 0)
+        self._pending_marked: Dict[PageTypes, Optional[np.ndarray]] = dict.fromkeys(PageTypes)
+        # Whether all pages need to be checked, which is done in chunks of pages
+        self._check_all = True
+
+    def _set_graph(self, graph: PageGraph):
+        self.graph = graph
+        self.designations = {t: graph.node_data[str(t)] for t in PageTypes}
+        num_nodes = graph.number_of_nodes()
+        # Whether the entry of an edge points to data, if its page has a given type
+        self._data = {t: graph.allocate(graph.number_of_edges(), bool) for t in PAGE_TYPES_ORDERED[:-1]}
+
+        # Supporting outbound edges, every PT needs to point somewhere.
+        self._succ_support = {PageTypes.PT: graph.allocate(num_nodes, np.int64)}
+        self._succ_support[PageTypes.PT][:] = graph.out_degree
+        self._succ_support.update({t: graph.allocate(num_nodes, np.int64) for t in PAGE_TYPES_ORDERED[:-1]})
+        # Supporting inbound edges
+        self._pred_support = {t: graph.allocate(num_nodes, np.int64) for t in PAGE_TYPES_ORDERED[1:]}
+
+        for edges in graph.edge_chunks():
+            sources, targets = graph.sources[edges], graph.targets[edges]
+            entries = self.snapshot.gather_entries(graph.nodes[sources] + graph.offsets[edges])
+            for page_type in PAGE_TYPES_ORDERED[:-1]:
+                data = entries_target_is_data(entries, page_type)
+                self._data[page_type][edges] = data
+                supporting = self.designations[next_type(page_type)][targets] | data
+                add_counts(self._succ_support[page_type], sources[supporting])
+            for page_type in PAGE_TYPES_ORDERED[1:]:
+                add_counts(self._pred_support[page_type], targets[self.designations[prev_type(page_type)][sources]])
+
+    def _add_pending(self, page_type: PageTypes, idx: np.ndarray):
+        if not len(idx):
+            return
+        self._pending[page_type].append(idx)
+        self._pending_size[page_type] += len(idx)
+        if self._pending_size[page_type] <= self.graph.chunk_sizes.nodes:
+            return
+        if self._pending_marked[page_type] is None:
+            self._pending_marked[page_type] = self.graph.allocate(self.graph.number_of_nodes(), bool)
+        for pending in self._pending[page_type]:
+            self._pending_marked[page_type][pending] = True
+        self._pending[page_type], self._pending_size[page_type] = [], 0
+
+    def _take_pending(self, page_type: PageTypes) -> Iterator[np.ndarray]:
+        """
+        Yield the (unique) indices of the pages pending to be checked for page_type in chunks and reset them.
+        """
+        pending, marked = self._pending[page_type], self._pending_marked[page_type]
+        self._pending[page_type], self._pending_size[page_type], self._pending_marked[page_type] = [], 0, None
+        if marked is None:
+            if pending:
+                yield np.unique(np.concatenate(pending))
+            return
+        for idx in pending:
+            marked[idx] = True
+        for nodes in self.graph.node_chunks():
+            yield np.flatnonzero(marked[nodes]) + nodes.start
+
+    def _decrement(self, counter: np.ndarray, idx: np.ndarray, page_type: PageTypes):
+        nodes, counts = np.unique(idx, return_counts=True)
+        counter[nodes] -= counts
+        self._add_pending(page_type, nodes)
+
+    def _drop(self, page_type: PageTypes, idx: np.ndarray):
+        """
+        Remove the designation page_type from the pages with the given (unique) indices, which must have it.
+        """
+        self.designations[page_type][idx] = False
+        if page_type != PageTypes.PML4:
+            sup_type = prev_type(page_type)
+            edges = self.graph.in_edges_of(idx)
+            # Edges with entries pointing to data keep supporting their source
+            edges = edges[~self._data[sup_type][edges]]
+            self._decrement(self._succ_support[sup_type], self.graph.sources[edges], sup_type)
+        if page_type != PageTypes.PT:
+            sub_type = next_type(page_type)
+            edges = self.graph.out_edges_of(idx)
+            self._decrement(self._pred_support[sub_type], self.graph.targets[edges], sub_type)
+
+    def remove(self, designations: Dict[PageTypes, np.ndarray], first: int = 0) -> int:
+        """
+        Remove designations from pages, e.g. based on a filter. Call prune to propagate the removal.
+        :param designations: Dict mapping page types to bool arrays (indexed like graph.nodes[first:]) selecting pages
+        which can not have the respective type.
+        :param first: Index of the first page the arrays refer to, e.g. to remove designations chunk by chunk.
+        :return: Number of removed designations. (Designations the pages did not have are not counted.)
+        """
+        removed = 0
+        for page_type, mask in designations.items():
+            idx = np.flatnonzero(mask & self.designations[page_type][first : first + len(mask)]) + first
+            self._drop(page_type, idx)
+            removed += len(idx)
+        return removed
+
+    def remove_edges(self, mask: np.ndarray):
+        """
+        Remove the edges selected by mask from the graph. The pruner continues on a copy of its graph (self.graph)
+        without these edges. Call prune to propagate the removal.
+        """
+        endpoints = [
+            np.concatenate((self.graph.sources[edges][mask[edges]], self.graph.targets[edges][mask[edges]]))
+            for edges in self.graph.edge_chunks()
+        ]
+        self._set_graph(self.graph.without_edges(mask))
+        for chunk_endpoints in endpoints:
+            for page_type in PageTypes:
+                self._add_pending(page_type, chunk_endpoints)
+
+    def prune(self) -> int:
+        """
+        Repeatedly remove designations from pages that are not supported by their neighbours, until nothing changes.
+        :return: Number of removed designations.
+        """
+        removed = 0
+        with instrumentation.span("prune"):
+            if self._check_all:
+                self._check_all = False
+                instrumentation.log(f"{self.graph.number_of_nodes()} need checking.")
+                instrumentation.count("pages", self.graph.number_of_nodes())
+                for nodes in self.graph.node_chunks():
+                    idx = np.arange(nodes.start, nodes.stop)
+                    for page_type in PageTypes:
+                        removed += self._check(page_type, idx)
+            while any(self._pending.values()) or any(marked is not None for marked in self._pending_marked.values()):
+                # Pages are counted once for every type they are checked for.
+                checking = 0
+                for page_type in PageTypes:
+                    for idx in self._take_pending(page_type):
+                        checking += len(idx)
+                        removed += self._check(page_type, idx)
+                instrumentation.log(f"{checking} need checking.")
+                instrumentation.count("pages", checking)
+            instrumentation.count("designations_removed", removed)
+        return removed
+
+    def _check(self, page_type: PageTypes, idx: np.ndarray) -> int:
+        """
+        Remove the designation page_type from the pages with the given (unique) indices, if they are not supported.
+        :return: Number of removed designations.
+        """
+        unsupported = self._succ_support[page_type][idx] == 0
+        if page_type != PageTypes.PML4:
+            unsupported |= self._pred_support[page_type][idx] == 0
+        drop = idx[unsupported & self.designations[page_type][idx]]
+        self._drop(page_type, drop)
+        return len(drop)
+
+
+def prune_designations(graph: PageGraph, snapshot: MemMappedSnapshot) -> int:
+    """
+    Repeatedly remove designations from pages that are not supported by their neighbours, until nothing changes:
+        - Every non-PT needs to point to a page with the next type or point to data (e.g. a large page)
+        - Every non-PML4 needs to have a predecessor with the previous type
+        - Every PT needs to point somewhere
+    Designations are read from and written to the node data of graph. When pruning repeatedly, e.g. between filters,
+    use a DesignationPruner instead, which keeps its counters between calls.
+    :return: Number of removed designations.
+    """
+    return DesignationPruner(graph, snapshot).prune()
+
+
+# Entries with an offset above 2048 map the "kernel" end of the address space.
+# (Strictly speaking, the kernel half starts at 2048, but the first slot of it is left out.)
+KERNEL_HALF_FIRST_SLOT = 2048 // PAGING_ENTRY_SIZE + 1
+
+
+def _kernel_halves(
+    snapshot: MemMappedSnapshot, candidates: np.ndarray, chunk_pages: int = CHUNK_PAGES
+) -> Iterator[np.ndarray]:
+    """
+    Yield the kernel halves of the candidates in chunks of chunk_pages, with non-present entries zeroed out.
+    """
+    for start in range(0, len(candidates), chunk_pages):
+        halves = snapshot.gather_pages(candidates[start : start + chunk_pages])[:, KERNEL_HALF_FIRST_SLOT:]
+        halves[~entries_present(halves)] = 0
+        yield halves
+
+
+def _pair_counts_streamed(
+    snapshot: MemMappedSnapshot, candidates: np.ndarray, workspace: pathlib.Path, chunk_pages: int = CHUNK_PAGES
+) -> Tuple[np.ndarray, int]:
+    """
+    For every candidate, sum up how many candidates every one of its (slot, value) pairs occurs in.
+    The pairs are sorted by value and slot with an external sort in workspace, so equal pairs end up next to each other
+    without holding all of them in memory.
+    :return: The sums, indexed like candidates and memory mapped from workspace, and the highest number of candidates
+    sharing a pair.
+    """
+    sorter = ExternalSorter(workspace, np.uint64, np.uint64, run_size=chunk_pages * ENTRIES_PER_PAGE)
+    chunk_starts = range(0, len(candidates), chunk_pages)
+    for start, halves in zip(chunk_starts, _kernel_halves(snapshot, candidates, chunk_pages)):
+        pages, slots = np.nonzero(halves)
+        # Values of the sorter: slot in the upper, candidate in the lower 32 bits
+        sorter.add(halves[pages, slots], (slots.astype(np.uint64) << np.uint64(32)) | (pages + start).astype(np.uint64))
+
+    sums = allocate(len(candidates), np.float64, workspace)
+    max_count = 0
+
+    def add_groups(values: np.ndarray, slot_ids: np.ndarray, ids: np.ndarray) -> int:
+        starts = np.flatnonzero(np.concatenate(([True], (values[1:] != values[:-1]) | (slot_ids[1:] != slot_ids[:-1]))))
+        counts = np.diff(np.append(starts, len(values)))
+        present_ids, positions = np.unique(ids, return_inverse=True)
+        sums[present_ids.astype(np.int64)] += np.bincount(positions.ravel(), weights=np.repeat(counts, counts))
+        return int(counts.max()) if len(counts) else 0
+
+    # The last group of a block may continue in the next one.
+    held_values, held_ids = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+    for values, ids in sorter.sorted():
+        values, ids = np.concatenate((held_values, values)), np.concatenate((held_ids, ids))
+        slot_ids = ids >> np.uint64(32)
+        last = np.flatnonzero((values != values[-1]) | (slot_ids != slot_ids[-1]))
+        last = last[-1] + 1 if len(last) else 0
+        max_count = max(max_count, add_groups(values[:last], slot_ids[:last], ids[:last] & np.uint64(0xFFFFFFFF)))
+        held_values, held_ids = values[last:], ids[last:]
+    if len(held_values):
+        held_slots = held_ids >> np.uint64(32)
+        max_count = max(max_count, add_groups(held_values, held_slots, held_ids & np.uint64(0xFFFFFFFF)))
+    return sums, max_count
+
+
+@instrumentation.span("kernel_mapping_similarity")
+def _kernel_mapping_scores(
+    snapshot: MemMappedSnapshot,
+    candidates: np.ndarray,
+    workspace: Optional[pathlib.Path] = None,
+    chunk_pages: int = CHUNK_PAGES,
+) -> np.ndarray:
+    """
+    The scores of pml4_kernel_mapping_similarity, indexed like candidates. With a workspace, they are memory mapped
+    from it.
+    """
+    instrumentation.count("pages", len(candidates))
+    if not len(candidates):
+        return np.zeros(0)
+    if workspace is not None:
+        page_scores, max_count = _pair_counts_streamed(snapshot, candidates, workspace, chunk_pages)
+        if not max_count:
+            return page_scores
+        page_scores /= max_count
+    else:
+        # Present entries of all candidates as (candidate, slot, value)
+        pages, slots, values = [], [], []
+        chunk_starts = range(0, len(candidates), chunk_pages)
+        for start, halves in zip(chunk_starts, _kernel_halves(snapshot, candidates, chunk_pages)):
+            chunk_rows, chunk_slots = np.nonzero(halves)
+            pages.append(chunk_rows + start)
+            slots.append(chunk_slots.astype(np.uint64))
+            values.append(halves[chunk_rows, chunk_slots])
+        pages = np.concatenate(pages)
+        if not len(pages):
+            return np.zeros(len(candidates))
+        pairs = np.ascontiguousarray(np.stack((np.concatenate(slots), np.concatenate(values)), axis=1))
+
+        # Count the occurrences of every distinct (slot, value) pair by viewing the pairs as opaque 16 byte values.
+        _, pair_ids, pair_counts = np.unique(
+            pairs.view(np.dtype((np.void, pairs.itemsize * 2))).ravel(), return_inverse=True, return_counts=True
+        )
+        entry_scores = pair_counts / pair_counts.max()
+        page_scores = np.bincount(pages, weights=entry_scores[pair_ids.ravel()], minlength=len(candidates))
+    page_scores /= page_scores.max()
+    return page_scores
+
+
+def pml4_kernel_mapping_similarity(
+    snapshot: MemMappedSnapshot, candidates: Optional[np.ndarray] = None, workspace: Optional[pathlib.Path] = None
+) -> Dict[int, float]:
     """
     Calculates a likelihood of actually being a pml4 for every candidate pml4 based on how many entries
     it shares with other pml4s in the "kernel" end of the address space.
+    Every present (slot, value) pair in the kernel halves scores the number of candidates it occurs in, relative to the
+    most common one. A candidates score is the sum of the scores of its pairs, relative to the highest score.
+    :param snapshot: The snapshot.
+    :param candidates: Physical addresses of the candidate pml4s. Defaults to all pages designated as PML4.
+    :param workspace: If given, pairs are counted with an external sort in this directory instead of in memory (see
+    out_of_core). Scores may then differ from the in memory ones by rounding errors.
+    :return: Dict mapping the candidates to their scores, sorted by score in descending order.
     """
-    candidate_pml4s = [offset for offset, page in pages.items() if PageTypes.PML4 in page.designations]
+    if candidates is None:
+        candidates = snapshot.designations.addresses(PageTypes.PML4)
+    candidates = np.asarray(candidates, dtype=np.uint64)
+    page_scores = _kernel_mapping_scores(snapshot, candidates, workspace)
+    order = np.argsort(-page_scores, kind="stable")
+    return dict(zip(candidates[order].tolist(), page_scores[order].tolist()))
+
 
-    entries: Dict[int, set] = {}
+def cluster_kernel_halves(snapshot: MemMappedSnapshot, candidates: Optional[np.ndarray] = None) -> List[np.ndarray]:
+    """
+    Group candidate pml4s with identical "kernel" ends (only considering present entries). Processes usually share
+    the kernel mappings, so the biggest cluster likely contains the real pml4s.
+    :param snapshot: The snapshot.
+    :param candidates: Physical addresses of the candidate pml4s. Defaults to all pages designated as PML4.
+    :return: Sorted physical addresses of the candidates in every cluster, biggest cluster first.
+    """
+    if candidates is None:
+        candidates = snapshot.designations.addresses(PageTypes.PML4)
+    candidates = np.sort(np.asarray(candidates, dtype=np.uint64))
+    if not len(candidates):
+        return []
+    halves = np.ascontiguousarray(np.concatenate(list(_kernel_halves(snapshot, candidates))))
+    _, cluster_ids, sizes = np.unique(
+        halves.view(np.dtype((np.void, halves.itemsize * halves.shape[1]))).ravel(),
+        return_inverse=True,
+        return_counts=True,
+    )
+    cluster_ids = cluster_ids.ravel()
+    clusters = np.argsort(-sizes, kind="stable")
+    order = np.argsort(cluster_ids, kind="stable")
+    members = np.split(candidates[order], np.cumsum(sizes)[:-1])
+    return [members[cluster] for cluster in clusters]
 
-    entry_counts = defaultdict(lambda: 0)
 
-    for page_offset in candidate_pml4s:
-        page = pages[page_offset]
-        entries[page_offset] = {
-            (entry_offset, entry.value) for entry_offset, entry in page.entries.items() if entry_offset > 2048
-        }
-        for entry in entries[page_offset]:
-            entry_counts[entry] += 1
+@instrumentation.span("filters")
+def apply_filters(graph: PageGraph, snapshot: MemMappedSnapshot) -> PageGraph:
+    """
+    Apply the filter chain to pages with possible types (see determine_types), pruning after every filter:
+        - Entries pointing to page 0 are discarded
+        - Pages with invalid entries under a type can not have that type
+        - Pages with OOB entries under a type can not have that type
+        - Pairs of PML4s with the KPTI signature (see kpti.find_kpti_pairs) can only be PML4s
+        - PML4s need to share their kernel mappings with other PML4s (see pml4_kernel_mapping_similarity), except for
+          the ones in KPTI pairs, as user PGDs only map a few kernel entries
+    Designations are read from and written to the node data of graph and synced to snapshot afterwards.
+    :param graph: Graph representing the pages, with possible types in its node data.
+    :param snapshot: The snapshot containing the pages.
+    :return: The filtered graph, a copy of graph without the edges pointing to page 0.
+    """
+    with instrumentation.span("initial"):
+        pruner = DesignationPruner(graph, snapshot)
+        initial_prune = pruner.prune()
+        instrumentation.log(f"Initial prune removed {initial_prune} designations.")
+
+    # Discarding entries to page 0 (and, as page 0 is no paging structure, its own entries)
+    with instrumentation.span("page_zero"):
+        page_zero = graph.index(0)
+        to_zero = int(graph.in_degree[page_zero])
+        removed_edges = graph.allocate(graph.number_of_edges(), bool)
+        removed_edges[graph.in_edges_of([page_zero])] = True
+        removed_edges[graph.out_edges_of([page_zero])] = True
+        pruner.remove_edges(removed_edges)
+        graph = pruner.graph
+        instrumentation.count("edges_removed", to_zero)
+        instrumentation.log(f"Removed {to_zero} edges pointing to page 0.")
+
+        no_zero = pruner.prune()
+        instrumentation.log(f"No-zero prune removed {no_zero} designations.")
 
-    max_occurence = max(entry_counts.values())
-    entry_scores = {entry: occurences / max_occurence for entry, occurences in entry_counts.items()}
+    # Discarding pages with invalid entries
+    with instrumentation.span("invalid"):
+        excluded = 0
+        for nodes in graph.node_chunks():
+            excluded += pruner.remove({t: graph.node_data[f"invalid_{t}"][nodes] > 0 for t in PageTypes}, nodes.start)
+        instrumentation.count("designations_removed", excluded)
+        instrumentation.log(f"Removed {excluded} designations due to invalid entries.")
+        pruned = pruner.prune()
+        instrumentation.log(f"Prune removed {pruned} designations.")
 
-    page_scores = {offset: sum(entry_scores[entry] for entry in entries) for offset, entries in entries.items()}
-    max_score = max(page_scores.values())
-    page_scores = {offset: score for offset, score in sorted(page_scores.items(), key=lambda tup: tup[1], reverse=True)}
-    page_scores_normed = {offset: score / max_score for offset, score in page_scores.items()}
+    # Discarding pages with OOB entries
+    with instrumentation.span("oob"):
+        excluded = 0
+        for nodes in graph.node_chunks():
+            excluded += pruner.remove({t: graph.node_data[f"oob_{t}"][nodes] > 0 for t in PageTypes}, nodes.start)
+        instrumentation.count("designations_removed", excluded)
+        instrumentation.log(f"Removed {excluded} designations due to OOB entries.")
+        pruned = pruner.prune()
+        instrumentation.log(f"Prune removed {pruned} designations.")
+
+    # Pages in KPTI pairs are PML4s, discarding their other designations
+    with instrumentation.span("kpti"):
+        pml4_candidates = graph.nodes[graph.node_data[str(PageTypes.PML4)]]
+        kpti_pairs = find_kpti_pairs(snapshot, max_page_addr(snapshot.size), pml4_candidates)
+        paired = graph.allocate(graph.number_of_nodes(), bool)
+        paired[graph.index(kpti_pairs.ravel())] = True
+        instrumentation.log(f"Found {len(kpti_pairs)} KPTI pairs.")
+        excluded = 0
+        for nodes in graph.node_chunks():
+            excluded += pruner.remove({t: paired[nodes] for t in PageTypes if t != PageTypes.PML4}, nodes.start)
+        instrumentation.count("designations_removed", excluded)
+        instrumentation.log(f"Removed {excluded} designations of pages in KPTI pairs.")
+        pruned = pruner.prune()
+        instrumentation.log(f"Prune removed {pruned} designations.")
 
-    return page_scores_normed
+    # Applying the "kernel mapping similarity" filter
+    with instrumentation.span("kernel_similarity"):
+        pml4_candidates = graph.nodes[graph.node_data[str(PageTypes.PML4)]]
+        pml4_scores = _kernel_mapping_scores(snapshot, pml4_candidates, graph.workspace, graph.chunk_sizes.pages)
+        dissimilar = graph.allocate(graph.number_of_nodes(), bool)
+        for candidates in chunks(len(pml4_candidates), graph.chunk_sizes.nodes):
+            dissimilar[graph.index(pml4_candidates[candidates][pml4_scores[candidates] < 0.8])] = True
+        removed = 0
+        for nodes in graph.node_chunks():
+            removed += pruner.remove({PageTypes.PML4: dissimilar[nodes] & ~paired[nodes]}, nodes.start)
+        instrumentation.count("designations_removed", removed)
+
+        instrumentation.log(f"Removed {removed} PML4 designations based on kernel part similarities.")
+        pruned = pruner.prune()
+        instrumentation.log(f"Prune removed {pruned} designations.")
+
+    # Syncing
+    instrumentation.log("Transferring designations to snapshot data")
+    for nodes in graph.node_chunks():
+        designations = {t: graph.node_data[str(t)][nodes] for t in PageTypes}
+        snapshot.designations.set_designations(graph.nodes[nodes], designations)
+
+    return graph
 
 
 if __name__ == "__main__":
@@ -82,91 +470,39 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "in_files",
-        help="Path to graphml file or the json with all pages in the snapshot. Other will be inferred.",
+        help="Path to the graph (.pgraph or .graphml) or the designations (.desig or .json) of all pages in the "
+        "snapshot. Other will be inferred.",
         type=pathlib.Path,
     )
+    parser.add_argument("--json", help="Additionally export the designations as JSON.", action="store_true")
+    parser.add_argument("--graphml", help="Additionally export the graph as graphml.", action="store_true")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.configure(args)
     input_path = args.in_files
-    if input_path.suffix not in {".json", ".graphml", ""}:
-        raise ValueError("Invalid extension for input files path. Must be either .json, .graphml or no extension.")
-
-    in_pages_path = input_path.with_suffix(".json")
-    in_graph_path = input_path.with_suffix(".graphml")
-    out_pages_path = input_path.with_stem(input_path.stem + "_filtered").with_suffix(".json")
-    out_graph_path = out_pages_path.with_suffix(".graphml")
-
-    print(f"Loading graph: {in_graph_path}")
-    graph = nx.read_graphml(in_graph_path, force_multigraph=True)
-
-    print(f"Loading pages: {in_pages_path}")
-    with open(in_pages_path) as f:
-        snapshot = MemMappedSnapshot(SnapshotPagingData.validate(json.load(f)))
-
-    pages = snapshot.pages
-
-    initial_prune = prune_designations(graph, pages)
-    print(f"Initial prune removed {initial_prune} designations.")
-
-    # Discarding entries to page 0
-    zero_entries = graph.in_degree["0"]
-    page_zero = graph.nodes["0"]
-    graph.remove_node("0")
-    graph.add_node("0", **page_zero)  # Adding node back in to prevent keyerrors
-    print(f"Removed {zero_entries} edges pointing to page 0.")
-
-    no_zero = prune_designations(graph, pages)
-    print(f"No-zero prune removed {initial_prune} designations.")
-
-    # Discarding pages with invalid entries
-    excluded = 0
-    for node in graph.nodes.values():
-        for page_type in PageTypes:
-            if node[f"invalid_{page_type}"] > 0:
-                excluded += 1
-                node[str(page_type)] = False
-    print(f"Removed {excluded} designations due to invalid entries.")
-    pruned = prune_designations(graph, pages)
-    print(f"Prune removed {pruned} designations.")
-
-    # Discarding pages with OOB entries
-    excluded = 0
-    for node in graph.nodes.values():
-        for page_type in PageTypes:
-            if node[f"oob_{page_type}"] > 0:
-                excluded += 1
-                node[str(page_type)] = False
-    print(f"Removed {excluded} designations due to OOB entries.")
-    pruned = prune_designations(graph, pages)
-    print(f"Prune removed {pruned} designations.")
-
-    # Applying the "kernel mapping similarity" filter
-
-    print("Transferring designations to snapshot data")
-    for offset, node in graph.nodes.items():
-        pages[int(offset)].designations = set(type for type in PageTypes if node[str(type)])
+    if input_path.suffix not in {".json", ".graphml", DESIGNATIONS_SUFFIX, GRAPH_SUFFIX, ""}:
+        raise ValueError(
+            f"Invalid extension for input files path. "
+            f"Must be either .json, {DESIGNATIONS_SUFFIX}, .graphml, {GRAPH_SUFFIX} or none."
+        )
 
-    pml4_scores = pml4_kernel_mapping_similarity(pages)
-    removed = 0
-    for page_offset, score in pml4_scores.items():
-        if score < 0.8:
-            removed += 1
-            graph.nodes[str(page_offset)][str(PageTypes.PML4)] = False
+    in_pages_path = resolve_pages_path(input_path)
+    in_graph_path = resolve_graph_path(input_path)
+    out_pages_path = input_path.with_stem(input_path.stem + "_filtered").with_suffix(DESIGNATIONS_SUFFIX)
+    out_graph_path = out_pages_path.with_suffix(GRAPH_SUFFIX)
 
-    print(f"Removed {removed} PML4 designations based on kernel part similarities.")
-    pruned = prune_designations(graph, pages)
-    print(f"Prune removed {pruned} designations.")
+    instrumentation.log(f"Loading graph: {in_graph_path}")
+    graph = load_graph(in_graph_path)
 
-    # Syncing and saving
+    instrumentation.log(f"Loading pages: {in_pages_path}")
+    snapshot = load_snapshot(in_pages_path)
 
-    print("Transferring designations to snapshot data")
-    for offset, node in graph.nodes.items():
-        pages[int(offset)].designations = set(type for type in PageTypes if node[str(type)])
+    graph = apply_filters(graph, snapshot)
 
-    print(f"Saving pages: {out_pages_path}")
-    with open(out_pages_path, "w") as f:
-        f.write(snapshot.json())
+    instrumentation.log(f"Saving pages: {out_pages_path}")
+    save_snapshot(snapshot, out_pages_path, export_json=args.json)
 
-    print(f"Saving graph: {out_graph_path}")
-    nx.readwrite.write_graphml(graph, out_graph_path)
+    instrumentation.log(f"Saving graph: {out_graph_path}")
+    save_graph(graph, out_graph_path, export_graphml=args.graphml)
 
-print("Done")
+    instrumentation.log("Done")
@@ -0,0 +1,417 @@
+"""
+Incremental re-analysis of snapshots of the same machine. The state of an analysis is a page graph of all pages (like
+extract_all_pages) whose node data additionally holds a content hash of every page, the bounded path lengths, entry
+flags and possible types of determine_types and the pruned designations (like prune_designations).
+Given the state of a previous snapshot, reanalyze only rescans the pages whose hashes changed, splices their edges into
+the graph and updates path lengths, possible types and pruned designations in the neighbourhood of the changes.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGE_TYPES_ORDERED,
+    PAGING_STRUCTURE_SIZE,
+    max_page_addr,
+    next_type,
+    prev_type,
+    entries_target_is_data,
+)
+from paging_detection import instrumentation
+from paging_detection.compressed import snapshot_stem
+from paging_detection.determine_types import (
+    SUCCESSOR_DATA_TYPES,
+    bounded_path_lengths,
+    get_entry_flags,
+    possible_types,
+)
+from paging_detection.extract_all_pages import build_page_graph, scan_pages
+from paging_detection.filters import prune_designations
+from paging_detection.mmaped import (
+    DesignationStore,
+    MemMappedSnapshot,
+    DESIGNATIONS_SUFFIX,
+    entry_hashes,
+    save_snapshot,
+)
+from paging_detection.page_graph import PageGraph, index_dtype, GRAPH_SUFFIX, load_graph, save_graph
+from paging_detection.physical import physical_size
+
+STAGE_SUFFIX = "_incremental"
+
+HASH_KEY = "hash"
+MAX_INBOUND_KEY = "max_inbound"
+MAX_OUTBOUND_KEY = "max_outbound"
+
+# Longest paths considered by determine_types
+MAX_PATH_LEN = len(PageTypes) - 1
+
+
+def possible_key(page_type: PageTypes) -> str:
+    return f"possible_{page_type}"
+
+
+def page_hashes(snapshot: MemMappedSnapshot, start: int, stop: int) -> np.ndarray:
+    """
+    64 bit content hashes (not cryptographic) of all pages with physical addresses in [start, stop).
+    """
+    return entry_hashes(snapshot.page_entries(start, stop))
+
+
+def hash_pages(snapshot: MemMappedSnapshot, max_paddr: int) -> np.ndarray:
+    """
+    Content hashes of all pages up to max_paddr, indexed by page number.
+    """
+    end = max_paddr + PAGING_STRUCTURE_SIZE
+    chunk_size = CHUNK_PAGES * PAGING_STRUCTURE_SIZE
+    hashes = []
+    for start in range(0, end, chunk_size):
+        instrumentation.progress(start / end)
+        hashes.append(page_hashes(snapshot, start, min(start + chunk_size, end)))
+    instrumentation.count("pages", end // PAGING_STRUCTURE_SIZE)
+    return np.concatenate(hashes)
+
+
+def _store_entry_flags(graph: PageGraph, snapshot: MemMappedSnapshot, idx: np.ndarray):
+    """
+    Store the entry flags (see get_entry_flags) of the nodes idx in the node data ("<flag>_<type>").
+    """
+    for flag, by_type in get_entry_flags(snapshot, graph.nodes[idx]).items():
+        for page_type, values in by_type.items():
+            graph.node_data.setdefault(f"{flag}_{page_type}", np.zeros(graph.number_of_nodes(), dtype=bool))
+            graph.node_data[f"{flag}_{page_type}"][idx] = values
+
+
+def _update_possible_types(graph: PageGraph, idx: np.ndarray) -> int:
+    """
+    Apply the rules of determine_types to the nodes idx, using the path lengths and entry flags in the node data.
+    :return: Number of avoided designations.
+    """
+    flags = {
+        flag: {t: graph.node_data[f"{flag}_{t}"][idx] for t in types}
+        for flag, types in (("valid", PAGE_TYPES_ORDERED[:-1]), ("data", (PageTypes.PDP, PageTypes.PD)))
+    }
+    successors = graph.targets[graph.out_edges_of(idx)]
+    owners = np.repeat(np.arange(len(idx)), graph.out_degree[idx])
+    suc_has_data = {}
+    for page_type, suc_type in SUCCESSOR_DATA_TYPES:
+        suc_has_data[page_type] = np.zeros(len(idx), dtype=bool)
+        suc_has_data[page_type][owners[graph.node_data[f"data_{suc_type}"][successors]]] = True
+
+    max_inbound = graph.node_data[MAX_INBOUND_KEY][idx]
+    max_outbound = graph.node_data[MAX_OUTBOUND_KEY][idx]
+    possible, designations_avoided = possible_types(max_inbound, max_outbound, flags, suc_has_data)
+    for page_type, has_type in possible.items():
+        graph.node_data.setdefault(possible_key(page_type), np.zeros(graph.number_of_nodes(), dtype=bool))
+        graph.node_data[possible_key(page_type)][idx] = has_type
+    return designations_avoided
+
+
+@instrumentation.span("analyze")
+def analyze(snapshot: MemMappedSnapshot, max_paddr: int, jobs: int = 1) -> PageGraph:
+    """
+    Analyze a snapshot from scratch, like build_page_graph, determine_possible_types and prune_designations.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param jobs: Number of processes scanning the snapshot.
+    :return: Graph of all pages, with the state of the analysis in its node data (see module docstring).
+    """
+    graph = build_page_graph(snapshot, max_paddr=max_paddr, jobs=jobs)
+    every_node = np.arange(graph.number_of_nodes())
+    with instrumentation.span("hash"):
+        graph.node_data[HASH_KEY] = hash_pages(snapshot, max_paddr)
+    with instrumentation.span("determine_types"):
+        graph.node_data[MAX_INBOUND_KEY] = bounded_path_lengths(graph, max_len=MAX_PATH_LEN, direction="in")
+        graph.node_data[MAX_OUTBOUND_KEY] = bounded_path_lengths(graph, max_len=MAX_PATH_LEN, direction="out")
+        _store_entry_flags(graph, snapshot, every_node)
+        designations_avoided = _update_possible_types(graph, every_node)
+        instrumentation.count("pages", graph.number_of_nodes())
+        instrumentation.count("designations_avoided", designations_avoided)
+    for page_type in PageTypes:
+        graph.node_data[str(page_type)] = graph.node_data[possible_key(page_type)].copy()
+    prune_designations(graph, snapshot)
+    return graph
+
+
+def _split_by_chunk(pages: np.ndarray) -> List[Tuple[int, np.ndarray]]:
+    """
+    Group sorted page numbers by the scan chunk (of CHUNK_PAGES pages) they are in.
+    :return: (chunk number, page numbers relative to the chunk start) for every chunk with pages in it.
+    """
+    chunk_ids = pages // CHUNK_PAGES
+    groups = np.split(pages, np.flatnonzero(np.diff(chunk_ids)) + 1)
+    return [(int(group[0]) // CHUNK_PAGES, group % CHUNK_PAGES) for group in groups if len(group)]
+
+
+def _patch_graph(
+    previous: PageGraph, snapshot: MemMappedSnapshot, changed: np.ndarray, max_paddr: int
+) -> Tuple[PageGraph, np.ndarray]:
+    """
+    Rescan the changed pages and replace their outbound edges and invalid / oob counts.
+    The edge arrays and the permutation sorting them by target are spliced, not sorted again.
+    :return: The patched graph and the (unique) targets of all removed and added edges.
+    """
+    node_data = {key: np.array(column) for key, column in previous.node_data.items()}
+    end = max_paddr + PAGING_STRUCTURE_SIZE
+    added_sources, added_targets = [np.zeros(0, dtype=np.uint64)], [np.zeros(0, dtype=np.uint64)]
+    added_offsets = [np.zeros(0, dtype=np.uint16)]
+    for chunk, rows in _split_by_chunk(changed):
+        start = chunk * CHUNK_PAGES * PAGING_STRUCTURE_SIZE
+        stop = min(start + CHUNK_PAGES * PAGING_STRUCTURE_SIZE, end)
+        sources, targets, offsets, counts = scan_pages(snapshot, start, stop, max_paddr, rows)
+        added_sources.append(sources)
+        added_targets.append(targets)
+        added_offsets.append(offsets)
+        for key, count in counts.items():
+            node_data[key][chunk * CHUNK_PAGES + rows] = count[rows]
+
+    idx_type = index_dtype(previous.number_of_nodes())
+    # Nodes are all pages in order, so a nodes index is its address divided by the page size.
+    add_sources = (np.concatenate(added_sources) // PAGING_STRUCTURE_SIZE).astype(idx_type)
+    add_targets = (np.concatenate(added_targets) // PAGING_STRUCTURE_SIZE).astype(idx_type)
+    add_offsets = np.concatenate(added_offsets)
+    instrumentation.count("edges", len(add_sources))
+
+    keep = np.ones(previous.number_of_edges(), dtype=bool)
+    keep[previous.out_edges_of(changed)] = False
+    removed_targets = previous.targets[~keep]
+    # The changed pages have no edges left, their new edges go where the old ones were.
+    kept_sources = previous.sources[keep]
+    positions = np.searchsorted(kept_sources, add_sources)
+    sources = np.insert(kept_sources, positions, add_sources)
+    targets = np.insert(previous.targets[keep], positions, add_targets)
+    offsets = np.insert(previous.offsets[keep], positions, add_offsets)
+    graph = PageGraph(np.array(previous.nodes), sources, targets, offsets, node_data, check_order=False)
+
+    # Edges sorted by target are sorted by id among edges with the same target. Kept edges stay in order, new edges are
+    # merged in by (target, id).
+    kept_index = np.cumsum(keep) - 1
+    kept_in_order = np.asarray(previous.in_order)
+    kept_in_order = kept_index[kept_in_order[keep[kept_in_order]]]
+    kept_in_order += np.searchsorted(positions, kept_in_order, side="right")
+    add_ids = positions + np.arange(len(positions))
+    by_target = np.lexsort((add_ids, add_targets))
+    num_edges = np.uint64(len(sources))
+    kept_keys = targets[kept_in_order].astype(np.uint64) * num_edges + kept_in_order.astype(np.uint64)
+    add_keys = add_targets[by_target].astype(np.uint64) * num_edges + add_ids[by_target].astype(np.uint64)
+    insert_at = np.searchsorted(kept_keys, add_keys)
+    graph.in_order = np.insert(kept_in_order, insert_at, add_ids[by_target]).astype(index_dtype(len(sources)))
+
+    return graph, np.unique(np.concatenate((removed_targets, add_targets)))
+
+
+def _update_path_lengths(graph: PageGraph, lengths: np.ndarray, seeds: np.ndarray, direction: str) -> np.ndarray:
+    """
+    Update bounded path lengths (see bounded_path_lengths) after edges changed.
+    Inbound path lengths can only change for nodes within MAX_PATH_LEN - 1 hops downstream of the targets of changed
+    edges, outbound path lengths for nodes within as many hops upstream of their sources. Only these nodes are
+    recomputed, level by level like in bounded_path_lengths, using the known lengths of the nodes around them.
+    :param graph: The graph after the change.
+    :param lengths: Path lengths before the change, updated in place.
+    :param seeds: Targets (for direction "in") or sources (for direction "out") of all changed edges.
+    :return: Indices of the recomputed nodes.
+    """
+    if direction == "in":
+        forward, ahead = graph.out_edges_of, graph.targets
+        backward, behind, degree = graph.in_edges_of, graph.sources, graph.in_degree
+    else:
+        forward, ahead = graph.in_edges_of, graph.sources
+        backward, behind, degree = graph.out_edges_of, graph.targets, graph.out_degree
+
+    region = frontier = np.unique(seeds)
+    for _ in range(MAX_PATH_LEN - 1):
+        frontier = np.setdiff1d(ahead[forward(frontier)], region)
+        region = np.union1d(region, frontier)
+
+    neighbours = behind[backward(region)]
+    owners = np.repeat(np.arange(len(region)), degree[region])
+    pos = np.minimum(np.searchsorted(region, neighbours), max(len(region) - 1, 0))
+    inside = region[pos] == neighbours if len(region) else np.zeros(0, dtype=bool)
+    has_path = np.ones(len(region), dtype=bool)  # Every node has a path of length 0
+    new_lengths = np.zeros(len(region), dtype=lengths.dtype)
+    for level in range(1, MAX_PATH_LEN + 1):
+        neighbour_has_path = np.where(inside, has_path[pos], lengths[neighbours] >= level - 1)
+        next_has_path = np.zeros_like(has_path)
+        next_has_path[owners[neighbour_has_path]] = True
+        if not next_has_path.any():
+            break
+        new_lengths += next_has_path
+        has_path = next_has_path
+    lengths[region] = new_lengths
+    return region
+
+
+def _neighbours(graph: PageGraph, idx: np.ndarray) -> np.ndarray:
+    return np.union1d(graph.targets[graph.out_edges_of(idx)], graph.sources[graph.in_edges_of(idx)])
+
+
+def _regain(graph: PageGraph, designations: Dict[PageTypes, np.ndarray], seeds: np.ndarray) -> np.ndarray:
+    """
+    Restore possible designations which might be supported again after a change.
+    Starting from the possible types of the seeds, designations of neighbours with a matching type (successors with
+    the next type, predecessors with the previous type) are restored until nothing changes. Every designation the
+    (new) pruned result can have, but the previous one did not, is connected to the seeds this way.
+    :return: Indices of the nodes with restored designations.
+    """
+    possible = {t: graph.node_data[possible_key(t)] for t in PageTypes}
+    queue = {t: seeds[possible[t][seeds]] for t in PageTypes}
+    restored = []
+    while any(len(nodes) for nodes in queue.values()):
+        next_queue: Dict[PageTypes, List[np.ndarray]] = {t: [] for t in PageTypes}
+        for page_type, idx in queue.items():
+            designations[page_type][idx] = True
+            restored.append(idx)
+            neighbours = []
+            if page_type != PageTypes.PT:
+                neighbours.append((next_type(page_type), graph.targets[graph.out_edges_of(idx)]))
+            if page_type != PageTypes.PML4:
+                neighbours.append((prev_type(page_type), graph.sources[graph.in_edges_of(idx)]))
+            for neighbour_type, nodes in neighbours:
+                nodes = np.unique(nodes[possible[neighbour_type][nodes] & ~designations[neighbour_type][nodes]])
+                designations[neighbour_type][nodes] = True
+                next_queue[neighbour_type].append(nodes)
+        queue = {t: np.unique(np.concatenate(nodes)) for t, nodes in next_queue.items() if nodes}
+    return np.unique(np.concatenate(restored)) if restored else np.zeros(0, dtype=np.int64)
+
+
+def _prune_locally(
+    graph: PageGraph, snapshot: MemMappedSnapshot, designations: Dict[PageTypes, np.ndarray], pending: np.ndarray
+) -> int:
+    """
+    Like DesignationPruner.prune, but only checks the pending nodes and the neighbours of nodes that lost a
+    designation. The support of every checked node is counted from its edges, so no counters for the whole graph are
+    needed.
+    :return: Number of removed designations.
+    """
+    removed = 0
+    while len(pending):
+        dropped = []
+        for page_type in PageTypes:
+            idx = pending[designations[page_type][pending]]
+            if page_type == PageTypes.PT:
+                supported = graph.out_degree[idx] > 0
+            else:
+                edges = graph.out_edges_of(idx)
+                owners = np.repeat(np.arange(len(idx)), graph.out_degree[idx])
+                entries = snapshot.gather_entries(graph.nodes[graph.sources[edges]] + graph.offsets[edges])
+                supporting = designations[next_type(page_type)][graph.targets[edges]]
+                supporting |= entries_target_is_data(entries, page_type)
+                supported = np.zeros(len(idx), dtype=bool)
+                supported[owners[supporting]] = True
+            if page_type != PageTypes.PML4:
+                owners = np.repeat(np.arange(len(idx)), graph.in_degree[idx])
+                supporting = designations[prev_type(page_type)][graph.sources[graph.in_edges_of(idx)]]
+                has_pred = np.zeros(len(idx), dtype=bool)
+                has_pred[owners[supporting]] = True
+                supported &= has_pred
+            drop = idx[~supported]
+            designations[page_type][drop] = False
+            removed += len(drop)
+            dropped.append(drop)
+        pending = _neighbours(graph, np.unique(np.concatenate(dropped)))
+    return removed
+
+
+@instrumentation.span("reanalyze")
+def reanalyze(previous: PageGraph, snapshot: MemMappedSnapshot, max_paddr: int, jobs: int = 1) -> PageGraph:
+    """
+    Analyze a snapshot, reusing the state of the analysis of a previous snapshot of the same machine.
+    The result equals analyze(snapshot, max_paddr), but only the pages whose content changed are scanned and only
+    their neighbourhood is checked again. (The whole snapshot is read once to hash its pages.)
+    :param previous: Result of analyze / reanalyze for the previous snapshot.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param jobs: Number of processes scanning the snapshot, if it has to be analyzed from scratch.
+    :return: Graph of all pages, with the state of the analysis in its node data.
+    """
+    num_pages = max_paddr // PAGING_STRUCTURE_SIZE + 1
+    if previous.number_of_nodes() != num_pages or HASH_KEY not in previous.node_data:
+        instrumentation.log("Previous state does not match the snapshot, analyzing from scratch.")
+        return analyze(snapshot, max_paddr, jobs)
+
+    with instrumentation.span("hash"):
+        hashes = hash_pages(snapshot, max_paddr)
+    changed = np.flatnonzero(hashes != previous.node_data[HASH_KEY])
+    instrumentation.count("pages", len(changed))
+    instrumentation.log(f"{len(changed)} of {num_pages} pages changed.")
+
+    with instrumentation.span("patch_graph"):
+        graph, changed_targets = _patch_graph(previous, snapshot, changed, max_paddr)
+        graph.node_data[HASH_KEY] = hashes
+
+    with instrumentation.span("update_types"):
+        inbound = _update_path_lengths(graph, graph.node_data[MAX_INBOUND_KEY], changed_targets, "in")
+        outbound = _update_path_lengths(graph, graph.node_data[MAX_OUTBOUND_KEY], changed, "out")
+        # The entry flags of the changed pages changed, which affects the successor rules of their predecessors.
+        predecessors = graph.sources[graph.in_edges_of(changed)]
+        region = np.unique(np.concatenate((changed, inbound, outbound, predecessors)))
+        _store_entry_flags(graph, snapshot, changed)
+        _update_possible_types(graph, region)
+        instrumentation.count("pages", len(region))
+
+    with instrumentation.span("prune"):
+        designations = {t: graph.node_data[str(t)] for t in PageTypes}
+        for page_type in PageTypes:
+            designations[page_type][region] &= graph.node_data[possible_key(page_type)][region]
+        seeds = np.union1d(region, changed_targets)
+        restored = _regain(graph, designations, seeds)
+        pending = np.union1d(np.union1d(seeds, restored), _neighbours(graph, np.union1d(seeds, restored)))
+        removed = _prune_locally(graph, snapshot, designations, pending)
+        instrumentation.count("pages", len(pending))
+        instrumentation.count("designations_removed", removed)
+
+    return graph
+
+
+if __name__ == "__main__":
+    import argparse
+    import pathlib
+
+    parser = argparse.ArgumentParser(
+        description="Analyze a snapshot (extract_all_pages, determine_types and pruning) incrementally, based on the "
+        "analysis of a previous snapshot of the same machine."
+    )
+    parser.add_argument(
+        "in_file",
+        help=f"Path to snapshot. Output files will have the same name with {STAGE_SUFFIX}.[desig|pgraph] appended.",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--previous",
+        help=f"Graph ({STAGE_SUFFIX}{GRAPH_SUFFIX}) of the previous snapshot. Without it, the snapshot is analyzed "
+        "from scratch.",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--jobs", help="Number of processes used to scan the snapshot. (Default: 1)", type=int, default=1
+    )
+    parser.add_argument("--json", help="Additionally export the designations as JSON.", action="store_true")
+    parser.add_argument("--graphml", help="Additionally export the graph as graphml.", action="store_true")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+    dump_path = args.in_file
+    if dump_path.suffix in {".json", ".graphml", DESIGNATIONS_SUFFIX, GRAPH_SUFFIX}:
+        raise ValueError(f"Snapshot has {dump_path.suffix} as extension and would be overwritten by outputs.")
+    out_pages_path = dump_path.with_name(snapshot_stem(dump_path) + STAGE_SUFFIX + DESIGNATIONS_SUFFIX)
+    out_graph_path = out_pages_path.with_suffix(GRAPH_SUFFIX)
+
+    snap_size = physical_size(dump_path)
+    snapshot = MemMappedSnapshot(DesignationStore.create(str(dump_path), snap_size, tracked=True))
+    max_paddr = max_page_addr(snap_size)
+    if args.previous:
+        instrumentation.log(f"Loading previous graph: {args.previous}")
+        graph = reanalyze(load_graph(args.previous), snapshot, max_paddr, jobs=args.jobs)
+    else:
+        graph = analyze(snapshot, max_paddr, jobs=args.jobs)
+    snapshot.designations.set_designations(graph.nodes, {t: graph.node_data[str(t)] for t in PageTypes})
+
+    instrumentation.log(f"Saving graph: {out_graph_path}")
+    save_graph(graph, out_graph_path, export_graphml=args.graphml)
+
+    instrumentation.log(f"Saving pages: {out_pages_path}")
+    save_snapshot(snapshot, out_pages_path, export_json=args.json)
+
+    instrumentation.log("Done")
@@ -0,0 +1,275 @@
+"""
+Instrumentation of the pipeline stages. Stage functions open (nested) spans, count what they process within them and log
+messages and progress through this module instead of printing. Collectors receive these events, e.g. to print them
+(ProgressCollector, the default) or to write them as JSON lines (JsonLinesCollector). Own collectors can be plugged in
+with add_collector.
+
+    with instrumentation.span("extract_all_pages"):
+        ...
+        instrumentation.count("pages", len(pages))
+        instrumentation.progress(done / total)
+
+When a span ends, its collectors get its duration, counters, throughput (counter per second) and the peak RSS.
+"""
+import atexit
+from contextlib import contextmanager
+import json
+import sys
+import time
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Not available on windows
+    resource = None
+
+# Counters whose throughput ProgressCollector reports
+THROUGHPUT_COUNTERS = ("pages", "entries", "edges")
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Peak resident set size of the current process in bytes, None if unknown.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Span:
+    """
+    A timed section of a stage. Counters are summed up while the span is open.
+    """
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.counters: Dict[str, float] = {}
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.peak_rss: Optional[int] = None
+
+    @property
+    def path(self) -> str:
+        """
+        Names of the span and its parents, separated by "/".
+        """
+        return self.name if self.parent is None else f"{self.parent.path}/{self.name}"
+
+    @property
+    def seconds(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def rates(self) -> Dict[str, float]:
+        """
+        Throughput of all counters, e.g. "pages/s".
+        """
+        seconds = self.seconds
+        return {f"{name}/s": value / seconds for name, value in self.counters.items() if seconds > 0}
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "span": self.path,
+            "seconds": self.seconds,
+            "counters": self.counters,
+            "rates": self.rates(),
+            "peak_rss": self.peak_rss,
+            **self.attrs,
+        }
+
+
+class Collector:
+    """
+    Base class of collectors, all hooks do nothing by default.
+    """
+
+    def span_started(self, span: Span):
+        pass
+
+    def span_finished(self, span: Span):
+        pass
+
+    def message(self, span: Optional[Span], text: str):
+        pass
+
+    def progress(self, span: Optional[Span], fraction: float):
+        pass
+
+
+class ProgressCollector(Collector):
+    """
+    Prints messages, progress in steps of 5 % and a summary (duration, counters, throughput of THROUGHPUT_COUNTERS and
+    peak RSS) of every finished span.
+    """
+
+    def __init__(self, file: IO = None, step: int = 5):
+        self.file = file
+        self.step = step
+        self._last_progress: Dict[int, int] = {}
+
+    def _print(self, text: str):
+        print(text, file=self.file or sys.stdout)
+
+    def span_finished(self, span: Span):
+        self._last_progress.pop(id(span), None)
+        details = [f"{span.seconds:.2f}s"]
+        details += [f"{value:g} {name}" for name, value in span.counters.items()]
+        rates = span.rates()
+        details += [f"{rates[f'{name}/s']:,.0f} {name}/s" for name in THROUGHPUT_COUNTERS if f"{name}/s" in rates]
+        if span.peak_rss is not None:
+            details.append(f"peak RSS {span.peak_rss / 2 ** 20:.0f} MiB")
+        self._print(f"[{span.path}] " + ", ".join(details))
+
+    def message(self, span: Optional[Span], text: str):
+        self._print(text)
+
+    def progress(self, span: Optional[Span], fraction: float):
+        percent = int(100 * fraction)
+        last = self._last_progress.get(id(span), 0)
+        if percent >= last + self.step:
+            self._last_progress[id(span)] = percent - percent % self.step
+            self._print(f"{percent} % done.")
+
+
+class JsonLinesCollector(Collector):
+    """
+    Writes one JSON object per finished span, message and progress update to a file.
+    """
+
+    def __init__(self, file: IO):
+        self.file = file
+
+    def _write(self, event: str, span: Optional[Span], **data):
+        record = {"event": event, "time": time.time(), "span": span.path if span else None, **data}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def span_finished(self, span: Span):
+        self._write("span", span, **{k: v for k, v in span.as_dict().items() if k != "span"})
+
+    def message(self, span: Optional[Span], text: str):
+        self._write("message", span, text=text)
+
+    def progress(self, span: Optional[Span], fraction: float):
+        self._write("progress", span, fraction=fraction)
+
+    def close(self):
+        self.file.close()
+
+
+class SummaryCollector(Collector):
+    """
+    Keeps the duration of all finished spans (summed up by path), e.g. to print a table of stage timings at the end.
+    """
+
+    def __init__(self, max_depth: Optional[int] = None):
+        """
+        :param max_depth: Only keep spans with at most this many parents.
+        """
+        self.max_depth = max_depth
+        self.timings: Dict[str, float] = {}
+
+    def span_finished(self, span: Span):
+        if self.max_depth is not None and span.path.count("/") > self.max_depth:
+            return
+        self.timings[span.path] = self.timings.get(span.path, 0) + span.seconds
+
+    def summary(self) -> str:
+        top_level = sum(seconds for path, seconds in self.timings.items() if "/" not in path)
+        lines = [f"{path:<40}{seconds:>10.2f}s" for path, seconds in self.timings.items()]
+        return "\n".join(lines + [f"{'total':<40}{top_level:>10.2f}s"])
+
+
+_collectors: List[Collector] = [ProgressCollector()]
+_stack: List[Span] = []
+
+
+def add_collector(collector: Collector):
+    _collectors.append(collector)
+
+
+def remove_collector(collector: Collector):
+    _collectors.remove(collector)
+
+
+def set_collectors(collectors: List[Collector]):
+    """
+    Replace all collectors, e.g. to silence the default ProgressCollector.
+    """
+    _collectors[:] = collectors
+
+
+def current_span() -> Optional[Span]:
+    return _stack[-1] if _stack else None
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    """
+    Open a span nested in the current one. Keyword arguments are passed on to the collectors as attributes.
+    """
+    new_span = Span(name, current_span(), attrs)
+    _stack.append(new_span)
+    for collector in _collectors:
+        collector.span_started(new_span)
+    try:
+        yield new_span
+    finally:
+        _stack.pop()
+        new_span.end = time.perf_counter()
+        new_span.peak_rss = peak_rss()
+        for collector in _collectors:
+            collector.span_finished(new_span)
+
+
+def count(name: str, value: float = 1):
+    """
+    Add value to the counter name of the current span.
+    """
+    if (current := current_span()) is not None:
+        current.counters[name] = current.counters.get(name, 0) + value
+
+
+def log(text: str):
+    for collector in _collectors:
+        collector.message(current_span(), text)
+
+
+def progress(fraction: float):
+    """
+    Report the progress of the current span, between 0 and 1.
+    """
+    for collector in _collectors:
+        collector.progress(current_span(), fraction)
+
+
+def add_arguments(parser):
+    """
+    Add the --metrics-json option to an argparse parser of a script.
+    """
+    parser.add_argument(
+        "--metrics-json",
+        help="Write spans, counters, messages and progress as JSON lines to this file ('-' for stdout, which also "
+        "suppresses the human-readable progress).",
+        metavar="FILE",
+    )
+
+
+def configure(args) -> Tuple[Collector, ...]:
+    """
+    Set up the collectors according to the options added by add_arguments.
+    :return: The added collectors.
+    """
+    if args.metrics_json is None:
+        return ()
+    if args.metrics_json == "-":
+        collector = JsonLinesCollector(sys.stdout)
+        set_collectors([collector])
+    else:
+        collector = JsonLinesCollector(open(args.metrics_json, "a"))
+        atexit.register(collector.close)
+        add_collector(collector)
+    return (collector,)
@@ -0,0 +1,141 @@
+"""
+Detection of KPTI page table pairs. With KPTI (kernel page table isolation), linux allocates the PGD (PML4) of a process
+as an 8 KiB aligned pair of pages: The kernel PGD in the first and the user PGD in the second page. The user PGD maps
+the same user space, the kernel PGD has NX set on these entries. Of the kernel half, the user PGD only maps the few
+entries needed to enter the kernel, which are shared with the kernel PGD.
+The signature is checked for all pairs at once, every detected pair is strong evidence for both pages being PML4s.
+"""
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from paging_detection import (
+    PageTypes,
+    PAGING_STRUCTURE_SIZE,
+    ENTRIES_PER_PAGE,
+    max_page_addr,
+    entries_present,
+    entries_target,
+    entries_valid,
+    entries_without_nx,
+)
+from paging_detection import instrumentation
+from paging_detection.compressed import snapshot_stem
+from paging_detection.mmaped import DesignationStore, MemMappedSnapshot
+from paging_detection.physical import physical_size
+
+PAIRS_SUFFIX = "_kpti_pairs.csv"
+
+# Size and alignment of a pair
+PAIR_SIZE = 2 * PAGING_STRUCTURE_SIZE
+# First slot of the kernel half. Unlike filters.KERNEL_HALF_FIRST_SLOT, slot 256 is not left out: The signature splits
+# the PGDs at the boundary of user and kernel addresses, an entry of the user PGD in slot 256 has to be shared with the
+# kernel PGD like the rest of its kernel half.
+KERNEL_HALF = ENTRIES_PER_PAGE // 2
+
+# Number of pairs inspected at once
+CHUNK_PAIRS = 2 ** 13
+
+
+def kpti_signature(kernel: np.ndarray, user: np.ndarray, max_paddr: int, snapshot: MemMappedSnapshot) -> np.ndarray:
+    """
+    Check the KPTI signature for pairs of pages, see the module docstring:
+        - All present entries of both pages are valid PML4 entries pointing into the snapshot
+        - The user halves are equal, apart from the NX bits (only considering present entries of the user PGD)
+        - The present entries of the kernel half of the user PGD are a non-empty, proper subset of the ones of the
+          kernel PGD
+    :param kernel: Entries of the pages which would be the kernel PGDs, shape (pairs, entries per page).
+    :param user: Entries of the pages which would be the user PGDs, indexed like kernel.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param snapshot: The snapshot.
+    :return: Bool array, indicating which pairs have the signature.
+    """
+    kernel_present, user_present = entries_present(kernel), entries_present(user)
+    plausible = np.ones(len(kernel), dtype=bool)
+    for entries, present in ((kernel, kernel_present), (user, user_present)):
+        targets = entries_target(entries)
+        valid = entries_valid(entries, PageTypes.PML4) & (targets <= max_paddr) & snapshot.in_bounds(targets)
+        plausible &= ~(present & ~valid).any(axis=1)
+
+    user_half_differs = user_present[:, :KERNEL_HALF] & (
+        entries_without_nx(user[:, :KERNEL_HALF] ^ kernel[:, :KERNEL_HALF]) != 0
+    )
+    kernel_half_differs = user_present[:, KERNEL_HALF:] & (user[:, KERNEL_HALF:] != kernel[:, KERNEL_HALF:])
+    shared = user_present[:, KERNEL_HALF:].sum(axis=1)
+    return (
+        plausible
+        & ~user_half_differs.any(axis=1)
+        & ~kernel_half_differs.any(axis=1)
+        & (shared > 0)
+        & (shared < kernel_present[:, KERNEL_HALF:].sum(axis=1))
+    )
+
+
+def _pair_chunks(
+    snapshot: MemMappedSnapshot, max_paddr: int, candidates: Optional[np.ndarray]
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield the addresses of the kernel PGDs and the entries of both pages of pairs in chunks, shaped (pairs, 2, entries
+    per page). With candidates, only pairs of two candidates are read.
+    """
+    if candidates is not None:
+        candidates = np.unique(np.asarray(candidates, dtype=np.uint64))
+        firsts = candidates[(candidates % PAIR_SIZE == 0) & np.isin(candidates + PAGING_STRUCTURE_SIZE, candidates)]
+        for start in range(0, len(firsts), CHUNK_PAIRS):
+            chunk = firsts[start : start + CHUNK_PAIRS]
+            pages = np.stack((chunk, chunk + PAGING_STRUCTURE_SIZE), axis=1).ravel()
+            yield chunk, snapshot.gather_pages(pages).reshape(len(chunk), 2, ENTRIES_PER_PAGE)
+        return
+    # Only complete pairs
+    end = (max_paddr + PAGING_STRUCTURE_SIZE) // PAIR_SIZE * PAIR_SIZE
+    for start in range(0, end, CHUNK_PAIRS * PAIR_SIZE):
+        stop = min(start + CHUNK_PAIRS * PAIR_SIZE, end)
+        entries = snapshot.page_entries(start, stop).reshape(-1, 2, ENTRIES_PER_PAGE)
+        yield np.arange(start, stop, PAIR_SIZE, dtype=np.uint64), entries
+        instrumentation.progress(stop / end)
+
+
+@instrumentation.span("kpti_pairs")
+def find_kpti_pairs(snapshot: MemMappedSnapshot, max_paddr: int, candidates: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Find all 8 KiB aligned pairs of pages with the KPTI signature, see kpti_signature.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param candidates: Physical addresses of candidate PML4s, only pairs of two candidates are checked. Defaults to all
+    pairs in the snapshot.
+    :return: Array of shape (pairs, 2), holding the physical addresses of the kernel and the user PGD of every pair.
+    """
+    kernel_pgds = []
+    for firsts, entries in _pair_chunks(snapshot, max_paddr, candidates):
+        kernel_pgds.append(firsts[kpti_signature(entries[:, 0], entries[:, 1], max_paddr, snapshot)])
+        instrumentation.count("pairs", len(firsts))
+    kernel_pgds = np.concatenate(kernel_pgds) if kernel_pgds else np.zeros(0, dtype=np.uint64)
+    instrumentation.count("kpti_pairs", len(kernel_pgds))
+    return np.stack((kernel_pgds, kernel_pgds + PAGING_STRUCTURE_SIZE), axis=1)
+
+
+if __name__ == "__main__":
+    import argparse
+    import pathlib
+
+    parser = argparse.ArgumentParser(description="Find pairs of kernel and user PGDs of a kernel with KPTI.")
+    parser.add_argument(
+        "in_file",
+        help=f"Path to snapshot. The pairs are saved with the same name with {PAIRS_SUFFIX} appended.",
+        type=pathlib.Path,
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+    dump_path = args.in_file
+    out_path = dump_path.with_name(snapshot_stem(dump_path) + PAIRS_SUFFIX)
+
+    snap_size = physical_size(dump_path)
+    snapshot = MemMappedSnapshot(DesignationStore.create(str(dump_path), snap_size))
+    pairs = find_kpti_pairs(snapshot, max_page_addr(snap_size))
+
+    # Same columns as the output of the pslist_with_pgds volatility plugin
+    instrumentation.log(f"Found {len(pairs)} KPTI pairs.")
+    instrumentation.log(f"Saving pairs: {out_path}")
+    pd.DataFrame(pairs, columns=["phy_pgd_kernel", "phy_pgd_user"]).to_csv(out_path, index=False)
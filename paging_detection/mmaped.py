@@ -1,11 +1,29 @@
-import mmap
-from functools import cached_property
+from collections.abc import MutableMapping, MutableSet
+import json
+import os
+import pathlib
 import struct
-from typing import Dict, Set, Iterable, Tuple, Union, List
+from functools import cached_property
+from typing import Dict, Set, Iterable, Tuple, Union, List, Optional, Iterator
 
+import numpy as np
 from pydantic import BaseModel
 
-from paging_detection import PageTypes, PAGING_STRUCTURE_SIZE, PAGING_ENTRY_SIZE, PagingEntry
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGE_TYPES_ORDERED,
+    PAGING_STRUCTURE_SIZE,
+    PAGING_ENTRY_SIZE,
+    ENTRIES_PER_PAGE,
+    PagingEntry,
+    entries_present,
+    entries_target,
+    entries_valid,
+    entries_target_is_data,
+    entries_large_page,
+)
+from paging_detection.physical import PhysicalLayer, open_layer, physical_size
 
 
 class SnapshotPagingData(BaseModel):
@@ -13,49 +31,338 @@ class SnapshotPagingData(BaseModel):
     designations: Dict[int, Set[PageTypes]]
 
 
+# Bits representing the page types in a designation mask
+DESIGNATION_BITS = {t: np.uint8(1 << i) for i, t in enumerate(PAGE_TYPES_ORDERED)}
+# Set for every page that is part of a DesignationStore, i.e. "has a (possibly empty) set of designations"
+TRACKED_BIT = np.uint8(1 << 7)
+
+DESIGNATIONS_SUFFIX = ".desig"
+_STORE_MAGIC = b"NOPGDDSG"
+_STORE_VERSION = 1
+# magic, version, header length, snapshot size, length of the snapshot path (which follows the header)
+_STORE_HEADER = struct.Struct("<8sIIQI")
+
+
+class PageDesignations(MutableSet):
+    """
+    The designations of a single page in a DesignationStore. Behaves like a set of PageTypes and writes through.
+    """
+
+    def __init__(self, masks: np.ndarray, index: int):
+        self.masks = masks
+        self.index = index
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, page_type) -> bool:
+        return page_type in DESIGNATION_BITS and bool(self.masks[self.index] & DESIGNATION_BITS[page_type])
+
+    def __iter__(self) -> Iterator[PageTypes]:
+        mask = self.masks[self.index]
+        return iter([t for t, bit in DESIGNATION_BITS.items() if mask & bit])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def add(self, page_type: PageTypes):
+        self.masks[self.index] |= DESIGNATION_BITS[page_type]
+
+    def discard(self, page_type: PageTypes):
+        self.masks[self.index] &= ~DESIGNATION_BITS[page_type]
+
+    def __repr__(self):
+        return repr(set(self))
+
+
+class DesignationStore(MutableMapping):
+    """
+    Compact alternative to SnapshotPagingData. Stores one uint8 mask (see DESIGNATION_BITS and TRACKED_BIT) per page of
+    the snapshot. Behaves like a dict mapping page addresses to sets of designations, only pages with the TRACKED_BIT
+    set are "in" the dict.
+    On disk, a small header (snapshot path and size) is followed by the masks, so they can be memory mapped on load.
+    """
+
+    def __init__(self, path: str, size: int, masks: np.ndarray):
+        """
+        :param path: Path of the snapshot.
+        :param size: Size of the snapshot.
+        :param masks: One mask per page in the snapshot.
+        """
+        self.path = path
+        self.size = size
+        self.masks = masks
+
+    @staticmethod
+    def num_pages(size: int) -> int:
+        return -(-size // PAGING_STRUCTURE_SIZE)
+
+    @classmethod
+    def create(cls, path: str, size: Optional[int] = None, tracked: bool = False) -> "DesignationStore":
+        """
+        Create an empty store.
+        :param path: Path of the snapshot.
+        :param size: Size of the snapshot, defaults to the size of the physical address space of the file at path.
+        :param tracked: Whether all pages should be in the store (with no designations) or none.
+        """
+        size = physical_size(path) if size is None else size
+        masks = np.full(cls.num_pages(size), TRACKED_BIT if tracked else 0, dtype=np.uint8)
+        return cls(path, size, masks)
+
+    @classmethod
+    def from_paging_data(cls, data: SnapshotPagingData, size: Optional[int] = None) -> "DesignationStore":
+        """
+        Import designations from SnapshotPagingData (e.g. loaded from JSON).
+        :param size: Size of the snapshot, defaults to the size of the file at data.path.
+        """
+        if size is None and not os.path.exists(data.path):
+            # Snapshot not available (e.g. analysing results elsewhere), the designated pages are all we know about.
+            size = max(data.designations, default=-PAGING_STRUCTURE_SIZE) + PAGING_STRUCTURE_SIZE
+        store = cls.create(data.path, size)
+        for addr, designations in data.designations.items():
+            store[addr] = designations
+        return store
+
+    def to_paging_data(self) -> SnapshotPagingData:
+        return SnapshotPagingData(path=self.path, designations={addr: set(desigs) for addr, desigs in self.items()})
+
+    @classmethod
+    def load(cls, file: Union[str, pathlib.Path], mode: str = "c") -> "DesignationStore":
+        """
+        Load a store from disk without reading the masks, they are memory mapped.
+        :param mode: numpy.memmap mode, by default changes are kept in memory and not written back to the file.
+        """
+        with open(file, "rb") as f:
+            magic, version, header_len, size, path_len = _STORE_HEADER.unpack(f.read(_STORE_HEADER.size))
+            if magic != _STORE_MAGIC or version != _STORE_VERSION:
+                raise ValueError(f"{file} is not a designation store (version {_STORE_VERSION}).")
+            path = f.read(path_len).decode()
+        masks = np.memmap(file, dtype=np.uint8, mode=mode, offset=header_len, shape=(cls.num_pages(size),))
+        return cls(path, size, masks)
+
+    def save(self, file: Union[str, pathlib.Path]):
+        path = self.path.encode()
+        header_len = _STORE_HEADER.size + len(path)
+        # Pad the header to a multiple of the page size, so the masks can be mapped at an aligned offset.
+        header_len += -header_len % PAGING_STRUCTURE_SIZE
+        with open(file, "wb") as f:
+            f.write(_STORE_HEADER.pack(_STORE_MAGIC, _STORE_VERSION, header_len, self.size, len(path)))
+            f.write(path)
+            f.write(bytes(header_len - _STORE_HEADER.size - len(path)))
+            f.write(np.ascontiguousarray(self.masks).data)
+
+    @property
+    def designations(self) -> "DesignationStore":
+        # Allows using a store wherever SnapshotPagingData is used
+        return self
+
+    def json(self) -> str:
+        return self.to_paging_data().json()
+
+    def _index(self, addr: int) -> int:
+        if addr % PAGING_STRUCTURE_SIZE != 0 or not 0 <= addr < len(self.masks) * PAGING_STRUCTURE_SIZE:
+            raise KeyError(addr)
+        return addr // PAGING_STRUCTURE_SIZE
+
+    def __getitem__(self, addr: int) -> PageDesignations:
+        index = self._index(addr)
+        if not self.masks[index] & TRACKED_BIT:
+            raise KeyError(addr)
+        return PageDesignations(self.masks, index)
+
+    def __setitem__(self, addr: int, designations: Iterable[PageTypes]):
+        mask = TRACKED_BIT
+        for page_type in designations:
+            mask |= DESIGNATION_BITS[page_type]
+        self.masks[self._index(addr)] = mask
+
+    def __delitem__(self, addr: int):
+        index = self._index(addr)
+        if not self.masks[index] & TRACKED_BIT:
+            raise KeyError(addr)
+        self.masks[index] = 0
+
+    def __contains__(self, addr) -> bool:
+        try:
+            return bool(self.masks[self._index(addr)] & TRACKED_BIT)
+        except (KeyError, TypeError):
+            return False
+
+    def addresses(self, page_type: Optional[PageTypes] = None) -> np.ndarray:
+        """
+        Addresses of all pages in the store, or only the ones designated as page_type.
+        """
+        return np.flatnonzero(self.type_mask(page_type)).astype(np.uint64) * PAGING_STRUCTURE_SIZE
+
+    def type_mask(self, page_type: Optional[PageTypes] = None) -> np.ndarray:
+        """
+        Bool array with one value per page, indicating whether it is in the store or designated as page_type.
+        """
+        return (self.masks & (TRACKED_BIT if page_type is None else DESIGNATION_BITS[page_type])).astype(bool)
+
+    def set_designations(self, addrs: np.ndarray, designations: Dict[PageTypes, np.ndarray]):
+        """
+        Replace the designations of many pages at once. The pages are added to the store if necessary.
+        :param addrs: Page addresses.
+        :param designations: Maps every page type to a bool array, indicating which pages have that designation.
+        """
+        masks = np.full(len(addrs), TRACKED_BIT, dtype=np.uint8)
+        for page_type, has_type in designations.items():
+            masks[has_type] |= DESIGNATION_BITS[page_type]
+        self.masks[np.asarray(addrs, dtype=np.uint64) // PAGING_STRUCTURE_SIZE] = masks
+
+    def add_designation(self, addrs: np.ndarray, page_type: PageTypes):
+        """
+        Add page_type to the designations of many pages at once, keeping their other designations. The pages are added
+        to the store if necessary.
+        """
+        index = np.asarray(addrs, dtype=np.uint64) // PAGING_STRUCTURE_SIZE
+        self.masks[index] |= TRACKED_BIT | DESIGNATION_BITS[page_type]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.addresses().tolist())
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.masks & TRACKED_BIT))
+
+
+# splitmix64 finalizer constants
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """
+    Elementwise splitmix64 finalizer. (uint64 arithmetic wraps around, which is intended.)
+    """
+    values = values ^ (values >> np.uint64(30))
+    values *= _MIX_1
+    values ^= values >> np.uint64(27)
+    values *= _MIX_2
+    values ^= values >> np.uint64(31)
+    return values
+
+
+# Every entry slot is mixed with its own key, so swapping entries changes the hash.
+_SLOT_KEYS = _mix(np.arange(1, ENTRIES_PER_PAGE + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+
+def entry_hashes(entries: np.ndarray, first_slot: int = 0) -> np.ndarray:
+    """
+    64 bit content hashes (not cryptographic) of every row of entries, e.g. pages or a range of slots of pages.
+    :param entries: Array of shape (rows, slots) holding the entries of the slots [first_slot, first_slot + slots).
+    :param first_slot: Slot of the first column.
+    """
+    return _mix(entries ^ _SLOT_KEYS[first_slot : first_slot + entries.shape[1]]).sum(axis=1, dtype=np.uint64)
+
+
+class PresentEntryIndex:
+    """
+    Slots of the present entries of a fixed set of pages in CSR style: The present slots of the page addrs[i] are
+    slots[indptr[i] : indptr[i + 1]]. Built once with a pass over the pages, see PagesView.
+    """
+
+    __slots__ = ("addrs", "indptr", "slots")
+
+    def __init__(self, addrs: np.ndarray, indptr: np.ndarray, slots: np.ndarray):
+        self.addrs = addrs
+        self.indptr = indptr
+        self.slots = slots
+
+    @classmethod
+    def build(cls, snapshot: "MemMappedSnapshot", addrs: np.ndarray) -> "PresentEntryIndex":
+        """
+        :param snapshot: The snapshot.
+        :param addrs: Sorted page addresses.
+        """
+        counts, slots = [], []
+        for start in range(0, len(addrs), CHUNK_PAGES):
+            present = entries_present(snapshot.gather_pages(addrs[start : start + CHUNK_PAGES]))
+            counts.append(present.sum(axis=1))
+            slots.append(np.nonzero(present)[1].astype(np.uint16))
+        indptr = np.zeros(len(addrs) + 1, dtype=np.int64)
+        if counts:
+            indptr[1:] = np.cumsum(np.concatenate(counts))
+        return cls(addrs, indptr, np.concatenate(slots) if slots else np.zeros(0, dtype=np.uint16))
+
+    def present_slots(self, addr: int) -> Optional[np.ndarray]:
+        """
+        Slots of the present entries of the page at addr, None if the page is not part of the index.
+        """
+        row = int(np.searchsorted(self.addrs, addr))
+        if row == len(self.addrs) or self.addrs[row] != addr:
+            return None
+        return self.slots[self.indptr[row] : self.indptr[row + 1]]
+
+
 class EntriesView:
-    def __init__(self, snapshot, page_offset: int):
-        self.snapshot = snapshot
+    """
+    Flyweight view of the entries of a page, see PagesView.
+    """
+
+    __slots__ = ("pages", "page_offset")
+
+    def __init__(self, pages: "PagesView", page_offset: int):
+        self.pages = pages
         self.page_offset: int = page_offset
-        self._present_keys = None
+
+    @property
+    def snapshot(self) -> "MemMappedSnapshot":
+        return self.pages.snapshot
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        The raw values of all entries in the page. (Zero-copy view into the snapshot if possible.)
+        """
+        return self.snapshot.page_entries(self.page_offset, self.page_offset + PAGING_STRUCTURE_SIZE)[0]
 
     def __getitem__(self, entry_offset: int) -> PagingEntry:
-        if entry_offset % 8 != 0:
+        if entry_offset % 8 != 0 or not 0 <= entry_offset < PAGING_STRUCTURE_SIZE:
             raise KeyError
 
-        offset = self.page_offset + entry_offset
-        (value,) = struct.unpack("<Q", self.snapshot.mmap[offset : offset + PAGING_ENTRY_SIZE])
-        return PagingEntry(value=value)
+        return PagingEntry(value=int(self.array[entry_offset // PAGING_ENTRY_SIZE]))
 
     def __len__(self):
-        return len(self.keys())
+        return len(self.pages.present_slots(self.page_offset))
 
     def keys(self, present_only=True) -> Union[range, List[int]]:
         all_offsets = range(0, PAGING_STRUCTURE_SIZE, PAGING_ENTRY_SIZE)
         if not present_only:
             return all_offsets
-
-        if not (present_keys := self._present_keys):
-            present_keys = [offset for offset in all_offsets if self[offset].present]
-            self._present_keys = present_keys
-
-        return present_keys
+        return (self.pages.present_slots(self.page_offset).astype(np.int64) * PAGING_ENTRY_SIZE).tolist()
 
     def __iter__(self):
         return iter(self.keys())
 
     def values(self, present_only=True) -> Iterable[PagingEntry]:
-        return (self[offset] for offset in self.keys(present_only=present_only))
+        return (entry for _, entry in self.items(present_only=present_only))
 
     def items(self, present_only=True) -> Iterable[Tuple[int, PagingEntry]]:
-        return ((offset, self[offset]) for offset in self.keys(present_only=present_only))
+        # The page is read once for all entries.
+        values = self.array.tolist()
+        return (
+            (offset, PagingEntry(value=values[offset // PAGING_ENTRY_SIZE]))
+            for offset in self.keys(present_only=present_only)
+        )
 
 
 class PageView:
-    def __init__(self, snapshot, offset):
-        self.snapshot = snapshot
+    """
+    Flyweight view of a page, see PagesView.
+    """
+
+    __slots__ = ("pages", "offset")
+
+    def __init__(self, pages: "PagesView", offset: int):
+        self.pages = pages
         self.offset = offset
 
+    @property
+    def snapshot(self) -> "MemMappedSnapshot":
+        return self.pages.snapshot
+
     @property
     def designations(self):
         return self.snapshot.designations[self.offset]
@@ -64,29 +371,66 @@ class PageView:
     def designations(self, value):
         self.snapshot.designations[self.offset] = value
 
-    @cached_property
-    def entries(self):
-        return EntriesView(self.snapshot, self.offset)
+    @property
+    def entries(self) -> EntriesView:
+        return EntriesView(self.pages, self.offset)
 
 
 class PagesView:
+    """
+    Dict like view of the pages of a snapshot, mapping page addresses to PageViews.
+    Page and entry views are flyweights holding nothing but the address, they are created on access and not cached, so
+    memory does not grow with the number of visited pages. The slots of the present entries of pages with designations
+    are looked up in PresentEntryIndexes, one per chunk of CHUNK_PAGES pages, built with one pass over the designated
+    pages of a chunk the first time one of its pages is accessed. Other pages (e.g. the ones without designations in a
+    tracked store, ones designated later or all pages of a SnapshotPagingData) are read on every access.
+    """
+
+    __slots__ = ("snapshot", "_present_indexes")
+
     def __init__(self, snapshot):
         self.snapshot = snapshot
-        self.pages: Dict[int, PageView] = {}
+        self._present_indexes: Dict[int, PresentEntryIndex] = {}
+
+    def present_index(self, addr: int) -> PresentEntryIndex:
+        """
+        The PresentEntryIndex of the designated pages in the chunk containing addr.
+        """
+        chunk = addr // (CHUNK_PAGES * PAGING_STRUCTURE_SIZE)
+        index = self._present_indexes.get(chunk)
+        if index is None:
+            designations = self.snapshot.designations
+            if isinstance(designations, DesignationStore):
+                masks = designations.masks[chunk * CHUNK_PAGES : (chunk + 1) * CHUNK_PAGES]
+                pages = np.flatnonzero(masks & ~TRACKED_BIT) + chunk * CHUNK_PAGES
+            else:
+                # Designations of a SnapshotPagingData (a dict), its pages are read on every access.
+                pages = np.array([], dtype=np.int64)
+            index = PresentEntryIndex.build(self.snapshot, pages.astype(np.uint64) * PAGING_STRUCTURE_SIZE)
+            self._present_indexes[chunk] = index
+        return index
+
+    def present_slots(self, addr: int) -> np.ndarray:
+        """
+        Slots of the present entries of the page at addr.
+        """
+        slots = self.present_index(addr).present_slots(addr)
+        if slots is None:
+            entries = self.snapshot.page_entries(addr, addr + PAGING_STRUCTURE_SIZE)[0]
+            slots = np.flatnonzero(entries_present(entries))
+        return slots
 
     def __getitem__(self, item: int) -> PageView:
         if item % PAGING_STRUCTURE_SIZE != 0:
             raise KeyError
-        if view := self.pages.get(item):
-            return view
-        else:
-            pv = PageView(self.snapshot, item)
-            self.pages[item] = pv
-            return pv
+        return PageView(self, item)
 
     def __len__(self):
         return len(self.snapshot.designations)
 
+    def __contains__(self, item: int) -> bool:
+        return item in self.snapshot.designations
+
     def keys(self) -> Iterable[int]:
         return self.snapshot.designations.keys()
 
@@ -103,15 +447,18 @@ class PagesView:
 
 
 class MemMappedSnapshot:
-    def __init__(self, snapshot: SnapshotPagingData):
+    def __init__(self, snapshot: Union[SnapshotPagingData, DesignationStore]):
         self.snapshot = snapshot
         self.designations = snapshot.designations
         self.path = snapshot.path
 
     @cached_property
-    def mmap(self):
-        with open(self.path) as f:
-            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    def layer(self) -> PhysicalLayer:
+        """
+        The physical address space of the snapshot. Raw, LiME and ELF core snapshots are supported, also compressed
+        (see paging_detection.compressed).
+        """
+        return open_layer(self.path)
 
     @cached_property
     def pages(self):
@@ -119,7 +466,113 @@ class MemMappedSnapshot:
 
     @property
     def size(self):
-        return len(self.mmap)
+        """
+        Size of the physical address space, i.e. the end of the highest segment.
+        """
+        return self.layer.size
+
+    @property
+    def num_pages(self) -> int:
+        """
+        Number of complete pages in the snapshot. A trailing partial page is not part of the entry arrays.
+        """
+        return self.layer.num_pages
+
+    @property
+    def entry_values(self) -> np.ndarray:
+        """
+        Zero-copy view of the entire snapshot as little endian uint64 values, shaped (pages, entries per page).
+        Row i holds the entries of the page at physical address i * PAGING_STRUCTURE_SIZE.
+        Only available if the physical address space is contiguous (e.g. raw snapshots), see PhysicalLayer.
+        """
+        return self.layer.entry_values
+
+    def in_bounds(self, addrs: Union[int, np.ndarray]) -> Union[bool, np.ndarray]:
+        """
+        Whether physical addresses lie within the snapshot, following its segment map.
+        """
+        return self.layer.in_bounds(addrs)
+
+    def page_entries(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Get the raw entry values of all pages with physical addresses in [start, stop).
+        Pages outside of the snapshot (past its end or between segments) read as all zeros (not present), in that case
+        the result is a copy.
+        :param start: Physical address of the first page, must be page aligned.
+        :param stop: Physical address after the last page, must be page aligned. Defaults to the end of the snapshot.
+        :return: Array of shape (pages, entries per page)
+        """
+        return self.layer.page_entries(start, stop)
+
+    def gather_pages(self, addrs: np.ndarray) -> np.ndarray:
+        """
+        Get the raw entry values of the pages at arbitrary (page aligned) physical addresses. The result is a copy.
+        Pages outside of the snapshot read as all zeros (not present).
+        :return: Array of shape (len(addrs), entries per page)
+        """
+        return self.layer.gather_pages(addrs)
+
+    def gather_entries(self, addrs: np.ndarray) -> np.ndarray:
+        """
+        Get the raw values of the entries at arbitrary (entry aligned) physical addresses. The result is a copy.
+        Entries outside of the snapshot read as zero (not present).
+        """
+        return self.layer.gather_entries(addrs)
+
+    def present_mask(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return entries_present(self.page_entries(start, stop))
+
+    def valid_mask(self, page_type: PageTypes, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return entries_valid(self.page_entries(start, stop), page_type)
+
+    def target_is_data_mask(self, page_type: PageTypes, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return entries_target_is_data(self.page_entries(start, stop), page_type)
+
+    def large_page_mask(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return entries_large_page(self.page_entries(start, stop))
+
+    def targets(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        return entries_target(self.page_entries(start, stop))
 
     def json(self):
         return self.snapshot.json()
+
+
+def resolve_pages_path(path: pathlib.Path) -> pathlib.Path:
+    """
+    Find the file with the designations belonging to path, e.g. a graph or a path without extension.
+    Designation stores are preferred over JSON files.
+    """
+    if path.suffix in {DESIGNATIONS_SUFFIX, ".json"}:
+        return path
+    store_path = path.with_suffix(DESIGNATIONS_SUFFIX)
+    json_path = path.with_suffix(".json")
+    return json_path if json_path.exists() and not store_path.exists() else store_path
+
+
+def load_snapshot(path: Union[str, pathlib.Path]) -> MemMappedSnapshot:
+    """
+    Load a snapshot with designations from a designation store or a JSON file. (JSON files are imported into a store.)
+    """
+    if pathlib.Path(path).suffix == ".json":
+        with open(path) as f:
+            store = DesignationStore.from_paging_data(SnapshotPagingData.validate(json.load(f)))
+    else:
+        store = DesignationStore.load(path)
+    return MemMappedSnapshot(store)
+
+
+def save_snapshot(snapshot: MemMappedSnapshot, path: Union[str, pathlib.Path], export_json: bool = False):
+    """
+    Save the designations of a snapshot as designation store, or as JSON if path ends with .json.
+    :param export_json: Additionally export the designations as JSON, next to the store.
+    """
+    path = pathlib.Path(path)
+    store = snapshot.snapshot
+    if not isinstance(store, DesignationStore):
+        store = DesignationStore.from_paging_data(store, snapshot.size)
+    if path.suffix != ".json":
+        store.save(path)
+    if path.suffix == ".json" or export_json:
+        with open(path.with_suffix(".json"), "w") as f:
+            f.write(store.json())
@@ -0,0 +1,167 @@
+"""
+Out-of-core mode for snapshots whose page graph does not fit into memory.
+build_page_graph_out_of_core streams the edges found while scanning the snapshot to .npy files and sorts them by target
+with an external merge sort (see external_sort). The result is a graph saved like
+PageGraph.save, which is memory mapped and gets a workspace directory. Stages working on such a graph keep their per
+node and per edge state in memory mapped files in the workspace (see PageGraph.allocate) and stream over the edges in
+chunks. chunk_sizes_for_limit sizes these chunks (see PageGraph.chunk_sizes), so the memory the passes need on top of
+the memory mapped files is bounded by the limit instead of growing with the snapshot. (Pages of memory mapped files are
+managed by the OS and can be evicted whenever memory is needed.)
+"""
+import pathlib
+import re
+from typing import Optional
+
+import numpy as np
+
+from paging_detection import PageTypes, PAGING_STRUCTURE_SIZE
+from paging_detection import instrumentation
+from paging_detection.external_sort import ExternalSorter, NpyWriter
+from paging_detection.extract_all_pages import COUNT_TYPE, scan_chunks
+from paging_detection.mmaped import MemMappedSnapshot
+from paging_detection.page_graph import ChunkSizes, PageGraph, chunks, index_dtype, write_meta
+from paging_detection.page_index import PageIndex
+
+# Rough upper bounds of the memory needed per edge / node / page in a chunk by the streaming passes
+BYTES_PER_EDGE = 64
+BYTES_PER_NODE = 64
+BYTES_PER_PAGE = 32 * 1024
+
+DEFAULT_MEMORY_LIMIT = 2 ** 30
+
+_SIZE_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def parse_size(text: str) -> int:
+    """
+    Parse a size like "512M" or "4G" (binary units) into bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", text, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def chunk_sizes_for_limit(limit: int) -> ChunkSizes:
+    """
+    Size the chunks of the streaming passes (scanning the snapshot, passes over edges and nodes) so that none of them
+    needs much more than limit bytes of memory at once.
+    """
+    return ChunkSizes(
+        edges=max(limit // BYTES_PER_EDGE, 2 ** 10),
+        nodes=max(limit // BYTES_PER_NODE, 2 ** 10),
+        pages=max(limit // BYTES_PER_PAGE, 1),
+    )
+
+
+class _IndptrWriter:
+    """
+    Writes the CSR style index pointers (see PageGraph.out_indptr) of a sorted stream of node indices, e.g. the
+    sources of all edges in order.
+    """
+
+    def __init__(self, path: pathlib.Path, num_nodes: int, chunk_nodes: int):
+        self.num_nodes = num_nodes
+        self.chunk_nodes = chunk_nodes
+        self._writer = NpyWriter(path, np.int64)
+        self._next_node = 0
+        self._position = 0
+
+    def _fill(self, idx: np.ndarray, stop: int):
+        # indptr[node] is the number of values < node
+        for nodes in chunks(stop - self._next_node, self.chunk_nodes):
+            node_range = np.arange(self._next_node + nodes.start, self._next_node + nodes.stop)
+            self._writer.append(self._position + np.searchsorted(idx, node_range))
+        self._next_node = stop
+
+    def append(self, idx: np.ndarray):
+        """
+        Append the next node indices, which must not be smaller than the ones before.
+        """
+        if len(idx):
+            self._fill(idx, int(idx[-1]) + 1)
+        self._position += len(idx)
+
+    def close(self):
+        self._fill(np.zeros(0, dtype=np.int64), self.num_nodes + 1)
+        self._writer.close()
+
+
+@instrumentation.span("extract_all_pages")
+def build_page_graph_out_of_core(
+    snapshot: MemMappedSnapshot,
+    max_paddr: int,
+    workspace: pathlib.Path,
+    jobs: int = 1,
+    index: Optional[PageIndex] = None,
+    chunk_sizes: Optional[ChunkSizes] = None,
+) -> PageGraph:
+    """
+    Like extract_all_pages.build_page_graph, but the graph is written to workspace / "all_pages.pgraph" while the
+    snapshot is scanned, instead of being collected in memory.
+    Edges are found in order of their sources, so sources, targets, offsets and out_indptr are streamed to disk
+    directly. The permutation sorting them by target (in_order) and in_indptr are the result of an external sort.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param workspace: Directory for the graph and temporary files.
+    :param jobs: Number of processes scanning the snapshot.
+    :param index: Page index of the snapshot, see build_page_graph.
+    :param chunk_sizes: Chunk sizes of the streaming passes. (Default: Sized for DEFAULT_MEMORY_LIMIT)
+    :return: The graph, memory mapped and with workspace as its workspace and chunk_sizes as its chunk sizes.
+    """
+    if chunk_sizes is None:
+        chunk_sizes = chunk_sizes_for_limit(DEFAULT_MEMORY_LIMIT)
+    workspace = pathlib.Path(workspace)
+    path = workspace / "all_pages.pgraph"
+    path.mkdir(parents=True, exist_ok=True)
+    num_nodes = max_paddr // PAGING_STRUCTURE_SIZE + 1
+    idx_type = index_dtype(num_nodes)
+
+    nodes = NpyWriter(path / "nodes.npy", np.uint64)
+    for chunk in chunks(num_nodes, chunk_sizes.nodes):
+        nodes.append(np.arange(chunk.start, chunk.stop, dtype=np.uint64) * PAGING_STRUCTURE_SIZE)
+    nodes.close()
+    node_data = {}
+    for page_type in PageTypes:
+        for key in (f"invalid_{page_type}", f"oob_{page_type}"):
+            node_data[key] = np.lib.format.open_memmap(
+                path / f"node_data.{key}.npy", mode="w+", dtype=COUNT_TYPE, shape=(num_nodes,)
+            )
+
+    sources = NpyWriter(path / "sources.npy", idx_type)
+    targets = NpyWriter(path / "targets.npy", idx_type)
+    offsets = NpyWriter(path / "offsets.npy", np.uint16)
+    out_indptr = _IndptrWriter(path / "out_indptr.npy", num_nodes, chunk_sizes.nodes)
+    by_target = ExternalSorter(workspace, idx_type, np.int64, run_size=chunk_sizes.edges)
+    scanned = scan_chunks(snapshot, max_paddr, jobs, index, chunk_sizes.pages)
+    for first, chunk_sources, chunk_targets, chunk_offsets, counts in scanned:
+        # Nodes are all pages in order, so a nodes index is its address divided by the page size.
+        chunk_sources = (chunk_sources // PAGING_STRUCTURE_SIZE).astype(idx_type)
+        chunk_targets = (chunk_targets // PAGING_STRUCTURE_SIZE).astype(idx_type)
+        by_target.add(chunk_targets, np.arange(sources.length, sources.length + len(chunk_sources)))
+        sources.append(chunk_sources)
+        targets.append(chunk_targets)
+        offsets.append(chunk_offsets)
+        out_indptr.append(chunk_sources)
+        for key, count in counts.items():
+            node_data[key][first : first + len(count)] = count
+    for writer in (sources, targets, offsets, out_indptr):
+        writer.close()
+    for column in node_data.values():
+        column.flush()
+
+    with instrumentation.span("sort_edges"):
+        in_order = NpyWriter(path / "in_order.npy", index_dtype(sources.length))
+        in_indptr = _IndptrWriter(path / "in_indptr.npy", num_nodes, chunk_sizes.nodes)
+        for sorted_targets, ids in by_target.sorted():
+            in_order.append(ids)
+            in_indptr.append(sorted_targets)
+            instrumentation.progress(in_order.length / max(sources.length, 1))
+        in_order.close()
+        in_indptr.close()
+        instrumentation.count("edges", sources.length)
+
+    write_meta(path, node_data)
+    graph = PageGraph.load(path)
+    graph.workspace, graph.chunk_sizes = workspace, chunk_sizes
+    return graph
@@ -0,0 +1,445 @@
+from functools import cached_property
+import json
+import os
+import pathlib
+import tempfile
+from typing import Dict, Iterator, NamedTuple, Optional, Union, Any
+
+import networkx as nx
+import numpy as np
+
+from paging_detection import CHUNK_PAGES
+
+GRAPH_SUFFIX = ".pgraph"
+_GRAPH_FORMAT_VERSION = 1
+
+
+class ChunkSizes(NamedTuple):
+    """
+    Number of edges / nodes / pages handled at once by passes streaming over a graph or scanning the snapshot.
+    Every graph carries the sizes its stages use, see out_of_core.chunk_sizes_for_limit.
+    """
+
+    edges: int = 2 ** 22
+    nodes: int = 2 ** 22
+    pages: int = CHUNK_PAGES
+
+
+def gather_ranges(indptr: np.ndarray, idx: np.ndarray) -> np.ndarray:
+    """
+    Concatenate the ranges indptr[i]:indptr[i+1] for all i in idx without a python loop.
+    :param indptr: CSR style index pointer array.
+    :param idx: Indices of the ranges to gather.
+    :return: Array with all positions in the selected ranges.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    starts = indptr[idx]
+    lens = indptr[idx + 1] - starts
+    ends = np.cumsum(lens)
+    return np.repeat(starts - ends + lens, lens) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def index_dtype(count: int) -> np.dtype:
+    return np.dtype(np.int32) if count < 2 ** 31 else np.dtype(np.int64)
+
+
+def chunks(length: int, chunk_size: int) -> Iterator[slice]:
+    """
+    Split range(length) into slices of at most chunk_size.
+    """
+    for start in range(0, length, chunk_size):
+        yield slice(start, min(start + chunk_size, length))
+
+
+def add_counts(counter: np.ndarray, idx: np.ndarray):
+    """
+    Increment counter[i] by the number of occurrences of i in idx. Like adding np.bincount(idx), but only needs memory
+    in the order of len(idx) (or of the range of values in idx, if that is smaller).
+    """
+    if not len(idx):
+        return
+    low, high = int(idx.min()), int(idx.max())
+    if high - low < 4 * len(idx):
+        counter[low : high + 1] += np.bincount(idx - low, minlength=high - low + 1)
+    else:
+        values, counts = np.unique(idx, return_counts=True)
+        counter[values] += counts
+
+
+def allocate(length: int, dtype, workspace: Optional[pathlib.Path] = None) -> np.ndarray:
+    """
+    Allocate a zeroed array. Without a workspace, it is held in memory. With a workspace, it is memory mapped from a
+    (deleted) temporary file in it.
+    """
+    if workspace is None:
+        return np.zeros(length, dtype=dtype)
+    fd, name = tempfile.mkstemp(suffix=".npy", dir=workspace)
+    os.close(fd)
+    array = np.lib.format.open_memmap(name, mode="w+", dtype=dtype, shape=(length,))
+    try:
+        os.unlink(name)  # The mapping keeps the file around until the array is gone.
+    except OSError:  # Windows does not allow deleting mapped files.
+        pass
+    return array
+
+
+def write_meta(path: pathlib.Path, node_data_keys):
+    """
+    Write the metadata of a graph saved as directory of .npy files, see PageGraph.save.
+    """
+    with open(path / "meta.json", "w") as f:
+        json.dump({"version": _GRAPH_FORMAT_VERSION, "node_data": list(node_data_keys)}, f)
+
+
+def lookup(nodes: np.ndarray, addrs: Union[int, np.ndarray]) -> Union[int, np.ndarray]:
+    """
+    Find the positions of addrs in the sorted array nodes. Raises a KeyError if any of them is missing.
+    """
+    addrs_arr = np.atleast_1d(np.asarray(addrs, dtype=np.uint64))
+    idx = np.searchsorted(nodes, addrs_arr)
+    found = idx < len(nodes)
+    found[found] = nodes[idx[found]] == addrs_arr[found]
+    if not np.all(found):
+        raise KeyError(addrs_arr[~found])
+    return int(idx[0]) if np.ndim(addrs) == 0 else idx
+
+
+class PageGraph:
+    """
+    Directed multigraph representing pages and their (hypothetical) paging entries, backed by numpy arrays.
+    A node represents a 4kb page and is identified by its physical address. Internally, every node also has an index,
+    its position in the sorted `nodes` array. Edges represent present entries pointing from one page to another.
+    They are stored sorted by source node (CSR). A permutation sorting them by target node (CSC) is kept alongside.
+    Node properties are stored as columns in `node_data`, e.g. node_data["PML4"][index] or node_data["oob_PD"][index].
+    If the graph has a workspace directory (see out_of_core), stages keep their per node and per edge state in memory
+    mapped files in it (see allocate) and stream over the edges in chunks, instead of holding it in memory.
+    The size of the chunks streaming passes use is kept in chunk_sizes and passed on to derived graphs.
+    """
+
+    def __init__(
+        self,
+        nodes: np.ndarray,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        offsets: np.ndarray,
+        node_data: Optional[Dict[str, np.ndarray]] = None,
+        check_order: bool = True,
+    ):
+        """
+        :param nodes: Sorted, unique physical addresses of the pages.
+        :param sources: Index of the source node for every edge.
+        :param targets: Index of the target node for every edge.
+        :param offsets: Offset of the corresponding entry within the source page for every edge.
+        :param node_data: Node properties, mapping a property name to an array with one value per node.
+        :param check_order: Whether to sort the edges by source and offset, if they are not already.
+        """
+        self.nodes = np.asarray(nodes, dtype=np.uint64)
+        idx_type = index_dtype(len(self.nodes))
+        self.sources = np.asarray(sources, dtype=idx_type)
+        self.targets = np.asarray(targets, dtype=idx_type)
+        self.offsets = np.asarray(offsets, dtype=np.uint16)
+        self.node_data: Dict[str, np.ndarray] = dict(node_data or {})
+        self.workspace: Optional[pathlib.Path] = None
+        self.chunk_sizes = ChunkSizes()
+        if not check_order:
+            return
+        # Edges from a linear scan over the snapshot are already in order, sorting them again is costly.
+        keys = self.sources.astype(np.int64) * (np.iinfo(np.uint16).max + 1) + self.offsets
+        if np.any(keys[1:] < keys[:-1]):
+            order = np.argsort(keys, kind="stable")
+            self.sources, self.targets, self.offsets = self.sources[order], self.targets[order], self.offsets[order]
+
+    @classmethod
+    def from_edges(
+        cls,
+        nodes: np.ndarray,
+        source_addrs: np.ndarray,
+        target_addrs: np.ndarray,
+        offsets: np.ndarray,
+        node_data: Optional[Dict[str, np.ndarray]] = None,
+    ) -> "PageGraph":
+        """
+        Build a graph from edges given as physical addresses. All addresses need to be in nodes.
+        """
+        nodes = np.unique(np.asarray(nodes, dtype=np.uint64))
+        return cls(nodes, lookup(nodes, source_addrs), lookup(nodes, target_addrs), offsets, node_data)
+
+    @cached_property
+    def out_indptr(self) -> np.ndarray:
+        return np.concatenate(([0], np.cumsum(np.bincount(self.sources, minlength=len(self.nodes)))))
+
+    @cached_property
+    def in_order(self) -> np.ndarray:
+        """
+        Edge ids sorted by target node.
+        """
+        return np.argsort(self.targets, kind="stable").astype(index_dtype(len(self.sources)))
+
+    @cached_property
+    def in_indptr(self) -> np.ndarray:
+        return np.concatenate(([0], np.cumsum(np.bincount(self.targets, minlength=len(self.nodes)))))
+
+    @cached_property
+    def out_degree(self) -> np.ndarray:
+        return self._degree(self.out_indptr)
+
+    @cached_property
+    def in_degree(self) -> np.ndarray:
+        return self._degree(self.in_indptr)
+
+    def _degree(self, indptr: np.ndarray) -> np.ndarray:
+        degree = self.allocate(len(self.nodes), np.int64)
+        for nodes in self.node_chunks():
+            degree[nodes] = np.diff(indptr[nodes.start : nodes.stop + 1])
+        return degree
+
+    def allocate(self, length: int, dtype) -> np.ndarray:
+        """
+        Allocate a zeroed array, e.g. for per node or per edge state, in the workspace of the graph (see allocate).
+        """
+        return allocate(length, dtype, self.workspace)
+
+    def edge_chunks(self) -> Iterator[slice]:
+        """
+        Slices of at most chunk_sizes.edges edge ids covering all edges.
+        """
+        return chunks(self.number_of_edges(), self.chunk_sizes.edges)
+
+    def node_chunks(self) -> Iterator[slice]:
+        """
+        Slices of at most chunk_sizes.nodes node indices covering all nodes.
+        """
+        return chunks(self.number_of_nodes(), self.chunk_sizes.nodes)
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return len(self.sources)
+
+    def index(self, addrs: Union[int, np.ndarray]) -> Union[int, np.ndarray]:
+        """
+        Get the node indices for physical addresses.
+        """
+        return lookup(self.nodes, addrs)
+
+    def __contains__(self, addr: int) -> bool:
+        idx = np.searchsorted(self.nodes, np.uint64(addr))
+        return bool(idx < len(self.nodes) and self.nodes[idx] == np.uint64(addr))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def out_edges_of(self, idx: np.ndarray) -> np.ndarray:
+        """
+        Edge ids of all outbound edges of the nodes with the given indices.
+        """
+        return gather_ranges(self.out_indptr, idx)
+
+    def in_edges_of(self, idx: np.ndarray) -> np.ndarray:
+        """
+        Edge ids of all inbound edges of the nodes with the given indices.
+        """
+        return self.in_order[gather_ranges(self.in_indptr, idx)]
+
+    def successor_indices(self, idx: int) -> np.ndarray:
+        return self.targets[self.out_indptr[idx] : self.out_indptr[idx + 1]]
+
+    def predecessor_indices(self, idx: int) -> np.ndarray:
+        return self.sources[self.in_order[self.in_indptr[idx] : self.in_indptr[idx + 1]]]
+
+    def successors(self, node: int) -> np.ndarray:
+        """
+        Physical addresses of the targets of all outbound edges of node. (One per edge, so there may be duplicates.)
+        """
+        return self.nodes[self.successor_indices(self.index(node))]
+
+    def predecessors(self, node: int) -> np.ndarray:
+        """
+        Physical addresses of the sources of all inbound edges of node. (One per edge, so there may be duplicates.)
+        """
+        return self.nodes[self.predecessor_indices(self.index(node))]
+
+    def out_entry_offsets(self, node: int) -> np.ndarray:
+        """
+        Offsets of the entries (within node) that correspond to the outbound edges of node.
+        """
+        idx = self.index(node)
+        return self.offsets[self.out_indptr[idx] : self.out_indptr[idx + 1]]
+
+    def node_attrs(self, node: int) -> Dict[str, Any]:
+        idx = self.index(node)
+        return {key: column[idx].item() for key, column in self.node_data.items()}
+
+    def without_edges(self, mask: np.ndarray) -> "PageGraph":
+        """
+        Create a copy of the graph without the edges selected by mask. Nodes and node data are kept.
+        With a workspace, the copy is streamed into it.
+        """
+        if self.workspace is not None:
+            return self._streamed_without_edges(mask)
+        keep = ~mask
+        node_data = {key: column.copy() for key, column in self.node_data.items()}
+        graph = PageGraph(self.nodes, self.sources[keep], self.targets[keep], self.offsets[keep], node_data)
+        graph.chunk_sizes = self.chunk_sizes
+        return graph
+
+    def _streamed_without_edges(self, mask: np.ndarray) -> "PageGraph":
+        """
+        without_edges, chunk by chunk. Removing edges keeps the order of the remaining ones, so the adjacency indices
+        are derived from the ones of this graph instead of sorting again.
+        """
+        num_edges = self.number_of_edges()
+        # kept_before[i]: Number of kept edges with an id < i
+        kept_before = self.allocate(num_edges + 1, np.int64)
+        kept = 0
+        for edges in self.edge_chunks():
+            kept_before[edges.start + 1 : edges.stop + 1] = kept + np.cumsum(~mask[edges])
+            kept = int(kept_before[edges.stop])
+
+        def copy_kept(array: np.ndarray) -> np.ndarray:
+            result = self.allocate(kept, array.dtype)
+            for edges in self.edge_chunks():
+                result[kept_before[edges.start] : kept_before[edges.stop]] = array[edges][~mask[edges]]
+            return result
+
+        def derive_indptr(indptr: np.ndarray, kept_before: np.ndarray) -> np.ndarray:
+            result = self.allocate(len(indptr), np.int64)
+            for nodes in chunks(len(indptr), self.chunk_sizes.nodes):
+                result[nodes] = kept_before[indptr[nodes]]
+            return result
+
+        node_data = {key: self.allocate(len(column), column.dtype) for key, column in self.node_data.items()}
+        for key, column in self.node_data.items():
+            node_data[key][:] = column
+        sources, targets, offsets = copy_kept(self.sources), copy_kept(self.targets), copy_kept(self.offsets)
+        graph = PageGraph(self.nodes, sources, targets, offsets, node_data, check_order=False)
+        graph.workspace, graph.chunk_sizes = self.workspace, self.chunk_sizes
+        graph.out_indptr = derive_indptr(self.out_indptr, kept_before)
+
+        # The same, with positions in the edges sorted by target
+        in_order = self.allocate(kept, index_dtype(kept))
+        kept_in_before = self.allocate(num_edges + 1, np.int64)
+        position = 0
+        for edges in self.edge_chunks():
+            ids = self.in_order[edges]
+            keep = ~mask[ids]
+            kept_in_before[edges.start + 1 : edges.stop + 1] = position + np.cumsum(keep)
+            in_order[position : position + np.count_nonzero(keep)] = kept_before[ids[keep]]
+            position = int(kept_in_before[edges.stop])
+        graph.in_order = in_order
+        graph.in_indptr = derive_indptr(self.in_indptr, kept_in_before)
+        return graph
+
+    def to_networkx(self) -> nx.MultiDiGraph:
+        """
+        Convert to a networkx graph, e.g. to export it as graphml for visualisation.
+        Edge keys are the physical addresses of the corresponding entries.
+        """
+        graph = nx.MultiDiGraph()
+        columns = list(self.node_data.items())
+        graph.add_nodes_from(
+            (int(node), {key: column[i].item() for key, column in columns}) for i, node in enumerate(self.nodes)
+        )
+        graph.add_edges_from(
+            (int(src), int(dst), int(src) + int(offset), {"offset": int(offset)})
+            for src, dst, offset in zip(self.nodes[self.sources], self.nodes[self.targets], self.offsets)
+        )
+        return graph
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph) -> "PageGraph":
+        """
+        Convert a networkx graph (e.g. read from graphml) to a PageGraph. Node ids are converted to int.
+        Edges without an "offset" property (e.g. the ones added by graphs.add_task_info) are dropped.
+        """
+        nodes = np.fromiter((int(node) for node in graph.nodes), dtype=np.uint64, count=graph.number_of_nodes())
+        order = np.argsort(nodes)
+        keys = {key for _, data in graph.nodes(data=True) for key in data}
+        node_data = {}
+        for key in sorted(keys):
+            values = [data.get(key) for _, data in graph.nodes(data=True)]
+            node_data[key] = np.array(values)[order]
+        edges = [(int(src), int(dst), offset) for src, dst, offset in graph.edges(data="offset") if offset is not None]
+        src, dst, offsets = zip(*edges) if edges else ((), (), ())
+        return cls.from_edges(
+            nodes[order],
+            np.array(src, dtype=np.uint64),
+            np.array(dst, dtype=np.uint64),
+            np.array(offsets, dtype=np.uint16),
+            node_data,
+        )
+
+    def save(self, path: Union[str, pathlib.Path]):
+        """
+        Save the graph as a directory of .npy files (nodes, edges, adjacency indices and one file per node property).
+        """
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        arrays = {
+            "nodes": self.nodes,
+            "sources": self.sources,
+            "targets": self.targets,
+            "offsets": self.offsets,
+            "out_indptr": self.out_indptr,
+            "in_indptr": self.in_indptr,
+            "in_order": self.in_order,
+        }
+        arrays.update({f"node_data.{key}": column for key, column in self.node_data.items()})
+        for name, array in arrays.items():
+            np.save(path / f"{name}.npy", array)
+        write_meta(path, self.node_data)
+
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path]) -> "PageGraph":
+        """
+        Load a graph saved with PageGraph.save. All arrays are memory mapped and only read when accessed.
+        Node properties are mapped copy-on-write, changes to them stay in memory.
+        """
+        path = pathlib.Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        if meta["version"] != _GRAPH_FORMAT_VERSION:
+            raise ValueError(f"Unsupported graph format version {meta['version']} in {path}.")
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r")
+            for name in ("nodes", "sources", "targets", "offsets", "out_indptr", "in_indptr", "in_order")
+        }
+        node_data = {key: np.load(path / f"node_data.{key}.npy", mmap_mode="c") for key in meta["node_data"]}
+        graph = cls(arrays["nodes"], arrays["sources"], arrays["targets"], arrays["offsets"], node_data, False)
+        graph.out_indptr, graph.in_indptr = arrays["out_indptr"], arrays["in_indptr"]
+        graph.in_order = arrays["in_order"]
+        return graph
+
+
+def resolve_graph_path(path: pathlib.Path) -> pathlib.Path:
+    """
+    Find the graph belonging to path, e.g. a designations file or a path without extension.
+    Binary graphs are preferred over graphml files.
+    """
+    if path.suffix in {GRAPH_SUFFIX, ".graphml"}:
+        return path
+    graph_path = path.with_suffix(GRAPH_SUFFIX)
+    graphml_path = path.with_suffix(".graphml")
+    return graphml_path if graphml_path.exists() and not graph_path.exists() else graph_path
+
+
+def load_graph(path: Union[str, pathlib.Path]) -> PageGraph:
+    """
+    Load a graph from the binary format or from graphml.
+    """
+    if pathlib.Path(path).suffix == ".graphml":
+        return PageGraph.from_networkx(nx.read_graphml(path, force_multigraph=True))
+    return PageGraph.load(path)
+
+
+def save_graph(graph: PageGraph, path: Union[str, pathlib.Path], export_graphml: bool = False):
+    """
+    Save a graph in the binary format, or as graphml if path ends with .graphml.
+    :param export_graphml: Additionally export the graph as graphml, next to the binary graph.
+    """
+    path = pathlib.Path(path)
+    if path.suffix != ".graphml":
+        graph.save(path)
+    if path.suffix == ".graphml" or export_graphml:
+        nx.readwrite.write_graphml(graph.to_networkx(), path.with_suffix(".graphml"))
@@ -0,0 +1,216 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pathlib
+import struct
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from paging_detection import (
+    CHUNK_PAGES,
+    max_page_addr,
+    PageTypes,
+    PAGING_STRUCTURE_SIZE,
+    ENTRIES_PER_PAGE,
+    entries_present,
+    entries_target,
+    entries_valid,
+    entries_target_is_data,
+)
+from paging_detection import instrumentation
+from paging_detection.mmaped import DESIGNATION_BITS, DesignationStore, MemMappedSnapshot, SnapshotPagingData
+from paging_detection.physical import physical_size
+
+INDEX_SUFFIX = ".pidx"
+_INDEX_MAGIC = b"NOPGDIDX"
+_INDEX_VERSION = 1
+# magic, version, header length, snapshot size, snapshot modification time (ns)
+_INDEX_HEADER = struct.Struct("<8sIIQQ")
+
+# One record per page:
+#   present: Number of present entries
+#   zero: Whether all bytes of the page are zero
+#   valid: Bit (see mmaped.DESIGNATION_BITS) set for every type under which all present entries are valid
+#   oob: Bit set for every type under which at least one present entry points to a paging structure out of bounds
+SUMMARY_DTYPE = np.dtype([("present", "<u2"), ("zero", "?"), ("valid", "u1"), ("oob", "u1")])
+
+
+def summarize_pages(snapshot: MemMappedSnapshot, start: int, stop: int, max_paddr: int) -> np.ndarray:
+    """
+    Summarize all pages with physical addresses in [start, stop).
+    :param snapshot: The snapshot.
+    :param start: Physical address of the first page.
+    :param stop: Physical address after the last page.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :return: Array of SUMMARY_DTYPE records, one per page.
+    """
+    entries = snapshot.page_entries(start, stop)
+    present = entries_present(entries)
+    targets = entries_target(entries)
+    out_of_bounds = present & ~((targets <= max_paddr) & snapshot.in_bounds(targets))
+
+    summary = np.zeros(len(entries), dtype=SUMMARY_DTYPE)
+    summary["present"] = present.sum(axis=1)
+    summary["zero"] = ~entries.any(axis=1)
+    for page_type in PageTypes:
+        bit = DESIGNATION_BITS[page_type]
+        all_valid = ~(present & ~entries_valid(entries, page_type)).any(axis=1)
+        has_oob = (out_of_bounds & ~entries_target_is_data(entries, page_type)).any(axis=1)
+        summary["valid"] |= np.where(all_valid, bit, 0).astype(np.uint8)
+        summary["oob"] |= np.where(has_oob, bit, 0).astype(np.uint8)
+    return summary
+
+
+# Snapshot of the dump in a worker process of a parallel summary.
+_worker_snapshot: Optional[MemMappedSnapshot] = None
+
+
+def _init_summary_worker(path: str):
+    global _worker_snapshot
+    _worker_snapshot = MemMappedSnapshot(SnapshotPagingData(path=path, designations={}))
+
+
+def _summarize_chunk(chunk: Tuple[int, int, int]) -> np.ndarray:
+    return summarize_pages(_worker_snapshot, *chunk)
+
+
+class PageIndex:
+    """
+    Per-page summary of a snapshot (see SUMMARY_DTYPE), built in a single pass over the snapshot.
+    It is saved as a sidecar file next to the snapshot (<snapshot>.pidx), a small header with the size and modification
+    time of the snapshot followed by the records, which are memory mapped when loading. Later stages and reruns use it
+    to skip pages that can never be paging structures (pages without present entries) without reading them again.
+    """
+
+    def __init__(self, size: int, mtime_ns: int, summary: np.ndarray):
+        """
+        :param size: Size of the snapshot.
+        :param mtime_ns: Modification time of the snapshot when the index was built.
+        :param summary: One SUMMARY_DTYPE record per page.
+        """
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.summary = summary
+
+    @staticmethod
+    def sidecar_path(snapshot_path: Union[str, pathlib.Path]) -> pathlib.Path:
+        snapshot_path = pathlib.Path(snapshot_path)
+        return snapshot_path.with_name(snapshot_path.name + INDEX_SUFFIX)
+
+    @classmethod
+    @instrumentation.span("page_index")
+    def build(cls, snapshot: MemMappedSnapshot, max_paddr: int, jobs: int = 1) -> "PageIndex":
+        """
+        Summarize every page of a snapshot.
+        :param snapshot: The snapshot.
+        :param max_paddr: Highest physical address of a page in the snapshot.
+        :param jobs: Number of processes scanning the snapshot.
+        """
+        end = max_paddr + PAGING_STRUCTURE_SIZE
+        chunk_size = CHUNK_PAGES * PAGING_STRUCTURE_SIZE
+        chunks = [(start, min(start + chunk_size, end), max_paddr) for start in range(0, end, chunk_size)]
+
+        instrumentation.log(f"Building page index using {jobs} process(es).")
+        if jobs > 1:
+            with ProcessPoolExecutor(jobs, initializer=_init_summary_worker, initargs=(snapshot.path,)) as executor:
+                summary = np.concatenate(list(executor.map(_summarize_chunk, chunks)))
+        else:
+            summary = np.concatenate([summarize_pages(snapshot, *chunk) for chunk in chunks])
+        instrumentation.count("pages", len(summary))
+        instrumentation.count("entries", len(summary) * ENTRIES_PER_PAGE)
+        return cls(snapshot.size, os.stat(snapshot.path).st_mtime_ns, summary)
+
+    @classmethod
+    def load(cls, file: Union[str, pathlib.Path]) -> "PageIndex":
+        """
+        Load an index from disk without reading the records, they are memory mapped (read only).
+        """
+        with open(file, "rb") as f:
+            magic, version, header_len, size, mtime_ns = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise ValueError(f"{file} is not a page index (version {_INDEX_VERSION}).")
+        summary = np.memmap(
+            file, dtype=SUMMARY_DTYPE, mode="r", offset=header_len, shape=(DesignationStore.num_pages(size),)
+        )
+        return cls(size, mtime_ns, summary)
+
+    def save(self, file: Union[str, pathlib.Path]):
+        # Pad the header to the page size, so the records can be mapped at an aligned offset.
+        header_len = PAGING_STRUCTURE_SIZE
+        with open(file, "wb") as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, header_len, self.size, self.mtime_ns))
+            f.write(bytes(header_len - _INDEX_HEADER.size))
+            f.write(np.ascontiguousarray(self.summary).data)
+
+    def matches(self, snapshot_path: Union[str, pathlib.Path]) -> bool:
+        """
+        Whether the index (still) belongs to the snapshot at snapshot_path, judging by its size and modification time.
+        """
+        return physical_size(snapshot_path) == self.size and os.stat(snapshot_path).st_mtime_ns == self.mtime_ns
+
+    @property
+    def present_count(self) -> np.ndarray:
+        return self.summary["present"]
+
+    @property
+    def zero(self) -> np.ndarray:
+        return self.summary["zero"]
+
+    def valid_mask(self, page_type: PageTypes) -> np.ndarray:
+        """
+        Bool array with one value per page, indicating whether all present entries are valid under page_type.
+        """
+        return (self.summary["valid"] & DESIGNATION_BITS[page_type]).astype(bool)
+
+    def oob_mask(self, page_type: PageTypes) -> np.ndarray:
+        """
+        Bool array with one value per page, indicating whether any present entry is out of bounds under page_type.
+        """
+        return (self.summary["oob"] & DESIGNATION_BITS[page_type]).astype(bool)
+
+    def may_be_paging_structure(self) -> np.ndarray:
+        """
+        Bool array with one value per page. Pages without present entries have no outbound edges in the page graph,
+        determine_types rules out every type for them.
+        """
+        return self.summary["present"] > 0
+
+
+def load_or_build_index(snapshot: MemMappedSnapshot, max_paddr: int, jobs: int = 1) -> PageIndex:
+    """
+    Load the sidecar index of a snapshot, or build and save it if it is missing or outdated.
+    """
+    path = PageIndex.sidecar_path(snapshot.path)
+    if path.exists():
+        index = PageIndex.load(path)
+        if index.matches(snapshot.path):
+            instrumentation.log(f"Loaded page index: {path}")
+            return index
+        instrumentation.log(f"Page index {path} is outdated.")
+    index = PageIndex.build(snapshot, max_paddr, jobs)
+    instrumentation.log(f"Saving page index: {path}")
+    index.save(path)
+    return index
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=f"Build the page index (<snapshot>{INDEX_SUFFIX}) of a snapshot.")
+    parser.add_argument("in_file", help="Path to snapshot.", type=pathlib.Path)
+    parser.add_argument(
+        "--jobs", help="Number of processes used to scan the snapshot. (Default: 1)", type=int, default=1
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+
+    snapshot = MemMappedSnapshot(SnapshotPagingData(path=str(args.in_file), designations={}))
+    index = PageIndex.build(snapshot, max_page_addr(snapshot.size), args.jobs)
+    instrumentation.log(f"Saving page index: {PageIndex.sidecar_path(args.in_file)}")
+    index.save(PageIndex.sidecar_path(args.in_file))
+    empty = int(np.count_nonzero(~index.may_be_paging_structure()))
+    instrumentation.log(
+        f"{empty} of {len(index.summary)} pages have no present entries, {int(index.zero.sum())} are all zero."
+    )
+    instrumentation.log("Done")
@@ -0,0 +1,367 @@
+from functools import cached_property
+import mmap
+import os
+import pathlib
+import struct
+from typing import BinaryIO, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from paging_detection import PAGING_STRUCTURE_SIZE, PAGING_ENTRY_SIZE, ENTRIES_PER_PAGE
+from paging_detection.compressed import CompressedFile, compression_format
+
+
+class Segment(NamedTuple):
+    """
+    A contiguous range [start, end) of physical memory, stored at file_offset in the snapshot file.
+    """
+
+    start: int
+    end: int
+    file_offset: int
+
+
+_LIME_MAGIC = 0x4C694D45
+# magic, version, start address, end address (inclusive), reserved
+_LIME_HEADER = struct.Struct("<IIQQ8s")
+
+_ELF_MAGIC = b"\x7fELF"
+_ELFCLASS64 = 2
+_PT_LOAD = 1
+# If e_phnum is PN_XNUM, the number of program headers is stored in sh_info of the first section header.
+_PN_XNUM = 0xFFFF
+# e_ident, e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize, e_phnum,
+# e_shentsize, e_shnum, e_shstrndx
+_ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+# p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align
+_ELF_PROGRAM_HEADER = struct.Struct("<IIQQQQQQ")
+# sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize
+_ELF_SECTION_HEADER = struct.Struct("<IIQQQQIIQQ")
+
+
+def read_lime_segments(f: BinaryIO) -> List[Segment]:
+    """
+    Read the segments of a LiME snapshot, every range of memory is preceded by a header.
+    """
+    segments = []
+    while header := f.read(_LIME_HEADER.size):
+        if len(header) < _LIME_HEADER.size:
+            raise ValueError("Truncated LiME header.")
+        magic, version, start, end, _ = _LIME_HEADER.unpack(header)
+        if magic != _LIME_MAGIC:
+            raise ValueError(f"Invalid LiME header at file offset {f.tell() - _LIME_HEADER.size}.")
+        segments.append(Segment(start, end + 1, f.tell()))
+        f.seek(end + 1 - start, os.SEEK_CUR)
+    return segments
+
+
+def read_elf_segments(f: BinaryIO) -> List[Segment]:
+    """
+    Read the segments of an ELF core file (e.g. from QEMUs dump-guest-memory), one per PT_LOAD program header.
+    Segments are placed at their physical address (p_paddr).
+    """
+    header = _ELF_HEADER.unpack(f.read(_ELF_HEADER.size))
+    ident, phoff, shoff, phentsize, phnum = header[0], header[5], header[6], header[9], header[10]
+    if ident[4] != _ELFCLASS64:
+        raise ValueError("Only 64 bit ELF core files are supported.")
+    if phnum == _PN_XNUM:
+        f.seek(shoff)
+        phnum = _ELF_SECTION_HEADER.unpack(f.read(_ELF_SECTION_HEADER.size))[7]
+    segments = []
+    for i in range(phnum):
+        f.seek(phoff + i * phentsize)
+        p_type, _, offset, _, paddr, filesz, _, _ = _ELF_PROGRAM_HEADER.unpack(f.read(_ELF_PROGRAM_HEADER.size))
+        if p_type == _PT_LOAD and filesz:
+            segments.append(Segment(paddr, paddr + filesz, offset))
+    return segments
+
+
+def open_snapshot(path: Union[str, pathlib.Path]) -> BinaryIO:
+    """
+    Open a snapshot file for reading. Compressed snapshots (see paging_detection.compressed) are decompressed on the
+    fly, the result reads like the decompressed snapshot.
+    """
+    if compression_format(path) is not None:
+        return CompressedFile(path)
+    return open(path, "rb")
+
+
+def snapshot_format(path: Union[str, pathlib.Path]) -> str:
+    """
+    Detect the format of a (decompressed) snapshot: "lime", "elf" or "raw".
+    """
+    with open_snapshot(path) as f:
+        magic = f.read(4)
+    if len(magic) == 4 and struct.unpack("<I", magic)[0] == _LIME_MAGIC:
+        return "lime"
+    if magic == _ELF_MAGIC:
+        return "elf"
+    return "raw"
+
+
+def read_segments(path: Union[str, pathlib.Path]) -> List[Segment]:
+    """
+    Read the segment map of a snapshot, sorted by physical address. Raw snapshots consist of a single segment, file
+    offsets equal physical addresses. (Sparse raw files are mapped as they are, holes read as zeros.)
+    File offsets of compressed snapshots refer to the decompressed snapshot.
+    """
+    fmt = snapshot_format(path)
+    with open_snapshot(path) as f:
+        file_size = f.seek(0, os.SEEK_END)
+        if fmt == "raw":
+            return [Segment(0, file_size, 0)]
+        f.seek(0)
+        segments = read_lime_segments(f) if fmt == "lime" else read_elf_segments(f)
+    segments.sort()
+    for segment in segments:
+        if segment.start % PAGING_STRUCTURE_SIZE:
+            raise ValueError(f"Segment at {segment.start:#x} in {path} is not page aligned.")
+        if segment.file_offset + segment.end - segment.start > file_size:
+            raise ValueError(f"Segment at {segment.start:#x} exceeds the end of {path}.")
+    for previous, segment in zip(segments, segments[1:]):
+        if segment.start < previous.end:
+            raise ValueError(f"Segments at {previous.start:#x} and {segment.start:#x} in {path} overlap.")
+    return segments
+
+
+def physical_size(path: Union[str, pathlib.Path]) -> int:
+    """
+    Size of the physical address space of a snapshot, i.e. the end of its last segment.
+    """
+    return max((segment.end for segment in read_segments(path)), default=0)
+
+
+class PhysicalLayer:
+    """
+    Physical address space of a snapshot file, made up of segments (see read_segments). The snapshot file is memory
+    mapped once and every segment is viewed as an array of little endian uint64 entries without copying.
+    Physical addresses outside of any segment read as zeros (not present) and are not "in bounds".
+    Implements ReadableMem, so it can be passed to paging_detection.translate.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], segments: Optional[List[Segment]] = None):
+        """
+        :param path: Path of the snapshot file.
+        :param segments: The segment map, read from the file by default.
+        """
+        self.path = path
+        self.segments = read_segments(path) if segments is None else sorted(segments)
+        self._starts = np.array([segment.start for segment in self.segments], dtype=np.uint64)
+        self._ends = np.array([segment.end for segment in self.segments], dtype=np.uint64)
+        # Complete pages of every segment, a trailing partial page is in bounds but reads as zeros.
+        self._first_pages = self._starts // PAGING_STRUCTURE_SIZE
+        self._page_counts = (self._ends - self._starts) // PAGING_STRUCTURE_SIZE
+
+    @cached_property
+    def mmap(self) -> mmap.mmap:
+        with open(self.path) as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @cached_property
+    def segment_values(self) -> List[np.ndarray]:
+        """
+        Zero-copy views of the complete pages of every segment, shaped (pages, entries per page).
+        """
+        return [
+            np.frombuffer(self.mmap, dtype="<u8", count=int(count) * ENTRIES_PER_PAGE, offset=segment.file_offset)
+            .reshape(int(count), ENTRIES_PER_PAGE)
+            for segment, count in zip(self.segments, self._page_counts)
+        ]
+
+    @property
+    def size(self) -> int:
+        return int(self._ends[-1]) if len(self.segments) else 0
+
+    @property
+    def contiguous(self) -> bool:
+        """
+        Whether the physical address space is a single segment starting at 0, like a raw snapshot.
+        """
+        return len(self.segments) == 1 and self.segments[0].start == 0
+
+    @property
+    def num_pages(self) -> int:
+        """
+        Number of complete pages below size. A trailing partial page is not part of the entry arrays.
+        """
+        return self.size // PAGING_STRUCTURE_SIZE
+
+    @property
+    def entry_values(self) -> np.ndarray:
+        """
+        Zero-copy view of the entire physical address space, only available if it is contiguous.
+        """
+        if not self.contiguous:
+            raise ValueError(f"{self.path} has {len(self.segments)} segments, use page_entries or gather_pages.")
+        return self.segment_values[0]
+
+    def in_bounds(self, addrs: Union[int, np.ndarray]) -> Union[bool, np.ndarray]:
+        """
+        Whether physical addresses lie within a segment.
+        """
+        addrs_arr = np.asarray(addrs, dtype=np.uint64)
+        if self.contiguous:
+            inside = addrs_arr < self._ends[0]
+        else:
+            seg = np.searchsorted(self._starts, addrs_arr, side="right") - 1
+            inside = (seg >= 0) & (addrs_arr < self._ends[np.maximum(seg, 0)])
+        return bool(inside) if np.ndim(addrs) == 0 else inside
+
+    def page_entries(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Get the raw entry values of all pages with physical addresses in [start, stop), see MemMappedSnapshot.
+        The result is a zero-copy view if all pages are complete pages of a single segment.
+        """
+        stop = self.num_pages * PAGING_STRUCTURE_SIZE if stop is None else stop
+        if start % PAGING_STRUCTURE_SIZE or stop % PAGING_STRUCTURE_SIZE:
+            raise KeyError
+        first, last = start // PAGING_STRUCTURE_SIZE, stop // PAGING_STRUCTURE_SIZE
+        seg = int(np.searchsorted(self._first_pages, np.uint64(first), side="right")) - 1
+        if seg >= 0 and last - int(self._first_pages[seg]) <= int(self._page_counts[seg]):
+            offset = int(self._first_pages[seg])
+            return self.segment_values[seg][first - offset : last - offset]
+        padded = np.zeros((last - first, ENTRIES_PER_PAGE), dtype="<u8")
+        for values, seg_first in zip(self.segment_values, self._first_pages.tolist()):
+            lo, hi = max(first, seg_first), min(last, seg_first + len(values))
+            if lo < hi:
+                padded[lo - first : hi - first] = values[lo - seg_first : hi - seg_first]
+        return padded
+
+    def gather_pages(self, addrs: np.ndarray) -> np.ndarray:
+        """
+        Get the raw entry values of the pages at arbitrary (page aligned) physical addresses, see MemMappedSnapshot.
+        """
+        page_nums = np.asarray(addrs, dtype=np.uint64) // PAGING_STRUCTURE_SIZE
+        return self._gather(page_nums, self.segment_values, self._first_pages, (len(page_nums), ENTRIES_PER_PAGE))
+
+    def gather_entries(self, addrs: np.ndarray) -> np.ndarray:
+        """
+        Get the raw values of the entries at arbitrary (entry aligned) physical addresses, see MemMappedSnapshot.
+        """
+        entry_nums = np.asarray(addrs, dtype=np.uint64) // PAGING_ENTRY_SIZE
+        flat_values = [values.reshape(-1) for values in self.segment_values]
+        return self._gather(entry_nums, flat_values, self._first_pages * ENTRIES_PER_PAGE, (len(entry_nums),))
+
+    @staticmethod
+    def _gather(nums: np.ndarray, arrays: List[np.ndarray], firsts: np.ndarray, shape) -> np.ndarray:
+        """
+        Gather the rows nums (counted from physical address 0) from the per-segment arrays, which start at the rows
+        firsts. Rows outside of all arrays are zero.
+        """
+        if len(arrays) == 1 and firsts[0] == 0 and len(nums) and nums.max() < len(arrays[0]):
+            return arrays[0][nums.astype(np.int64)]
+        seg = np.searchsorted(firsts, nums, side="right") - 1
+        result = np.zeros(shape, dtype="<u8")
+        for i in np.unique(seg[seg >= 0]).tolist():
+            rows = nums - firsts[i]
+            selected = (seg == i) & (nums < firsts[i] + np.uint64(len(arrays[i])))
+            result[selected] = arrays[i][rows[selected].astype(np.int64)]
+        return result
+
+    def read_entry(self, addr: int) -> int:
+        """
+        Read the value of the entry at the (entry aligned) physical address addr, see translation.
+        """
+        if self.contiguous:
+            return struct.unpack_from("<Q", self.mmap, addr)[0]
+        return struct.unpack("<Q", self[addr : addr + PAGING_ENTRY_SIZE])[0]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, item: slice) -> bytes:
+        """
+        Read the physical memory in [item.start, item.stop) as bytes, addresses outside of all segments read as zeros.
+        """
+        start, stop = item.start or 0, self.size if item.stop is None else item.stop
+        if self.contiguous:
+            data = self.mmap[start:stop]
+            return data + bytes(max(0, stop - start - len(data)))
+        result = bytearray(max(0, stop - start))
+        for segment in self.segments:
+            lo, hi = max(start, segment.start), min(stop, segment.end)
+            if lo < hi:
+                offset = segment.file_offset - segment.start
+                result[lo - start : hi - start] = self.mmap[lo + offset : hi + offset]
+        return bytes(result)
+
+
+class CompressedLayer(PhysicalLayer):
+    """
+    Physical address space of a compressed snapshot file, see paging_detection.compressed.
+    Instead of viewing a memory map, the pages are copied out of the decompressed blocks of the snapshot, so all results
+    are copies and there is no zero-copy view (mmap, segment_values, entry_values).
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], segments: Optional[List[Segment]] = None):
+        self.file = CompressedFile(path)
+        super().__init__(path, segments)
+
+    @property
+    def mmap(self) -> mmap.mmap:
+        raise ValueError(f"{self.path} is compressed and can not be memory mapped.")
+
+    @property
+    def segment_values(self) -> List[np.ndarray]:
+        raise ValueError(f"{self.path} is compressed, use page_entries or gather_pages.")
+
+    def _file_offsets(self, nums: np.ndarray, per_page: int, unit: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Map rows (pages or entries, per_page of them in a page) counted from physical address 0 to file offsets.
+        :return: Bool array of the rows within complete pages of a segment and the file offsets of these rows.
+        """
+        firsts = self._first_pages * np.uint64(per_page)
+        seg = np.maximum(np.searchsorted(firsts, nums, side="right") - 1, 0)
+        inside = (nums >= firsts[seg]) & (nums < firsts[seg] + self._page_counts[seg] * np.uint64(per_page))
+        file_offsets = np.array([segment.file_offset for segment in self.segments], dtype=np.uint64)
+        return inside, file_offsets[seg[inside]] + (nums[inside] - firsts[seg[inside]]) * np.uint64(unit)
+
+    def page_entries(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        stop = self.num_pages * PAGING_STRUCTURE_SIZE if stop is None else stop
+        if start % PAGING_STRUCTURE_SIZE or stop % PAGING_STRUCTURE_SIZE:
+            raise KeyError
+        first, last = start // PAGING_STRUCTURE_SIZE, stop // PAGING_STRUCTURE_SIZE
+        result = np.zeros((last - first, ENTRIES_PER_PAGE), dtype="<u8")
+        for segment, seg_first, count in zip(self.segments, self._first_pages.tolist(), self._page_counts.tolist()):
+            lo, hi = max(first, seg_first), min(last, seg_first + count)
+            if lo < hi:
+                offset = segment.file_offset + (lo - seg_first) * PAGING_STRUCTURE_SIZE
+                data = self.file.pread(offset, (hi - lo) * PAGING_STRUCTURE_SIZE)
+                result[lo - first : hi - first] = np.frombuffer(data, dtype="<u8").reshape(-1, ENTRIES_PER_PAGE)
+        return result
+
+    def gather_pages(self, addrs: np.ndarray) -> np.ndarray:
+        page_nums = np.asarray(addrs, dtype=np.uint64) // PAGING_STRUCTURE_SIZE
+        inside, file_offsets = self._file_offsets(page_nums, 1, PAGING_STRUCTURE_SIZE)
+        result = np.zeros((len(page_nums), ENTRIES_PER_PAGE), dtype="<u8")
+        result[inside] = self.file.gather(file_offsets, PAGING_STRUCTURE_SIZE).view("<u8")
+        return result
+
+    def gather_entries(self, addrs: np.ndarray) -> np.ndarray:
+        entry_nums = np.asarray(addrs, dtype=np.uint64) // PAGING_ENTRY_SIZE
+        inside, file_offsets = self._file_offsets(entry_nums, ENTRIES_PER_PAGE, PAGING_ENTRY_SIZE)
+        result = np.zeros(len(entry_nums), dtype="<u8")
+        result[inside] = self.file.gather(file_offsets, PAGING_ENTRY_SIZE).view("<u8")[:, 0]
+        return result
+
+    def read_entry(self, addr: int) -> int:
+        return struct.unpack("<Q", self[addr : addr + PAGING_ENTRY_SIZE])[0]
+
+    def __getitem__(self, item: slice) -> bytes:
+        start, stop = item.start or 0, self.size if item.stop is None else item.stop
+        result = bytearray(max(0, stop - start))
+        for segment in self.segments:
+            lo, hi = max(start, segment.start), min(stop, segment.end)
+            if lo < hi:
+                data = self.file.pread(lo + segment.file_offset - segment.start, hi - lo)
+                result[lo - start : lo - start + len(data)] = data
+        return bytes(result)
+
+
+def open_layer(path: Union[str, pathlib.Path]) -> PhysicalLayer:
+    """
+    The physical address space of a snapshot file, a CompressedLayer if it is compressed.
+    """
+    if compression_format(path) is not None:
+        return CompressedLayer(path)
+    return PhysicalLayer(path)
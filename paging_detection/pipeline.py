@@ -0,0 +1,173 @@
+import pathlib
+from typing import Iterable, Optional, Tuple
+
+from paging_detection import max_page_addr, PageTypes
+from paging_detection import instrumentation
+from paging_detection.compressed import snapshot_stem
+from paging_detection.determine_types import determine_possible_types
+from paging_detection.extract_all_pages import build_page_graph
+from paging_detection.filters import apply_filters
+from paging_detection.mmaped import DesignationStore, MemMappedSnapshot, DESIGNATIONS_SUFFIX, save_snapshot
+from paging_detection.out_of_core import (
+    DEFAULT_MEMORY_LIMIT,
+    build_page_graph_out_of_core,
+    chunk_sizes_for_limit,
+    parse_size,
+)
+from paging_detection.page_graph import ChunkSizes, PageGraph, GRAPH_SUFFIX, save_graph
+from paging_detection.physical import physical_size
+from paging_detection.page_index import INDEX_SUFFIX, load_or_build_index
+
+# Stages of the pipeline, in order. Each one has an output stem suffix, matching the outputs of the individual scripts.
+STAGES = {
+    "all_pages": "_all_pages",
+    "with_types": "_all_pages_with_types",
+    "filtered": "_all_pages_with_types_filtered",
+}
+
+
+def run_pipeline(
+    dump_path: pathlib.Path,
+    checkpoints: Iterable[str] = ("filtered",),
+    filters: bool = True,
+    jobs: int = 1,
+    use_index: bool = False,
+    export_json: bool = False,
+    export_graphml: bool = False,
+    workspace: Optional[pathlib.Path] = None,
+    memory_limit: Optional[int] = None,
+) -> Tuple[PageGraph, MemMappedSnapshot]:
+    """
+    Run extraction, type determination and the filter chain on a snapshot in one process.
+    The graph and designations are passed between stages in memory and only written at the selected checkpoints.
+    :param dump_path: Path to the snapshot.
+    :param checkpoints: Stages (keys of STAGES) after which the graph and designations are saved.
+    :param filters: Whether to apply the filter chain.
+    :param jobs: Number of processes scanning the snapshot.
+    :param use_index: Whether to load (or build) the page index of the snapshot and skip pages without present entries.
+    :param export_json: Additionally export the designations at checkpoints as JSON.
+    :param export_graphml: Additionally export the graph at checkpoints as graphml.
+    :param workspace: Run out of core (see paging_detection.out_of_core), with the graph and per page / edge state in
+    memory mapped files in this directory.
+    :param memory_limit: Memory the streaming passes may use at once, see out_of_core.chunk_sizes_for_limit. (Default:
+    DEFAULT_MEMORY_LIMIT when running out of core, chunks of a fixed size otherwise)
+    :return: The resulting graph and snapshot.
+    Every stage (and saving a checkpoint) runs in a span named after it, see paging_detection.instrumentation.
+    """
+    checkpoints = set(checkpoints)
+
+    def checkpoint(stage: str, graph: PageGraph, snapshot: MemMappedSnapshot):
+        if stage not in checkpoints:
+            return
+        out_pages_path = dump_path.with_name(snapshot_stem(dump_path) + STAGES[stage] + DESIGNATIONS_SUFFIX)
+        out_graph_path = out_pages_path.with_suffix(GRAPH_SUFFIX)
+        with instrumentation.span(f"save_{stage}"):
+            instrumentation.log(f"Saving graph: {out_graph_path}")
+            save_graph(graph, out_graph_path, export_graphml=export_graphml)
+            instrumentation.log(f"Saving pages: {out_pages_path}")
+            save_snapshot(snapshot, out_pages_path, export_json=export_json)
+
+    if memory_limit is None and workspace is not None:
+        memory_limit = DEFAULT_MEMORY_LIMIT
+    chunk_sizes = ChunkSizes() if memory_limit is None else chunk_sizes_for_limit(memory_limit)
+
+    snap_size = physical_size(dump_path)
+    with instrumentation.span("all_pages"):
+        snapshot = MemMappedSnapshot(DesignationStore.create(str(dump_path), snap_size, tracked=True))
+        max_paddr = max_page_addr(snap_size)
+        index = load_or_build_index(snapshot, max_paddr, jobs=jobs) if use_index else None
+        if workspace is None:
+            graph = build_page_graph(snapshot, max_paddr=max_paddr, jobs=jobs, index=index, chunk_sizes=chunk_sizes)
+        else:
+            graph = build_page_graph_out_of_core(
+                snapshot, max_paddr, workspace, jobs=jobs, index=index, chunk_sizes=chunk_sizes
+            )
+    checkpoint("all_pages", graph, snapshot)
+
+    with instrumentation.span("with_types"):
+        instrumentation.log("Determining possible types for all pages.")
+        graph = determine_possible_types(graph, snapshot)
+        for nodes in graph.node_chunks():
+            designations = {t: graph.node_data[str(t)][nodes] for t in PageTypes}
+            snapshot.designations.set_designations(graph.nodes[nodes], designations)
+    checkpoint("with_types", graph, snapshot)
+
+    if filters:
+        with instrumentation.span("filtered"):
+            graph = apply_filters(graph, snapshot)
+        checkpoint("filtered", graph, snapshot)
+
+    return graph, snapshot
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run extract_all_pages.py, determine_types.py and filters.py in one process."
+    )
+    parser.add_argument(
+        "in_file",
+        help="Path to snapshot. Output files will have the same name with the suffix of the respective stage "
+        "(e.g. _all_pages_with_types_filtered.[desig|pgraph]) appended.",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--checkpoints",
+        help="Stages after which graph and designations are saved. (Default: Only the last stage)",
+        nargs="*",
+        choices=list(STAGES),
+    )
+    parser.add_argument("--no-filters", help="Skip the (linux specific) filters.", action="store_true")
+    parser.add_argument(
+        "--jobs", help="Number of processes used to scan the snapshot. (Default: 1)", type=int, default=1
+    )
+    parser.add_argument(
+        "--index",
+        help=f"Use the page index (<snapshot>{INDEX_SUFFIX}) to skip pages without present entries. It is built and "
+        "saved next to the snapshot if it does not exist yet.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--out-of-core",
+        dest="workspace",
+        help="Keep the graph and the state of all stages in memory mapped files in this directory instead of in "
+        "memory, for snapshots whose graph does not fit into memory. The directory can be removed afterwards.",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--memory-limit",
+        help="Memory (e.g. 512M, 4G) the streaming passes over pages, nodes and edges may use at once. Peak memory "
+        "still grows with the snapshot, unless running --out-of-core. (Default: Chunks of a fixed size)",
+        type=parse_size,
+    )
+    parser.add_argument("--json", help="Additionally export the designations as JSON.", action="store_true")
+    parser.add_argument("--graphml", help="Additionally export the graphs as graphml.", action="store_true")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+    dump_path = args.in_file
+    if dump_path.suffix in {".json", ".graphml", DESIGNATIONS_SUFFIX, GRAPH_SUFFIX}:
+        raise ValueError(f"Snapshot has {dump_path.suffix} as extension and would be overwritten by outputs.")
+
+    last_stage = "with_types" if args.no_filters else "filtered"
+    checkpoints = args.checkpoints if args.checkpoints is not None else [last_stage]
+    if args.no_filters and "filtered" in checkpoints:
+        raise ValueError("Can not save the filtered stage with --no-filters.")
+
+    timings = instrumentation.SummaryCollector(max_depth=0)
+    instrumentation.add_collector(timings)
+    run_pipeline(
+        dump_path,
+        checkpoints=checkpoints,
+        filters=not args.no_filters,
+        jobs=args.jobs,
+        use_index=args.index,
+        export_json=args.json,
+        export_graphml=args.graphml,
+        workspace=args.workspace,
+        memory_limit=args.memory_limit,
+    )
+
+    instrumentation.log("Stage timings:\n" + timings.summary())
+    instrumentation.log("Done")
@@ -0,0 +1,224 @@
+"""
+Fast triage: rank likely PML4s with a single pass over a snapshot, without building the page graph of all pages.
+Candidates are pages whose present entries are all valid PML4 entries (see PagingEntry.valid_pml4e) pointing into the
+snapshot, with at least one present entry in the "kernel" half (slots 256 - 511, the similarity filter leaves out slot
+256). They are bucketed by a hash of their kernel halves, the PML4s of a system mostly share their kernel half and end
+up in few big buckets. One member of every bucket is confirmed with a shallow walk: The kernel half entries need to
+point to plausible PDPs. Confirmed candidates are scored by how much of their kernel halves they share with each other
+(see filters.pml4_kernel_mapping_similarity). User PGDs of KPTI pairs (see kpti.find_kpti_pairs) only map a few kernel
+entries, they are scored like their kernel PGD.
+"""
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from paging_detection import (
+    CHUNK_PAGES,
+    PageTypes,
+    PAGING_STRUCTURE_SIZE,
+    max_page_addr,
+    entries_present,
+    entries_target,
+    entries_target_is_data,
+    entries_valid,
+)
+from paging_detection import instrumentation
+from paging_detection.compressed import snapshot_stem
+from paging_detection.filters import pml4_kernel_mapping_similarity
+from paging_detection.kpti import KERNEL_HALF, find_kpti_pairs
+from paging_detection.mmaped import DesignationStore, MemMappedSnapshot, entry_hashes
+from paging_detection.page_index import INDEX_SUFFIX, PageIndex, load_or_build_index
+from paging_detection.physical import physical_size
+
+CANDIDATES_SUFFIX = "_pml4_candidates.csv"
+
+
+# Number of present kernel half entries followed per candidate by confirm_kernel_halves
+WALKED_ENTRIES = 8
+# Minimal fraction of the kernel half entries of a candidate pointing to plausible PDPs, see confirm_kernel_halves.
+# Page tables full of entries can point to a few plausible PDPs by chance, with the many entries they share with other
+# candidates they would still dominate the similarity scores.
+MIN_CONFIRMED = 1.0
+# Candidates scoring at least this are considered likely PML4s, like in the kernel similarity filter.
+LIKELY_SCORE = 0.8
+
+
+def _chunks(
+    snapshot: MemMappedSnapshot, max_paddr: int, index: Optional[PageIndex]
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield the addresses and entries of all pages in chunks. With an index, only pages whose present entries are all
+    valid PML4 entries are read.
+    """
+    end = max_paddr + PAGING_STRUCTURE_SIZE
+    if index is not None:
+        may_be_pml4 = index.may_be_paging_structure() & index.valid_mask(PageTypes.PML4)
+        addrs = np.flatnonzero(may_be_pml4[: end // PAGING_STRUCTURE_SIZE]).astype(np.uint64) * PAGING_STRUCTURE_SIZE
+        for start in range(0, len(addrs), CHUNK_PAGES):
+            yield addrs[start : start + CHUNK_PAGES], snapshot.gather_pages(addrs[start : start + CHUNK_PAGES])
+            instrumentation.progress(min(start + CHUNK_PAGES, len(addrs)) / max(len(addrs), 1))
+        return
+    chunk_size = CHUNK_PAGES * PAGING_STRUCTURE_SIZE
+    for start in range(0, end, chunk_size):
+        stop = min(start + chunk_size, end)
+        yield np.arange(start, stop, PAGING_STRUCTURE_SIZE, dtype=np.uint64), snapshot.page_entries(start, stop)
+        instrumentation.progress(stop / end)
+
+
+def scan_candidates(
+    snapshot: MemMappedSnapshot, max_paddr: int, index: Optional[PageIndex] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the candidate PML4s with a single pass over the snapshot, see the module docstring.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param index: Page index of the snapshot, pages which can not be PML4s according to it are not read.
+    :return: Addresses of the candidates and the hashes of their kernel halves (only considering present entries).
+    """
+    addrs, hashes = [], []
+    for chunk_addrs, entries in _chunks(snapshot, max_paddr, index):
+        present = entries_present(entries)
+        targets = entries_target(entries)
+        plausible = entries_valid(entries, PageTypes.PML4) & (targets <= max_paddr) & snapshot.in_bounds(targets)
+        candidates = ~(present & ~plausible).any(axis=1) & present[:, KERNEL_HALF:].any(axis=1)
+        halves = entries[candidates, KERNEL_HALF:]
+        halves = np.where(present[candidates, KERNEL_HALF:], halves, 0)
+        addrs.append(chunk_addrs[candidates])
+        hashes.append(entry_hashes(halves, KERNEL_HALF))
+        instrumentation.count("pages", len(chunk_addrs))
+    addrs = np.concatenate(addrs) if addrs else np.zeros(0, dtype=np.uint64)
+    instrumentation.count("candidates", len(addrs))
+    return addrs, np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+
+
+def confirm_kernel_halves(snapshot: MemMappedSnapshot, pml4s: np.ndarray, max_paddr: int) -> np.ndarray:
+    """
+    Shallow walk from candidate PML4s: Follow the first WALKED_ENTRIES present entries in their kernel halves one level
+    down and check whether the targets look like PDPs: At least one present entry, all present entries valid PDP
+    entries and the ones pointing to PDs within the snapshot. Every PDP is only read once, even if several candidates
+    point to it.
+    :return: For every candidate, the fraction of the followed entries pointing to plausible PDPs.
+    """
+    confirmed = np.zeros(len(pml4s))
+    for start in range(0, len(pml4s), CHUNK_PAGES):
+        halves = snapshot.gather_pages(pml4s[start : start + CHUNK_PAGES])[:, KERNEL_HALF:]
+        rows, slots = np.nonzero(entries_present(halves))
+        # Entries are in order of rows, so this is the position of every entry within its row.
+        walked = np.arange(len(rows)) - np.searchsorted(rows, rows) < WALKED_ENTRIES
+        rows, slots = rows[walked], slots[walked]
+        pdps, pdp_ids = np.unique(entries_target(halves[rows, slots]), return_inverse=True)
+        plausible = np.zeros(len(pdps), dtype=bool)
+        for pdp_start in range(0, len(pdps), CHUNK_PAGES):
+            entries = snapshot.gather_pages(pdps[pdp_start : pdp_start + CHUNK_PAGES])
+            present = entries_present(entries)
+            targets = entries_target(entries)
+            in_bounds = (targets <= max_paddr) & snapshot.in_bounds(targets)
+            valid = entries_valid(entries, PageTypes.PDP) & (in_bounds | entries_target_is_data(entries, PageTypes.PDP))
+            plausible[pdp_start : pdp_start + CHUNK_PAGES] = present.any(axis=1) & ~(present & ~valid).any(axis=1)
+        num_rows = min(CHUNK_PAGES, len(pml4s) - start)
+        hits = np.bincount(rows, weights=plausible[pdp_ids.ravel()], minlength=num_rows)
+        confirmed[start : start + num_rows] = hits / np.maximum(np.bincount(rows, minlength=num_rows), 1)
+    return confirmed
+
+
+@instrumentation.span("pml4_candidates")
+def find_pml4_candidates(
+    snapshot: MemMappedSnapshot, max_paddr: int, index: Optional[PageIndex] = None
+) -> pd.DataFrame:
+    """
+    Rank the candidate PML4s of a snapshot, see the module docstring.
+    :param snapshot: The snapshot.
+    :param max_paddr: Highest physical address of a page in the snapshot.
+    :param index: Page index of the snapshot, see scan_candidates.
+    :return: Dataframe with one row per candidate, best first:
+        - address: Physical address of the candidate
+        - bucket: Bucket of the candidate, buckets are numbered by size (0 is the biggest)
+        - bucket_size: Number of candidates with the same kernel half
+        - confirmed: Fraction of the kernel half entries of the bucket pointing to plausible PDPs
+        - similarity: Score of pml4_kernel_mapping_similarity among the candidates with confirmed >= MIN_CONFIRMED,
+          0 for the other ones. User PGDs of KPTI pairs get the similarity of their kernel PGD.
+        - kpti: Whether the candidate is part of a KPTI pair among the candidates with confirmed >= MIN_CONFIRMED
+        - score: similarity * confirmed
+        - likely: Whether score is at least LIKELY_SCORE
+    """
+    addrs, hashes = scan_candidates(snapshot, max_paddr, index)
+    columns = ["address", "bucket", "bucket_size", "confirmed", "similarity", "kpti", "score", "likely"]
+    if not len(addrs):
+        return pd.DataFrame(columns=columns)
+
+    _, first, bucket_ids, sizes = np.unique(hashes, return_index=True, return_inverse=True, return_counts=True)
+    bucket_ids = bucket_ids.ravel()
+    # Renumber buckets by size, biggest first
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind="stable")] = np.arange(len(sizes))
+    instrumentation.count("buckets", len(sizes))
+
+    with instrumentation.span("confirm"):
+        # Members of a bucket share their kernel half, so one walk per bucket suffices.
+        confirmed = confirm_kernel_halves(snapshot, addrs[first], max_paddr)[bucket_ids]
+    with instrumentation.span("similarity"):
+        # Unconfirmed candidates (e.g. page tables full of entries) would dominate the similarity scores.
+        similar = confirmed >= MIN_CONFIRMED
+        scores = pml4_kernel_mapping_similarity(snapshot, addrs[similar])
+        similarity = np.zeros(len(addrs))
+        similarity[similar] = [scores[addr] for addr in addrs[similar].tolist()]
+        # Candidates are in order of their addresses.
+        pairs = find_kpti_pairs(snapshot, max_paddr, addrs[similar])
+        kernel_rows, user_rows = np.searchsorted(addrs, pairs[:, 0]), np.searchsorted(addrs, pairs[:, 1])
+        similarity[user_rows] = similarity[kernel_rows]
+        kpti = np.zeros(len(addrs), dtype=bool)
+        kpti[kernel_rows] = kpti[user_rows] = True
+
+    candidates = pd.DataFrame(
+        {
+            "address": addrs,
+            "bucket": rank[bucket_ids],
+            "bucket_size": sizes[bucket_ids],
+            "confirmed": confirmed,
+            "similarity": similarity,
+            "kpti": kpti,
+            "score": similarity * confirmed,
+        }
+    )
+    candidates["likely"] = candidates["score"] >= LIKELY_SCORE
+    candidates = candidates.sort_values(["score", "bucket_size", "address"], ascending=[False, False, True])
+    instrumentation.count("likely", int(candidates["likely"].sum()))
+    return candidates.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    import pathlib
+
+    parser = argparse.ArgumentParser(
+        description="Rank likely PML4s with a single pass over a snapshot, without building the page graph."
+    )
+    parser.add_argument(
+        "in_file",
+        help=f"Path to snapshot. The candidates are saved with the same name with {CANDIDATES_SUFFIX} appended.",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--index",
+        help=f"Use the page index (<snapshot>{INDEX_SUFFIX}) to only read pages which may be PML4s. It is built and "
+        "saved next to the snapshot if it does not exist yet.",
+        action="store_true",
+    )
+    parser.add_argument("--top", help="Number of candidates to print. (Default: 20)", type=int, default=20)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure(args)
+    dump_path = args.in_file
+    out_path = dump_path.with_name(snapshot_stem(dump_path) + CANDIDATES_SUFFIX)
+
+    snap_size = physical_size(dump_path)
+    snapshot = MemMappedSnapshot(DesignationStore.create(str(dump_path), snap_size))
+    max_paddr = max_page_addr(snap_size)
+    index = load_or_build_index(snapshot, max_paddr) if args.index else None
+    candidates = find_pml4_candidates(snapshot, max_paddr, index)
+
+    instrumentation.log(candidates.head(args.top).to_string(index=False, formatters={"address": hex}))
+    instrumentation.log(f"{int(candidates['likely'].sum())} likely PML4s among {len(candidates)} candidates.")
+    instrumentation.log(f"Saving candidates: {out_path}")
+    candidates.to_csv(out_path, index=False)
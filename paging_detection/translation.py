@@ -0,0 +1,263 @@
+from collections import OrderedDict
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from paging_detection import (
+    InvalidAddressException,
+    PAGING_ENTRY_SIZE,
+    PAGING_STRUCTURE_SIZE,
+    PageTypes,
+    entries_present,
+    entries_nx,
+    entries_user_access,
+)
+from paging_detection.mmaped import MemMappedSnapshot, DESIGNATIONS_SUFFIX, load_snapshot
+
+# Same target mask as paging_detection.dir2base, it includes bit 52.
+_TARGET_MASK = np.uint64(0x001FFFFFFFFFF000)
+_FIELDS_MASK = np.uint64(0xFFF)
+_PRESENT_BIT = np.uint64(1)
+_LARGE_BIT = np.uint64(0x80)
+_INDEX_MASK = np.uint64(0x1FF)
+
+# Position of the lowest virtual address bit resolved by the PML4, PDP, PD and PT respectively.
+_LEVEL_SHIFTS = (39, 30, 21, 12)
+# Virtual addresses are sign extended from bit 47.
+_SIGN_EXTENSION = np.uint64(0xFFFF000000000000)
+_FIRST_UPPER_PML4_SLOT = 256
+
+
+class Translator:
+    """
+    Translates virtual addresses to physical addresses for one address space (snapshot and DTB / PML4 address).
+    Entries read from the upper level tables (PML4, PDP and PD) are kept in a bounded LRU cache, similar to the paging
+    structure caches of an MMU. Large pages are handled like paging_detection.translate does.
+    """
+
+    def __init__(self, snapshot: MemMappedSnapshot, dtb: int, cache_size: int = 4096):
+        """
+        :param snapshot: The snapshot.
+        :param dtb: Physical address of the PML4.
+        :param cache_size: Maximum number of upper level entries to cache.
+        """
+        self.snapshot = snapshot
+        self.dtb = dtb
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[int, int], Tuple[int, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _read_entry(self, table_addr: int, index: int) -> Tuple[int, int]:
+        entry_addr = table_addr + (PAGING_ENTRY_SIZE * index)
+        if not self.snapshot.in_bounds(entry_addr) or entry_addr + PAGING_ENTRY_SIZE > self.snapshot.size:
+            raise InvalidAddressException
+
+        entry = self.snapshot.layer.read_entry(entry_addr)
+
+        if entry & 1 == 0:  # not present
+            raise InvalidAddressException("dir2base", table_addr, "Page not present")
+
+        return entry & int(_TARGET_MASK), entry & int(_FIELDS_MASK)
+
+    def dir2base(self, table_addr: int, index: int) -> Tuple[int, int]:
+        """
+        Read an upper level entry, through the cache. Faults are not cached.
+        :return: Target address and flags (lowest 12 bits) of the entry.
+        """
+        key = (table_addr, index)
+        if (cached := self._cache.get(key)) is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached
+        self.misses += 1
+        result = self._read_entry(table_addr, index)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def translate(self, vaddr: int) -> int:
+        """
+        Translate a single virtual address. Raises an InvalidAddressException if the translation faults.
+        """
+        l4, f4 = self.dir2base(self.dtb, (vaddr >> 39) & 0x1FF)
+        l3, f3 = self.dir2base(l4, (vaddr >> 30) & 0x1FF)
+        if f3 & 0x80:
+            return l3 + (vaddr & ((1 << 30) - 1))
+        l2, f2 = self.dir2base(l3, (vaddr >> 21) & 0x1FF)
+        if f2 & 0x80:
+            return l2 + (vaddr & ((1 << 21) - 1))
+        l1, f1 = self._read_entry(l2, (vaddr >> 12) & 0x1FF)
+        paddr = l1 + (vaddr & ((1 << 12) - 1))
+        return paddr
+
+    def translate_many(self, vaddrs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Translate many virtual addresses at once. The tables are walked level by level for all addresses, every entry
+        is only read once per call, regardless of how many addresses it translates. (The cache is not used.)
+        :param vaddrs: Virtual addresses.
+        :return: Physical addresses and a mask which is True for every address whose translation faulted. The physical
+        address of faulting translations is 0.
+        """
+        vaddrs = np.asarray(vaddrs, dtype=np.uint64)
+        paddrs = np.zeros(len(vaddrs), dtype=np.uint64)
+        faults = np.zeros(len(vaddrs), dtype=bool)
+        # Addresses still being translated and the table containing their entry at the current level
+        active = np.arange(len(vaddrs))
+        tables = np.full(len(vaddrs), self.dtb, dtype=np.uint64)
+
+        for level, shift in enumerate(_LEVEL_SHIFTS):
+            # All addresses sharing the bits above shift share the entry at this level.
+            prefixes, inverse = np.unique(vaddrs[active] >> np.uint64(shift), return_inverse=True)
+            first = np.zeros(len(prefixes), dtype=np.int64)
+            first[inverse] = np.arange(len(active))
+            entry_addrs = tables[first] + (prefixes & _INDEX_MASK) * np.uint64(PAGING_ENTRY_SIZE)
+            entries = self.snapshot.gather_entries(entry_addrs)[inverse]
+
+            present = (entries & _PRESENT_BIT) != 0
+            faults[active[~present]] = True
+            active, entries = active[present], entries[present]
+            targets = entries & _TARGET_MASK
+            offsets = vaddrs[active] & np.uint64((1 << shift) - 1)
+
+            if level == len(_LEVEL_SHIFTS) - 1:
+                paddrs[active] = targets + offsets
+            elif level > 0:  # PDP and PD entries may map large pages
+                large = (entries & _LARGE_BIT) != 0
+                paddrs[active[large]] = targets[large] + offsets[large]
+                active, targets = active[~large], targets[~large]
+            tables = targets
+        return paddrs, faults
+
+
+class MappedRange(NamedTuple):
+    """
+    A contiguous range of virtual addresses mapped to a contiguous range of physical addresses.
+    user and nx are the effective permissions, combined over all levels of the hierarchy.
+    large is True for ranges mapped by 1GiB or 2MiB pages.
+    """
+
+    vaddr: int
+    paddr: int
+    size: int
+    user: bool
+    nx: bool
+    large: bool
+
+
+# Leaf entries of one table: virtual addresses, physical addresses, size of the mapped pages, user and nx flags
+_LeafBatch = Tuple[np.ndarray, np.ndarray, int, np.ndarray, np.ndarray]
+
+
+def _walk(
+    snapshot: MemMappedSnapshot, table: int, level: int, vbase: int, user: bool, nx: bool
+) -> Iterator[_LeafBatch]:
+    """
+    Walk a paging structure hierarchy depth-first, yielding consecutive leaf entries of a table in batches.
+    Non-present entries are skipped for an entire table at once.
+    """
+    entries = snapshot.page_entries(table, table + PAGING_STRUCTURE_SIZE)[0]
+    slots = np.flatnonzero(entries_present(entries))
+    entries = entries[slots]
+    shift = _LEVEL_SHIFTS[level]
+    vaddrs = np.uint64(vbase) + (slots.astype(np.uint64) << np.uint64(shift))
+    if level == 0:
+        vaddrs[slots >= _FIRST_UPPER_PML4_SLOT] |= _SIGN_EXTENSION
+    targets = entries & _TARGET_MASK
+    users = user & entries_user_access(entries)
+    nxs = nx | entries_nx(entries)
+    if level == len(_LEVEL_SHIFTS) - 1:
+        is_leaf = np.ones(len(entries), dtype=bool)
+    elif level > 0:  # PDP and PD entries may map large pages
+        is_leaf = (entries & _LARGE_BIT) != 0
+    else:
+        is_leaf = np.zeros(len(entries), dtype=bool)
+
+    # Split the entries into segments of leaves and single non-leaves, keeping them in order.
+    boundaries = np.flatnonzero((is_leaf[1:] != is_leaf[:-1]) | ~is_leaf[1:]) + 1
+    for segment in np.split(np.arange(len(entries)), boundaries):
+        if not len(segment):
+            continue
+        if is_leaf[segment[0]]:
+            yield vaddrs[segment], targets[segment], 1 << shift, users[segment], nxs[segment]
+        else:
+            i = segment[0]
+            yield from _walk(snapshot, int(targets[i]), level + 1, int(vaddrs[i]), bool(users[i]), bool(nxs[i]))
+
+
+def iter_mappings(snapshot: MemMappedSnapshot, pml4: int, coalesce: bool = True) -> Iterator[MappedRange]:
+    """
+    Enumerate the virtual address space of a PML4, ordered by virtual address. This is a generator, it walks the
+    hierarchy while ranges are consumed and only touches present entries, so sparse address spaces are quick to walk.
+    Target addresses and large pages are handled like paging_detection.translate does.
+    :param snapshot: The snapshot.
+    :param pml4: Physical address of the PML4.
+    :param coalesce: Whether to merge adjacent pages with contiguous physical addresses and equal flags into one
+    range. Otherwise, one range per mapped page is returned.
+    :return: Iterator over the mapped ranges.
+    """
+    pending: Optional[MappedRange] = None
+    for vaddrs, paddrs, size, users, nxs in _walk(snapshot, pml4, 0, 0, True, False):
+        large = size > PAGING_STRUCTURE_SIZE
+        step = np.uint64(size)
+        starts = np.ones(len(vaddrs), dtype=bool)
+        if coalesce:
+            starts[1:] = (
+                (vaddrs[1:] != vaddrs[:-1] + step)
+                | (paddrs[1:] != paddrs[:-1] + step)
+                | (users[1:] != users[:-1])
+                | (nxs[1:] != nxs[:-1])
+            )
+        firsts = np.flatnonzero(starts)
+        lengths = np.diff(np.append(firsts, len(vaddrs))) * size
+        for first, length in zip(firsts.tolist(), lengths.tolist()):
+            run = MappedRange(
+                int(vaddrs[first]), int(paddrs[first]), length, bool(users[first]), bool(nxs[first]), large
+            )
+            # Runs may continue across tables
+            if (
+                coalesce
+                and pending is not None
+                and pending.vaddr + pending.size == run.vaddr
+                and pending.paddr + pending.size == run.paddr
+                and pending[3:] == run[3:]
+            ):
+                pending = pending._replace(size=pending.size + run.size)
+                continue
+            if pending is not None:
+                yield pending
+            pending = run
+    if pending is not None:
+        yield pending
+
+
+if __name__ == "__main__":
+    import argparse
+    import csv
+    import pathlib
+    import sys
+
+    parser = argparse.ArgumentParser(description="Print the mapped virtual address ranges of PML4s as CSV.")
+    parser.add_argument(
+        "in_file",
+        help=f"Designations (.json or {DESIGNATIONS_SUFFIX}), the ranges of all pages designated as PML4 are printed.",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--pml4", help="Only print the ranges of these PML4s (physical addresses).", type=lambda x: int(x, 0), nargs="+"
+    )
+    parser.add_argument("--no-coalesce", help="Print one range per mapped page.", action="store_true")
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.in_file)
+    pml4s = args.pml4 if args.pml4 else snapshot.designations.addresses(PageTypes.PML4).tolist()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["pml4", "vaddr", "paddr", "size", "user", "nx", "large"])
+    for pml4 in pml4s:
+        for mapping in iter_mappings(snapshot, pml4, coalesce=not args.no_coalesce):
+            writer.writerow([hex(pml4), hex(mapping.vaddr), hex(mapping.paddr), mapping.size, *mapping[3:]])